@@ -1,5 +1,5 @@
 import xml.etree.ElementTree as ET
-from typing import TYPE_CHECKING, List, Optional, Union
+from typing import TYPE_CHECKING, Callable, List, Optional, Union
 from zipfile import ZipFile
 
 if TYPE_CHECKING:
@@ -19,6 +19,8 @@ class EpubHtml:
     file_name: str
     lang: str
     content: str
+    # produces the content when the book is written, instead of content
+    loader: Optional[Callable[[], str]]
     tocTitle: str
 
     def __init__(
@@ -32,6 +34,7 @@ class EpubHtml:
         self.file_name = file_name
         self.lang = lang
         self.content = ""
+        self.loader = None
         self.tocTitle = tocTitle if tocTitle is not None else self.title
 
 
@@ -155,7 +158,9 @@ def write_epub(title: str, book: EpubBook) -> None:
         for item in book.item_list:
             if isinstance(item, EpubHtml):
                 file_content = html_template.format(
-                    lang=item.lang, title=item.title, content=item.content
+                    lang=item.lang,
+                    title=item.title,
+                    content=item.content if item.loader is None else item.loader(),
                 )
                 Zip.writestr("EPUB/" + item.file_name, file_content)
                 ET.SubElement(
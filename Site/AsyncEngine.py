@@ -0,0 +1,496 @@
+import asyncio
+import collections
+import functools
+import os
+import shutil
+import tempfile
+import threading
+import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Type,
+)
+
+import requests
+
+from Site import Common
+
+try:
+    import aiohttp
+except ImportError:  # only needed for --engine async
+    aiohttp = None  # type: ignore[assignment]
+
+
+class SpoolFile:
+    """A reply body spooled to disk, standing in for a response's raw stream.
+
+    The file is read back once and removed when it reaches its end or is
+    closed.
+    """
+
+    path: str
+    file: Optional[IO[bytes]]
+    closed: bool
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = None
+        self.closed = False
+
+    def read(self, size: int = -1) -> bytes:
+        if self.closed:
+            return b""
+        if self.file is None:
+            self.file = open(self.path, "rb")
+        chunk = self.file.read(size)
+        if not chunk:
+            self.close()
+        return chunk
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        if self.file is not None:
+            self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def RequestsError(e: Exception) -> Type[requests.RequestException]:
+    """The requests exception matching an aiohttp failure."""
+    if isinstance(e, asyncio.TimeoutError):
+        return requests.Timeout
+    if isinstance(e, aiohttp.InvalidURL):
+        return requests.exceptions.InvalidURL
+    if isinstance(e, aiohttp.ClientSSLError):
+        return requests.exceptions.SSLError
+    if isinstance(e, aiohttp.TooManyRedirects):
+        return requests.TooManyRedirects
+    if isinstance(e, aiohttp.ClientPayloadError):
+        return requests.exceptions.ChunkedEncodingError
+    return requests.ConnectionError
+
+
+class Ahead:
+    """Requests started before they are asked for, at most limit running at once.
+
+    Requests start in the order they are added, and each one that finishes
+    makes room for the next. One asked for before its turn starts straight
+    away, so nobody waits on the limit. Replies nobody will ask for must be
+    dropped.
+    """
+
+    limit: int
+    entries: Dict[str, Tuple[Callable[[], "Future[Any]"], Optional["Future[Any]"]]]
+    waiting: Deque[str]
+    held: int
+    lock: threading.RLock
+
+    def __init__(self, limit: int) -> None:
+        self.limit = max(1, limit)
+        self.entries = {}
+        self.waiting = collections.deque()
+        self.held = 0
+        # re-entered when a request is already done as it starts
+        self.lock = threading.RLock()
+
+    def Add(self, key: str, start: Callable[[], "Future[Any]"]) -> None:
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (start, None)
+            self.waiting.append(key)
+            self.Fill()
+
+    def Fill(self) -> None:
+        """Starts waiting requests while there is room. Called with lock held."""
+        while self.waiting and self.held < self.limit:
+            key = self.waiting.popleft()
+            entry = self.entries.get(key)
+            # claimed or dropped before its turn came
+            if entry is None or entry[1] is not None:
+                continue
+            future = entry[0]()
+            self.entries[key] = (entry[0], future)
+            self.held += 1
+            future.add_done_callback(self.Done)
+
+    def Done(self, future: "Future[Any]") -> None:
+        with self.lock:
+            self.held -= 1
+            self.Fill()
+
+    def Take(self, key: str) -> Optional["Future[Any]"]:
+        """The reply for key, if it was added, handed out once."""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            start, future = entry
+            return start() if future is None else future
+
+    def Drop(self, keys: Iterable[str]) -> List["Future[Any]"]:
+        """Forgets keys, cancelling their requests. Returns the replies already in."""
+        with self.lock:
+            # all forgotten before any cancelling makes room for them
+            dropped = [self.entries.pop(key, (None, None))[1] for key in keys]
+            # still counted until their callbacks run
+            return [
+                future
+                for future in dropped
+                if future is not None and not future.cancel() and not future.cancelled()
+            ]
+
+    def Keys(self) -> List[str]:
+        with self.lock:
+            return list(self.entries)
+
+
+class AsyncTransport(Common.Transport):
+    """Transport that sends every request as a coroutine on one asyncio event loop.
+
+    At most maxInflight requests are in flight, perHost of them to any one
+    host, and none of them ties up a thread. Providers keep their blocking
+    parsers, which Run hands to a pool of worker threads once each story's
+    first page is on its way. The pages and images providers announce
+    (see Common.Transport.Prefetch) are fetched ahead, with up to
+    maxInflight of each waiting to be claimed and image bodies spooled to
+    disk, so a parser finds them ready. A request nobody announced is still
+    sent from the loop, with the calling thread waiting for its reply.
+    """
+
+    prefetches = True
+    maxInflight: int
+    perHost: int
+    cookies: Dict[str, Dict[str, str]]
+    connections: Dict[str, int]
+    inflight: int
+    peak: int
+    pages: Ahead
+    images: Ahead
+    local: threading.local
+    spool: str
+    hosts: Dict[str, asyncio.Semaphore]
+    slots: asyncio.Semaphore
+    loop: asyncio.AbstractEventLoop
+    thread: threading.Thread
+    session: Any
+
+    def __init__(self, maxInflight: int = 1000, perHost: int = 8) -> None:
+        if aiohttp is None:
+            raise ImportError("The async engine requires aiohttp: pip install aiohttp")
+        super().__init__(perHost)
+        self.maxInflight = maxInflight
+        self.perHost = perHost
+        self.cookies = {}
+        self.connections = {}
+        self.inflight = 0
+        self.peak = 0
+        self.pages = Ahead(maxInflight)
+        self.images = Ahead(maxInflight)
+        self.local = threading.local()
+        self.spool = tempfile.mkdtemp(prefix="ebook-publisher-")
+        self.hosts = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.Open(), self.loop).result()
+
+    async def Open(self) -> None:
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self.OnConnection)
+        connector = aiohttp.TCPConnector(
+            limit=self.maxInflight, limit_per_host=self.perHost
+        )
+        self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+        self.slots = asyncio.Semaphore(self.maxInflight)
+
+    async def OnConnection(self, session: Any, context: Any, params: Any) -> None:
+        # Runs on the loop thread, the only writer of self.connections
+        host = context.trace_request_ctx
+        if host:
+            self.connections[host] = self.connections.get(host, 0) + 1
+
+    def Mount(self, session: requests.Session) -> None:
+        pass
+
+    def Register(self, host: str, session: requests.Session) -> None:
+        # aiohttp cannot share a requests session, so carry its cookies over
+        with self.lock:
+            self.cookies[host] = session.cookies.get_dict()
+
+    def Host(self, host: str) -> asyncio.Semaphore:
+        # Only used on the loop thread
+        if host not in self.hosts:
+            self.hosts[host] = asyncio.Semaphore(self.perHost)
+        return self.hosts[host]
+
+    async def Fetch(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]],
+        cookies: Optional[Dict[str, str]],
+        timeout: Optional[float],
+        stream: bool,
+    ) -> requests.Response:
+        """Sends one request. A streamed body is spooled to disk rather than kept in memory."""
+        host = urllib.parse.urlparse(url).netloc
+        with self.lock:
+            self.requestCounts[host] = self.requestCounts.get(host, 0) + 1
+            merged = dict(self.cookies.get(host, {}))
+        merged.update(cookies or {})
+        async with self.Host(host), self.slots:
+            self.inflight += 1
+            self.peak = max(self.peak, self.inflight)
+            try:
+                resp = await self.session.get(
+                    url,
+                    headers=headers,
+                    cookies=merged,
+                    timeout=aiohttp.ClientTimeout(
+                        total=None, sock_connect=timeout, sock_read=timeout
+                    ),
+                    trace_request_ctx=host,
+                )
+                # released without awaiting, so a cancelled prefetch cannot
+                # lose a reply that is already spooled
+                try:
+                    if stream and resp.status < 400:
+                        return await self.Spool(resp)
+                    body = await resp.read()
+                    return Common.BuildResponse(
+                        str(resp.url), resp.status, dict(resp.headers), body
+                    )
+                finally:
+                    resp.release()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Lets RetryPolicy tell these apart as it does for requests
+                raise RequestsError(e)(str(e) or type(e).__name__) from e
+            finally:
+                self.inflight -= 1
+
+    async def Spool(self, resp: Any) -> requests.Response:
+        fd, path = tempfile.mkstemp(dir=self.spool)
+        try:
+            with os.fdopen(fd, "wb") as fo:
+                async for chunk in resp.content.iter_chunked(Common.image_chunk_size):
+                    fo.write(chunk)
+        except BaseException:
+            os.remove(path)
+            raise
+        response = Common.BuildResponse(
+            str(resp.url), resp.status, dict(resp.headers), b""
+        )
+        # read back from the spool file by iter_content
+        response._content = False  # type: ignore[assignment]
+        response._content_consumed = False  # type: ignore[attr-defined]
+        response.raw = SpoolFile(path)
+        return response
+
+    async def Send(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]],
+        default: bool = True,
+        timeout: Optional[float] = None,
+        stream: bool = False,
+        kind: str = "page",
+    ) -> Optional[requests.Response]:
+        """Sends url under the shared rate limits and retry policy, as RetryPolicy.Send does."""
+        policy = Common.retryPolicy
+        spent = 0.0
+        attempt = 0
+        while True:
+            await asyncio.sleep(Common.rateLimiter.Reserve(url, default))
+            reason: str
+            response: Optional[requests.Response] = None
+            error: Optional[Exception] = None
+            try:
+                response = await self.Fetch(url, headers, None, timeout, stream)
+            except requests.RequestException as e:
+                reason = type(e).__name__
+                error = e
+            else:
+                if response.status_code < 400:
+                    if attempt > 0:
+                        policy.Record("recovered")
+                    return response
+                reason = str(response.status_code)
+            delay = policy.Retry(url, attempt, spent, response, reason, error, kind)
+            if delay is None:
+                return None
+            await asyncio.sleep(delay)
+            spent += delay
+            attempt += 1
+
+    async def Page(
+        self, url: str, headers: Optional[Dict[str, str]]
+    ) -> Tuple[Optional[requests.Response], bool]:
+        """Common.FetchPage, with the request sent from the loop.
+
+        The page cache is read and written on the default executor, keeping
+        its disk IO off the loop.
+        """
+        loop = asyncio.get_running_loop()
+        request = await loop.run_in_executor(None, Common.PageRequest, url, headers)
+        if request.result is not None:
+            return request.result
+        if not Common.is_safe_url(url):
+            print(f"Blocked unsafe or unsupported URL: {url}")
+            return None, False
+        response = await self.Send(url, request.headers)
+        return await loop.run_in_executor(None, request.Finish, response)
+
+    async def Image(self, url: str) -> Optional[requests.Response]:
+        """Common.RequestImage, with the request sent from the loop."""
+        response = await self.Send(
+            url,
+            Common.default_headers,
+            default=False,
+            timeout=10,
+            stream=True,
+            kind="image",
+        )
+        if response is None:
+            new_url = Common.OtherExtension(url)
+            if new_url and Common.is_safe_url(new_url):
+                response = await self.Send(
+                    new_url,
+                    Common.default_headers,
+                    default=False,
+                    timeout=10,
+                    stream=True,
+                    kind="image",
+                )
+        return response
+
+    def Start(self, coroutine: Any) -> "Future[Any]":
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def StartPage(
+        self, url: str, headers: Optional[Dict[str, str]]
+    ) -> "Future[Tuple[Optional[requests.Response], bool]]":
+        return self.Start(self.Page(url, headers))
+
+    def StartImage(self, url: str) -> "Future[Optional[requests.Response]]":
+        return self.Start(self.Image(url))
+
+    def Owned(self) -> Optional[List[str]]:
+        """The URLs prefetched by the story on this thread, if it is one of Run's."""
+        owned: Optional[List[str]] = getattr(self.local, "owned", None)
+        return owned
+
+    def Prefetch(
+        self, urls: Iterable[str], headers: Optional[Dict[str, str]] = None
+    ) -> None:
+        owned = self.Owned()
+        for url in urls:
+            self.pages.Add(url, functools.partial(self.StartPage, url, headers))
+            if owned is not None:
+                owned.append(url)
+
+    def Prefetched(
+        self, url: str
+    ) -> Optional["Future[Tuple[Optional[requests.Response], bool]]"]:
+        return self.pages.Take(url)
+
+    def PrefetchImage(self, url: str) -> None:
+        self.images.Add(url, functools.partial(self.StartImage, url))
+        owned = self.Owned()
+        if owned is not None:
+            owned.append(url)
+
+    def PrefetchedImage(
+        self, url: str
+    ) -> Optional["Future[Optional[requests.Response]]"]:
+        return self.images.Take(url)
+
+    def Cancel(self, urls: Iterable[str]) -> None:
+        urls = list(urls)
+        self.pages.Drop(urls)
+        for future in self.images.Drop(urls):
+            # an unread image body is still spooled on disk
+            if future.exception() is None and future.result() is not None:
+                future.result().close()
+
+    def Get(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        cookies: Optional[Dict[str, str]] = None,
+        **kwargs: Any,
+    ) -> requests.Response:
+        future = self.Start(
+            self.Fetch(
+                url,
+                headers,
+                cookies,
+                kwargs.get("timeout"),
+                bool(kwargs.get("stream")),
+            )
+        )
+        response: requests.Response = future.result()
+        return response
+
+    def Stats(self) -> Dict[str, Tuple[int, int]]:
+        with self.lock:
+            return {
+                host: (sent, self.connections.get(host, 0))
+                for host, sent in self.requestCounts.items()
+            }
+
+    def Run(
+        self, urls: Iterable[str], work: Callable[[str], Any], workers: int
+    ) -> None:
+        """Runs work(url) for every url on workers threads, fetching first pages ahead.
+
+        At most twice workers stories have their first page fetched while
+        they wait for a thread.
+        """
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="story")
+
+        def own(url: str) -> None:
+            # whatever the story prefetched and never claimed is dropped with it,
+            # starting with its first page if it was skipped or asked for another URL
+            self.local.owned = [url]
+            try:
+                work(url)
+            finally:
+                owned, self.local.owned = self.local.owned, None
+                self.Cancel(owned)
+
+        async def story(url: str, ready: asyncio.Semaphore) -> None:
+            async with ready:
+                self.Prefetch([url])
+                try:
+                    await asyncio.get_running_loop().run_in_executor(executor, own, url)
+                except Exception as e:
+                    print("Failed to download " + url + ": " + repr(e))
+
+        async def runAll() -> None:
+            ready = asyncio.Semaphore(2 * workers)
+            await asyncio.gather(*(story(url, ready) for url in urls))
+
+        try:
+            self.Start(runAll()).result()
+        finally:
+            executor.shutdown()
+
+    def Close(self) -> None:
+        self.Cancel(self.pages.Keys() + self.images.Keys())
+        self.Start(self.session.close()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        shutil.rmtree(self.spool, ignore_errors=True)
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.parse
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+
+from Site import Common
+
+
+def Normalize(url: str) -> str:
+    """Canonical form of a URL used as the cache key."""
+    parsed = urllib.parse.urlsplit(url.strip())
+    scheme = parsed.scheme.lower()
+    host = (parsed.hostname or "").lower()
+    port = parsed.port
+    if port is not None and (scheme, port) not in (("http", 80), ("https", 443)):
+        host += ":" + str(port)
+    query = urllib.parse.urlencode(
+        sorted(urllib.parse.parse_qsl(parsed.query, keep_blank_values=True))
+    )
+    return urllib.parse.urlunsplit((scheme, host, parsed.path or "/", query, ""))
+
+
+class ResponseCache:
+    """On-disk cache of page responses keyed by normalized URL.
+
+    Each entry is a body file plus a JSON sidecar holding the status, headers
+    (including the ETag/Last-Modified validators) and the time it was stored.
+    Entries older than ttl seconds have to be revalidated with the server, and
+    once the bodies exceed maxBytes the least recently used entries (by body
+    mtime, bumped on every hit) are removed.
+    """
+
+    directory: str
+    ttl: float
+    maxBytes: int
+    size: int
+    hits: int
+    misses: int
+    revalidated: int
+    lock: threading.Lock
+
+    def __init__(
+        self, directory: str, ttl: float = 7 * 86400, maxBytes: int = 1 << 30
+    ) -> None:
+        self.directory = directory
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.Entries())
+
+    def Paths(self, url: str) -> Tuple[str, str]:
+        key = hashlib.sha256(Normalize(url).encode("utf-8")).hexdigest()
+        base = os.path.join(self.directory, key[:2], key)
+        return base + ".json", base + ".body"
+
+    def Entries(self) -> List[Tuple[str, int, float]]:
+        """Lists (body path, size, last use) for every entry on disk."""
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".body"):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def Load(self, url: str) -> Optional[Tuple[Dict[str, Any], bytes]]:
+        metaPath, bodyPath = self.Paths(url)
+        try:
+            with open(metaPath, "r", encoding="utf-8") as fi:
+                meta = json.load(fi)
+            with open(bodyPath, "rb") as fi:
+                body = fi.read()
+            os.utime(bodyPath)
+        except (OSError, ValueError):
+            return None
+        return meta, body
+
+    def Fresh(self, meta: Dict[str, Any]) -> bool:
+        return bool(time.time() - meta["stored"] < self.ttl)
+
+    def Response(self, meta: Dict[str, Any], body: bytes) -> requests.Response:
+        return Common.BuildResponse(meta["url"], meta["status"], meta["headers"], body)
+
+    def Count(self, hit: bool) -> None:
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def Conditional(self, meta: Dict[str, Any]) -> Dict[str, str]:
+        """Builds If-None-Match/If-Modified-Since headers from the stored validators."""
+        stored = {k.lower(): v for k, v in meta["headers"].items()}
+        headers = {}
+        if "etag" in stored:
+            headers["If-None-Match"] = stored["etag"]
+        if "last-modified" in stored:
+            headers["If-Modified-Since"] = stored["last-modified"]
+        return headers
+
+    def Refresh(
+        self, url: str, meta: Dict[str, Any], response: requests.Response
+    ) -> None:
+        """Marks an entry fresh again after the server answered 304 Not Modified."""
+        metaPath, _ = self.Paths(url)
+        meta["headers"].update(
+            {
+                k: v
+                for k, v in response.headers.items()
+                if k.lower() in ("etag", "last-modified", "cache-control", "expires")
+            }
+        )
+        meta["stored"] = time.time()
+        self.SaveMeta(metaPath, meta)
+        with self.lock:
+            self.revalidated += 1
+
+    def SaveMeta(self, metaPath: str, meta: Dict[str, Any]) -> None:
+        suffix = ".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+        with open(metaPath + suffix, "w", encoding="utf-8") as fo:
+            json.dump(meta, fo)
+        os.replace(metaPath + suffix, metaPath)
+
+    def Outputs(self, url: str) -> Dict[str, List[str]]:
+        """Files the story whose first page is url was last written to, by format.
+
+        Empty if the page is not cached or changed since, as storing a new
+        copy of the page drops the record.
+        """
+        metaPath, _ = self.Paths(url)
+        try:
+            with open(metaPath, "r", encoding="utf-8") as fi:
+                return dict(json.load(fi).get("outputs", {}))
+        except (OSError, ValueError):
+            return {}
+
+    def RecordOutputs(self, url: str, outputs: Dict[str, List[str]]) -> None:
+        """Notes the files a story was written to alongside its cached first page."""
+        metaPath, _ = self.Paths(url)
+        try:
+            with open(metaPath, "r", encoding="utf-8") as fi:
+                meta = json.load(fi)
+        except (OSError, ValueError):
+            return
+        meta["outputs"] = outputs
+        self.SaveMeta(metaPath, meta)
+
+    def Store(self, url: str, response: requests.Response) -> None:
+        metaPath, bodyPath = self.Paths(url)
+        meta = {
+            "url": response.url or url,
+            "status": response.status_code,
+            "headers": dict(response.headers),
+            "stored": time.time(),
+        }
+        body = response.content
+        os.makedirs(os.path.dirname(bodyPath), exist_ok=True)
+        try:
+            old = os.path.getsize(bodyPath)
+        except OSError:
+            old = 0
+        # Write both files under temporary names so readers never see half an entry
+        suffix = ".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+        with open(bodyPath + suffix, "wb") as fo:
+            fo.write(body)
+        with open(metaPath + suffix, "w", encoding="utf-8") as fo:
+            json.dump(meta, fo)
+        os.replace(bodyPath + suffix, bodyPath)
+        os.replace(metaPath + suffix, metaPath)
+        with self.lock:
+            self.size += len(body) - old
+            full = self.size > self.maxBytes
+        if full:
+            self.Evict()
+
+    def Evict(self) -> None:
+        """Removes least recently used entries until the cache is at 90% of maxBytes."""
+        with self.lock:
+            entries = sorted(self.Entries(), key=lambda entry: entry[2])
+            self.size = sum(size for _, size, _ in entries)
+            for bodyPath, size, _ in entries:
+                if self.size <= self.maxBytes * 0.9:
+                    break
+                for path in (bodyPath, bodyPath[: -len(".body")] + ".json"):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                self.size -= size
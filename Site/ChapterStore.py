@@ -0,0 +1,100 @@
+import sqlite3
+import threading
+from typing import Iterator
+
+
+class ChapterStore:
+    """Rendered chapters of one story, kept on disk until the writers read them.
+
+    Every chapter is written here as soon as it is rendered, as one row with
+    its HTML, its EPUB variant and its text. Rows are keyed so chapters can
+    be added at either end, which means only the first and last keys are
+    kept in memory. Fetched pages that are waiting to be rendered are
+    spilled to a second table keyed by chapter. The database is SQLite's
+    private temporary file, which is deleted when the store is closed or
+    garbage collected.
+    """
+
+    db: sqlite3.Connection
+    lock: threading.Lock
+    first: int
+    last: int
+
+    def __init__(self) -> None:
+        # the writers may run on another thread than the one that filled the store
+        self.db = sqlite3.connect("", check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute(
+            "CREATE TABLE chapters (id INTEGER PRIMARY KEY, html TEXT, epub TEXT,"
+            " text TEXT)"
+        )
+        self.db.execute("CREATE TABLE pages (key TEXT PRIMARY KEY, content TEXT)")
+        self.lock = threading.Lock()
+        self.first = 0
+        self.last = -1
+
+    def __len__(self) -> int:
+        return self.last - self.first + 1
+
+    def Append(self, html: str, epub: str, text: str) -> None:
+        with self.lock:
+            self.last += 1
+            self.Put(self.last, html, epub, text)
+
+    def Prepend(self, html: str, epub: str, text: str) -> None:
+        with self.lock:
+            self.first -= 1
+            self.Put(self.first, html, epub, text)
+
+    def Put(self, key: int, html: str, epub: str, text: str) -> None:
+        self.db.execute(
+            "INSERT INTO chapters VALUES (?, ?, ?, ?)", (key, html, epub, text)
+        )
+
+    def Get(self, i: int, column: str) -> str:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT " + column + " FROM chapters WHERE id = ?", (self.first + i,)
+            ).fetchone()
+        if row is None:
+            raise IndexError(i)
+        return str(row[0])
+
+    def Html(self, i: int) -> str:
+        return self.Get(i, "html")
+
+    def Epub(self, i: int) -> str:
+        return self.Get(i, "epub")
+
+    def Texts(self) -> Iterator[str]:
+        """Yields the text of every chapter in order, a few hundred rows at a time."""
+        key = self.first
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    "SELECT id, text FROM chapters WHERE id >= ? ORDER BY id LIMIT 256",
+                    (key,),
+                ).fetchall()
+            if not rows:
+                return
+            for _, text in rows:
+                yield text
+            key = rows[-1][0] + 1
+
+    def SavePage(self, key: str, content: str) -> None:
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?)", (key, content)
+            )
+
+    def PageContent(self, key: str) -> str:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT content FROM pages WHERE key = ?", (key,)
+            ).fetchone()
+        return str(row[0]) if row is not None else ""
+
+    def Close(self) -> None:
+        with self.lock:
+            self.db.close()
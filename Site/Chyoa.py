@@ -1,13 +1,24 @@
-import queue
+import hashlib
+import heapq
+import html
+import json
+import os
+import re
+import sqlite3
+import sys
 import threading
+import time
 import urllib.parse
+from array import array
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from threading import Lock
-from typing import TYPE_CHECKING, Any, Dict, List, Optional
+from typing import TYPE_CHECKING, Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
 
-from bs4 import BeautifulSoup, Tag
+from bs4 import BeautifulSoup, NavigableString, Tag
 
-from Site import Common
+from Site import ChapterStore, Common, ImageProcess, Staging
 
 if TYPE_CHECKING:
     from Site.Common import Progress
@@ -15,6 +26,24 @@ if TYPE_CHECKING:
 lock: Lock = Lock()
 lock2: Lock = Lock()
 
+# Pages fetched at once by a multithreaded forward crawl
+workers: int = 4
+
+# Budgets of a forward crawl, 0 for none: levels below the start page, pages,
+# seconds and bytes downloaded
+maxDepth: int = 0
+maxPages: int = 0
+maxTime: float = 0
+maxBytes: int = 0
+
+# Choices of a page whose links are not resolved yet, shared as it is never changed
+noTargets: "array[int]" = array("i")
+
+# An anchor whose only text is "Previous Chapter", icons aside
+prevLinkPattern = re.compile(
+    rb'<a\s[^>]*?href="([^"]*)"[^>]*>(?:\s|<[^>]*>)*Previous Chapter(?:\s|<[^>]*>)*</a>'
+)
+
 
 class Chyoa:
     title: str
@@ -22,16 +51,12 @@ class Chyoa:
     authors: List[str]
     chapters: List[str]
     story: str
-    temp: List[str]
-    epubtemp: List[str]
     rawstoryhtml: List[Tag]
-    epubrawstoryhtml: List[Tag]
+    store: ChapterStore.ChapterStore
     questions: List[str]
     summary: str
     renames: List[str]
     oldnames: List[str]
-    truestoryhttml: List[str]
-    epubtruestoryhttml: List[str]
     length: int
     pbar: Optional["Progress"]
     url: str
@@ -40,18 +65,15 @@ class Chyoa:
     duplicate: bool
     backwards: bool
     depth: List[str]
+    dangling: List[int]
     quiet: bool
-    epubnextpages: List[str]
-    nextLinks: List[str]
     partial: bool
     partialStart: int
     ogUrl: str
     pageIDs: List[int]
     pageIDIter: int
     pageIDDict: Dict[str, int]
-    q: queue.Queue[Any]
-    pageQueue: List[Any]
-    Pages: List[Any]
+    staged: Staging.Manifest
 
     def requestPage(self, url: str) -> Optional[Any]:
         return Common.RequestPageChyoa(
@@ -59,6 +81,17 @@ class Chyoa:
         )
 
     def __init__(self, url: str) -> None:
+        # the chapters, their HTML and the story text are kept in store
+        self.store = ChapterStore.ChapterStore()
+        try:
+            self.Load(url)
+        except BaseException:
+            # the story is never published, which is where store is closed
+            self.store.Close()
+            raise
+
+    def Load(self, url: str) -> None:
+        """Downloads the story at url, or notes that it is a duplicate."""
         self.title = ""
         # initial author only for title page
         self.author = ""
@@ -67,17 +100,12 @@ class Chyoa:
         # the h1 tag
         self.chapters = []
         self.story = ""
-        self.temp = []
-        self.epubtemp = []
         self.rawstoryhtml = []
-        self.epubrawstoryhtml = []
         # the question at the end of each page
         self.questions = []
         self.summary = ""
         self.renames = []
         self.oldnames = []
-        self.truestoryhttml = []
-        self.epubtruestoryhttml = []
         self.length = 1
         self.pbar = None
         self.url = url
@@ -86,18 +114,16 @@ class Chyoa:
         self.duplicate = False
         self.backwards = not Common.chyoa_force_forwards
         self.depth = []
+        # choices of each chapter that lead to chapters not downloaded
+        self.dangling = []
         self.quiet = Common.quiet
-        self.epubnextpages = []
-        self.nextLinks = []
         self.partial = False
         self.partialStart = 1
         self.ogUrl = self.url
         self.pageIDs = []
         self.pageIDIter = 0
         self.pageIDDict = {}
-        self.q = queue.Queue()
-        self.pageQueue = []
-        self.Pages = []
+        self.staged = Staging.Manifest()
 
         page = self.requestPage(url)
 
@@ -238,24 +264,24 @@ class Chyoa:
 
         if self.questions:
             temp += "<h2>" + self.questions[0] + "</h2>"
-        self.temp.insert(0, temp)
-        if self.backwards and self.pbar:
-            self.pbar.Update()
-
-        for a_tag in soup.find_all("a"):
-            if a_tag.text.strip() == "Previous Chapter" and self.backwards:
-                newLink = a_tag.get("href")
-                while isinstance(newLink, str):
-                    newLink = self.AddPrevPage(newLink)
+        epub = Common.opf is not None and any(x in ("epub", "EPUB") for x in Common.opf)
+        if self.backwards:
+            self.Render(
+                self.chapters[0] if self.chapters else "",
+                self.authors[0] if self.authors else "",
+                temp,
+                temp if epub else "",
+            )
+            if self.pbar:
+                self.pbar.Update()
 
-                self.backwards = True
-                break
+        if self.backwards:
+            newLink = PrevLink(soup)
+            if newLink is not None:
+                self.AddPrevPages(newLink)
 
         # Gets here if it's the intro page that is used
         if not self.backwards:
-            self.Pages = []
-            urls = []
-
             # Starting the Progress Bar
             numChaptersStr = "0"
             numChaptersTempTemp = soup.find_all("li")
@@ -277,140 +303,58 @@ class Chyoa:
             except Exception:
                 pass
 
-            j = 1
-            self.temp[0] += "\n<br />"
-            self.epubtemp = self.temp.copy()
+            # the page the crawl starts from, already fetched above
+            start = Page(self.url)
+            start.fetched = True
+            if isinstance(meta_p, Tag):
+                meta_text = meta_p.get_text().split()
+                if len(meta_text) > 1 and meta_text[1].isdigit():
+                    start.chapNum = int(meta_text[1])
             q_content = soup.find("div", attrs={"class": "question-content"})
             if isinstance(q_content, Tag):
-                for a_tag in q_content.find_all("a"):
-                    link = a_tag.get_text()
-                    if link.strip() != "Add a new chapter":
-                        # Band aid fix for replaceable text in the next chapter links
-
-                        for i_rename in range(len(self.renames)):
-                            link = link.replace(self.oldnames[i_rename], self.renames[i_rename])
-
-                        if Common.opf is not None and any(
-                            x in ("epub", "EPUB") for x in Common.opf
-                        ):
-                            self.epubtemp[0] += (
-                                '\n<a href="'
-                                + str(j)
-                                + '.xhtml">'
-                                + link.strip()
-                                + "</a>\n<br />"
-                            )
-
-                        nextLink = (
-                            '\n<a href="#'
-                            + str(j)
-                            + '">'
-                            + "Previous Chapter"
-                            + "</a>\n<br />"
-                        )
-                        self.temp[0] += (
-                            '\n<a href="#' + str(j) + '">'
-                            + link.strip()
-                            + "</a>\n<br />"
-                        )
-                        self.nextLinks.append(nextLink)
-                        href = a_tag.get("href")
-                        if isinstance(href, str):
-                            urls.append(href)
-                        j += 1
-            self.Pages.extend(urls)
-            j = 1
-            self.pageQueue = []
-            for u in urls:
-                if Common.mt and not self.partial:
-                    chapNum = 0
-                    if isinstance(meta_p, Tag):
-                        meta_text = meta_p.get_text().split()
-                        if len(meta_text) > 1:
-                            chapNum = int(meta_text[1])
-                    firstLinkId = None
-                    threading.Thread(
-                        target=self.ThreadAdd,
-                        args=(
-                            u,
-                            j,
-                            self.renames,
-                            self.oldnames,
-                            chapNum,
-                            '<a href="#Chapter 0">Previous Chapter</a>\n<br />',
-                            '\n<a href="'
-                            + "Chapter 1"
-                            + '.xhtml">'
-                            + "Previous Chapter"
-                            + "</a>\n<br />",
-                            self.nextLinks[j - 1],
-                            firstLinkId,
-                            self.url,
-                        ),
-                        daemon=True,
-                    ).start()  # TODO
-                else:
-                    if Common.mt:
-                        Common.prnt(
-                            "Warning: Cannot multithread partial Chyoa story: "
-                            + self.url
-                            + "\nUsing default method to download an unknown number of pages"
-                        )
-                    defArgs = (
-                        u,
-                        str(j),
-                        1,
-                        '<a href="#Chapter 0">Previous Chapter</a>\n<br />',
-                        '\n<a href="'
-                        + "Chapter 1"
-                        + '.xhtml">'
-                        + "Previous Chapter"
-                        + "</a>\n<br />",
-                        self.nextLinks[j - 1],
-                        None,
+                start.AddChoices(q_content)
+
+            temp += "\n<br />"
+            epubtemp = temp
+            graph = None
+            if Common.chyoaDupCheck and not self.partial:
+                graph = StoryGraph(
+                    os.path.join(
+                        Common.wd, Common.sanitize_filename(self.title) + ".chyoa.db"
                     )
-                    self.pageQueue.append(defArgs)
-                    while self.pageQueue:
-                        self.AddNextPage(self.pageQueue.pop(0))
-
-                j += 1
-            if Common.mt and not self.partial:
-                i_rem = numChaptersInt - 1
-                print("Pages to add: " + str(i_rem))
-                while i_rem > 0:
-                    try:
-                        self.q.get(timeout=30)
-                    except queue.Empty:
-                        print(
-                            "Unsure if all threads ended. Expected reamining pages: "
-                            + str(i_rem)
-                        )
-                        break
-                    i_rem -= 1
-                # print(threading.active_count())
-                self.pageQueue = []
-
-                for pg in self.Pages:
-                    self.pageQueue.append(pg)
-                    while self.pageQueue:
-                        self.addPage(self.pageQueue.pop(0))
-            # print(self.pageIDDict)
-            for p in range(len(self.epubtemp)):
-                for d in self.depth:
-                    if (self.epubtemp[p].count('href="' + d + '.xhtml"')) > 0:
-                        try:
-                            self.epubtemp[p] = self.epubtemp[p].replace(
-                                'href="' + d + '.xhtml"',
-                                'href="nfChapter' + str(self.pageIDDict[d]) + '.xhtml"',
-                            )
-                        except KeyError:
-                            print("Key error at: " + d)
-                            print("Please report this error to the developer.")
+                )
+            crawl = Crawl(
+                workers if Common.mt else 1,
+                self.store,
+                self.pbar,
+                graph,
+            )
+            crawl.Run(start)
+            placed = crawl.Place()
+            self.pageIDDict = crawl.ids
+            for pg in placed:
+                self.addPage(pg, crawl)
+            if graph is not None:
+                graph.Save(self.url, crawl, placed)
+                graph.Close()
+
+            dangling = len(crawl.unresolved)
+            for j in range(len(start.rawChoices)):
+                choice, epubChoice = self.Choice(crawl, start, j)
+                temp += choice
+                epubtemp += epubChoice
+            self.dangling.insert(0, len(crawl.unresolved) - dangling)
+            crawl.ReportUnresolved()
+            self.Render(
+                self.chapters[0] if self.chapters else "",
+                self.authors[0] if self.authors else "",
+                temp,
+                epubtemp if epub else "",
+                True,
+            )
 
         if self.pbar:
             self.pbar.End()
-        if self.backwards:
-            self.epubtemp = self.temp.copy()
 
         # band-aid fix for names in chapter titles
         # WARNING DO NOT PUT THIS TO PRODUCTION
@@ -422,80 +366,8 @@ class Chyoa:
 
         # TODO regular expressions go here
 
-        for i in range(len(self.temp)):
-            self.temp[i] = "\n<h4>by " + self.authors[i] + "</h4>" + self.temp[i]
-            if Common.opf is not None and any(x in ("epub", "EPUB") for x in Common.opf):
-                self.epubtemp[i] = (
-                    "\n<h4>by " + self.authors[i] + "</h4>" + self.epubtemp[i]
-                )
-            self.rawstoryhtml.append(BeautifulSoup(self.temp[i], "html.parser"))
-            if Common.opf is not None and any(x in ("epub", "EPUB") for x in Common.opf):
-                self.epubrawstoryhtml.append(
-                    BeautifulSoup(self.epubtemp[i], "html.parser")
-                )
-        # print(self.rawstoryhtml[len(self.rawstoryhtml)-1].get_text())
         if self.authors:
             self.author = self.authors[0]
-        # print(self.chapters)
-
-        # replaces replaceable text in the story
-        for i_tag in self.rawstoryhtml:
-            for j in range(len(self.renames)):
-                for k in i_tag.find_all(
-                    "span", attrs={"class": "js-immersion-receiver-c" + str(j)}
-                ):
-                    k.string = self.renames[j]
-            self.story += self.chapters[self.rawstoryhtml.index(i_tag)] + i_tag.get_text()
-
-            self.truestoryhttml.append(str(i_tag))
-        if Common.opf is not None and any(x in ("epub", "EPUB") for x in Common.opf):
-            for i_tag in self.epubrawstoryhtml:
-                for j in range(len(self.renames)):
-                    for l_tag in i_tag.find_all(
-                        "span", attrs={"class": "js-immersion-receiver-c" + str(j)}
-                    ):
-                        l_tag.string = self.renames[j]
-                self.epubtruestoryhttml.append(str(i_tag))
-
-        for i in range(len(self.truestoryhttml)):
-            self.truestoryhttml[i] = self.truestoryhttml[i].replace(
-                "\n  <span", "<span"
-            )
-            self.truestoryhttml[i] = self.truestoryhttml[i].replace("<span", " <span")
-            for j_name in self.renames:
-                self.truestoryhttml[i] = self.truestoryhttml[i].replace(
-                    "\n   " + j_name + "\n", j_name
-                )
-            self.truestoryhttml[i] = self.truestoryhttml[i].replace(
-                "  </span>\n  ", "</span> "
-            )
-
-        if Common.opf is not None and any(x in ("epub", "EPUB") for x in Common.opf):
-            for i in range(len(self.epubtruestoryhttml)):
-                self.epubtruestoryhttml[i] = self.epubtruestoryhttml[i].replace(
-                    "\n <span", "<span"
-                )
-                self.epubtruestoryhttml[i] = self.epubtruestoryhttml[i].replace(
-                    "<span", " <span"
-                )
-                for j_name in self.renames:
-                    self.epubtruestoryhttml[i] = self.epubtruestoryhttml[i].replace(
-                        "\n   " + j_name + "\n", j_name
-                    )
-                self.epubtruestoryhttml[i] = self.epubtruestoryhttml[i].replace(
-                    "  </span>\n  ", "</span> "
-                )
-
-        self.story = self.story.replace("\n", Common.lineEnding)
-
-        for i in range(0, len(self.truestoryhttml)):
-            self.rawstoryhtml[i] = BeautifulSoup(self.truestoryhttml[i], "html.parser")
-
-        if Common.opf is not None and any(x in ("epub", "EPUB") for x in Common.opf):
-            for i in range(0, len(self.epubtruestoryhttml)):
-                self.epubrawstoryhtml[i] = BeautifulSoup(
-                    self.epubtruestoryhttml[i], "html.parser"
-                )
 
         if (
             Common.images
@@ -503,6 +375,12 @@ class Chyoa:
             and Common.opf is not None
             and any(x in ("html", "HTML") for x in Common.opf)
         ):
+            paths = []
+            for i in range(0, len(Common.urlDict[self.url])):
+                Common.PrefetchImage(
+                    Common.urlDict[self.url][i],
+                    Common.ImagePath(self.title, i + 1, len(Common.urlDict[self.url])),
+                )
             for i in range(0, len(Common.urlDict[self.url])):
                 Common.prnt(
                     "Getting image "
@@ -511,7 +389,7 @@ class Chyoa:
                     + str(Common.urlDict[self.url][i])
                 )
                 try:
-                    Common.imageDL(
+                    path = Common.imageDL(
                         self.title,
                         Common.urlDict[self.url][i],
                         i + 1,
@@ -519,24 +397,64 @@ class Chyoa:
                     )
                 except Exception:
                     continue
+                if path is not None:
+                    self.staged.Record(Common.urlDict[self.url][i], path)
+                    paths.append(path)
+            ImageProcess.ProcessAll(paths)
+            urls = Common.urlDict[self.url]
+            Common.imageSources.Finish(
+                os.path.join(Common.wd, Common.sanitize_filename(self.title)),
+                (
+                    (Common.ImagePath(self.title, i + 1, len(urls)), urls[i])
+                    for i in range(0, len(urls))
+                ),
+            )
 
-    def AddPrevPage(self, url: str) -> Optional[str]:
-        page = self.requestPage(url)
-
-        if page is None:
-            print("Could not complete request for page: " + url)
-            return None
-
-        soup = BeautifulSoup(page.content, "html.parser")
+    def AddPrevPages(self, url: str) -> None:
+        """Walks Previous Chapter links back to the start of the story.
+
+        The next chapter is requested as soon as its link is found in the
+        raw page, so it downloads while the current one is parsed. The
+        link is checked against the parsed page and requested again in
+        the rare case the quick scan picked the wrong one.
+        """
+        chain = Chain(self)
+        with ThreadPoolExecutor(max_workers=1) as fetcher:
+            pending: Optional["Future[Optional[Any]]"] = fetcher.submit(
+                self.requestPage, url
+            )
+            while pending is not None:
+                page = pending.result()
+                if page is None:
+                    print("Could not complete request for page: " + url)
+                    break
+                guess = ScanPrevLink(page.content)
+                pending = None
+                if guess is not None:
+                    pending = fetcher.submit(self.requestPage, guess)
+                    # let the fetcher send its request before parsing takes the GIL
+                    time.sleep(0)
+                soup = BeautifulSoup(page.content, "html.parser")
+                prev = PrevLink(soup)
+                if prev != guess:
+                    pending = None
+                    if prev is not None:
+                        pending = fetcher.submit(self.requestPage, prev)
+                if prev is not None:
+                    url = prev
+                self.AddPrevPage(soup, chain, prev is None)
+        chain.Store(self)
+
+    def AddPrevPage(self, soup: BeautifulSoup, chain: "Chain", first: bool) -> None:
         meta_p = soup.find("p", class_="meta")
         if isinstance(meta_p, Tag):
             meta_a = meta_p.find("a")
             if isinstance(meta_a, Tag):
-                self.authors.insert(0, meta_a.get_text())
+                chain.authors.appendleft(meta_a.get_text())
 
         h1_tag = soup.find("h1")
         if isinstance(h1_tag, Tag):
-            self.chapters.insert(0, h1_tag.get_text())
+            chain.chapters.appendleft(h1_tag.get_text())
 
         if Common.images:
             content_div = soup.find("div", attrs={"class": "chapter-content"})
@@ -552,329 +470,862 @@ class Chyoa:
         temp = str(content_div) if isinstance(content_div, Tag) else ""
         q_header = soup.find("header", attrs={"class": "question-header"})
         if isinstance(q_header, Tag):
-            self.questions.insert(0, q_header.get_text())
-        temp += "<h2>" + (self.questions[0] if self.questions else "") + "</h2>"
-        self.temp.insert(0, temp)
+            chain.questions.appendleft(q_header.get_text())
+        temp += "<h2>" + (chain.questions[0] if chain.questions else "") + "</h2>"
+        epub = Common.opf is not None and any(x in ("epub", "EPUB") for x in Common.opf)
+        self.Render(
+            chain.chapters[0] if chain.chapters else "",
+            chain.authors[0] if chain.authors else "",
+            temp,
+            temp if epub else "",
+            True,
+        )
 
         if self.pbar:
             self.pbar.Update()
-        for i in soup.find_all("a"):
-            if i.text.strip() == "Previous Chapter":
-                href = i.get("href")
-                return href if isinstance(href, str) else None
         # gets author name if on last/first page I guess
-        if isinstance(meta_p, Tag):
+        if first and isinstance(meta_p, Tag):
             meta_a = meta_p.find("a")
             if isinstance(meta_a, Tag):
-                self.authors[0] = meta_a.get_text()
+                chain.authors[0] = meta_a.get_text()
+
+    def addPage(self, page: "Page", crawl: "Crawl") -> None:
+        """Renders a placed chapter with its links and appends it in reading order."""
+        temp = (
+            '<div id="'
+            + page.label
+            + '">'
+            + self.NumberImages(page, self.store.PageContent(page.key))
+            + "<h2>"
+            + page.question
+            + "</h2>\n</div>"
+            + "<br />"
+        )
+        epubtemp = temp
+        parent = page.parent
+        if parent is None or parent is crawl.start:
+            temp += '<a href="#Chapter 0">Previous Chapter</a>\n<br />'
+            epubtemp += '\n<a href="Chapter 1.xhtml">Previous Chapter</a>\n<br />'
+        else:
+            temp += '\n<a href="#' + parent.label + '">Previous Chapter</a>\n<br />'
+            epubtemp += (
+                '\n<a href="'
+                + crawl.EpubHref(parent.label)
+                + '">Previous Chapter</a>\n<br />'
+            )
+        dangling = len(crawl.unresolved)
+        for j in range(len(page.rawChoices)):
+            choice, epubChoice = self.Choice(crawl, page, j)
+            temp += choice
+            epubtemp += epubChoice
+
+        self.depth.append(page.label)
+        self.dangling.append(len(crawl.unresolved) - dangling)
+        self.authors.append(page.author)
+        self.chapters.append(page.chapter)
+        if page.hasimages:
+            self.hasimages = True
+        self.questions.append(page.question)
+        epub = Common.opf is not None and any(x in ("epub", "EPUB") for x in Common.opf)
+        self.Render(page.chapter, page.author, temp, epubtemp if epub else "")
+
+        self.pageIDs.append(self.pageIDIter)
+        self.pageIDIter += 1
+
+    def Choice(self, crawl: "Crawl", page: "Page", j: int) -> Tuple[str, str]:
+        """HTML and EPUB markup of page's j-th choice.
+
+        A choice leading to a chapter that was not downloaded, because the
+        crawl ran out of budget or the page failed, is marked instead of
+        linked.
+        """
+        choice = self.Rename(page.rawChoices[j]).strip()
+        target = crawl.Target(page, j)
+        if target is None:
+            mark = (
+                '\n<span class="dangling">'
+                + choice
+                + " (not downloaded)</span>\n<br />"
+            )
+            return mark, mark
+        return (
+            '\n<a href="' + target[0] + '">' + choice + "</a>\n<br />",
+            '\n<a href="' + target[1] + '">' + choice + "</a>\n<br />",
+        )
+
+    def NumberImages(self, page: "Page", content: str) -> str:
+        """page's content with its images pointed at the story's next img<N>.jpg files.
+
+        Runs as chapters are placed, so numbers follow reading order whatever
+        order the pages were fetched in.
+        """
+        if not (Common.images and page.hasimages):
+            return content
+        content_div = BeautifulSoup(content, "html.parser")
+        with lock2:
+            for simg in content_div.find_all("img"):
+                imgtemp = simg.get("src")
+                if isinstance(imgtemp, str):
+                    simg["src"] = (
+                        "img" + str(len(Common.urlDict[self.ogUrl]) + 1) + ".jpg"
+                    )
+                    Common.urlDict[self.ogUrl][len(Common.urlDict[self.ogUrl])] = imgtemp
+        return str(content_div)
+
+    def Rename(self, text: str) -> str:
+        """Band aid fix for replaceable text in chapter titles and choices."""
+        for j in range(len(self.renames)):
+            text = text.replace(self.oldnames[j], self.renames[j])
+        return text
+
+    def Render(
+        self, title: str, author: str, temp: str, epubtemp: str, first: bool = False
+    ) -> None:
+        """Renders a chapter into the store, ahead of the others if first."""
+        html, epub, text = RenderEntry(
+            self.Rename(title), author, temp, epubtemp, self.renames
+        )
+        if first:
+            self.store.Prepend(html, epub, text)
+        else:
+            self.store.Append(html, epub, text)
+
+
+def ScanPrevLink(content: bytes) -> Optional[str]:
+    """Finds the Previous Chapter link without parsing the whole page."""
+    match = prevLinkPattern.search(content)
+    if match is None:
         return None
+    return html.unescape(match.group(1).decode("utf-8", "replace"))
+
+
+def RenderEntry(
+    title: str, author: str, temp: str, epubtemp: str, renames: List[str]
+) -> Tuple[str, str, str]:
+    """A rendered chapter as the store keeps it: its HTML, EPUB and text.
+
+    The chapter is parsed once per output; the EPUB is left empty when
+    epubtemp is, as no EPUB is written.
+    """
+    header = "\n<h4>by " + author + "</h4>"
+    soup, text = RenderChapter(header + temp, renames, "  ")
+    epub = ""
+    if epubtemp:
+        epubSoup, _ = RenderChapter(header + epubtemp, renames, " ")
+        epub = str(epubSoup)
+    return str(soup), epub, (title + text).replace("\n", Common.lineEnding)
+
+
+def RenderChapter(
+    chapter: str, renames: List[str], indent: str
+) -> Tuple[BeautifulSoup, str]:
+    """Parses a rendered chapter and fills in its immersion names.
+
+    Returns the tree and its text. The text keeps the page's whitespace; the
+    tree has the whitespace around spans tidied as if its HTML had gone
+    through str.replace("\\n" + indent + "<span", "<span"), then "<span" to
+    " <span", "\\n   NAME\\n" to NAME and "  </span>\\n  " to "</span> "
+    and been parsed again, without serialising and parsing it twice.
+    """
+    soup = BeautifulSoup(chapter, "html.parser")
+    spans = soup.find_all("span")
+    if renames and spans:
+        for span in spans:
+            classes = span.get_attribute_list("class")
+            for j in range(len(renames)):
+                if "js-immersion-receiver-c" + str(j) in classes:
+                    span.string = renames[j]
+        # names replace whole subtrees, so spans inside them are gone
+        spans = soup.find_all("span")
+    text = soup.get_text()
+
+    edited: List[NavigableString] = []
+
+    def Edit(string: NavigableString, value: str) -> None:
+        edited.append(type(string)(value))
+        string.replace_with(edited[-1])
+
+    for span in spans:
+        prev = span.previous_sibling
+        if type(prev) is NavigableString and prev.endswith("\n" + indent):
+            Edit(prev, prev[: -len(indent) - 1])
+    for span in spans:
+        prev = span.previous_sibling
+        if type(prev) is NavigableString:
+            Edit(prev, prev + " ")
+        else:
+            span.insert_before(" ")
+    if renames:
+        for string in soup.find_all(string=True):
+            fixed: str = string
+            for name in renames:
+                fixed = fixed.replace("\n   " + name + "\n", name)
+            if fixed != string:
+                Edit(string, fixed)
+    # innermost first, like a left to right scan meets the closing tags
+    for span in reversed(spans):
+        last = span.contents[-1] if span.contents else None
+        after = span.next_sibling
+        if (
+            type(last) is NavigableString
+            and last.endswith("  ")
+            and type(after) is NavigableString
+            and after.startswith("\n  ")
+        ):
+            Edit(last, last[:-2])
+            Edit(after, " " + after[3:])
+    # parsing collapses whitespace-only strings, outside <pre> at least
+    for string in edited:
+        if (
+            string.parent is not None
+            and type(string) is NavigableString
+            and not string.strip(" \n\t\f\r")
+            and string
+            and string.find_parent(["pre", "textarea"]) is None
+        ):
+            string.replace_with("\n" if "\n" in string else " ")
+    return soup, text
 
-    # def AddNextPage(self, (url, depth, prevChapNum, prevLink, epubPrevLink, currLink, prevLinkId)):
-    def AddNextPage(self, args: Any) -> None:
-        url = args[0]
-        depth = args[1]
-        prevChapNum = args[2]
-        prevLink = args[3]
-        epubPrevLink = args[4]
-        currLink = args[5]
-        prevLinkId = args[6]
 
-        page = self.requestPage(url)
+def PrevLink(soup: BeautifulSoup) -> Optional[str]:
+    """The Previous Chapter link of a chapter, or None on the first one."""
+    for i in soup.find_all("a"):
+        if i.text.strip() == "Previous Chapter":
+            href = i.get("href")
+            return href if isinstance(href, str) else None
+    return None
 
-        if page is None:
-            print("Could not complete request for page: " + url)
-            return
 
-        soup = BeautifulSoup(page.content, "html.parser")
+class Chain:
+    """Chapters met walking backwards, prepended in constant time.
 
-        try:
-            meta_p = soup.find("p", class_="meta")
-            if isinstance(meta_p, Tag):
-                meta_a = meta_p.find("a")
-                if isinstance(meta_a, Tag):
-                    self.authors.append(meta_a.get_text())
-                else:
-                    self.authors.append("Unknown")
-            else:
-                self.authors.append("Unknown")
-        except AttributeError:
-            self.authors.append("Unknown")
+    Seeded with (and stored back into) the Chyoa lists of the same names.
+    """
 
-        h1_tag = soup.find("h1")
-        if isinstance(h1_tag, Tag):
-            self.chapters.append(h1_tag.get_text())
-
-        epubCurrLink = (
-            '\n<a href="'
-            + str(depth)
-            + '.xhtml">'
-            + "Previous Chapter"
-            + "</a>\n<br />"
-        )
+    authors: Deque[str]
+    chapters: Deque[str]
+    questions: Deque[str]
 
-        if Common.images:
-            content_div = soup.find("div", attrs={"class": "chapter-content"})
-            if isinstance(content_div, Tag) and content_div.find("img"):
-                for simg in content_div.find_all("img"):
-                    imgtemp = simg.get("src")
-                    if isinstance(imgtemp, str):
-                        simg["src"] = (
-                            "img" + str(len(Common.urlDict[self.ogUrl]) + 1) + ".jpg"
-                        )
-                        Common.urlDict[self.ogUrl][
-                            len(Common.urlDict[self.ogUrl])
-                        ] = imgtemp
-                        self.hasimages = True
+    def __init__(self, site: Chyoa) -> None:
+        self.authors = deque(site.authors)
+        self.chapters = deque(site.chapters)
+        self.questions = deque(site.questions)
 
-        content_div = soup.find("div", attrs={"class": "chapter-content"})
-        self.depth.append(str(depth))
-        temp = '<div id="' + str(depth) + '">' + str(content_div)
+    def Store(self, site: Chyoa) -> None:
+        site.authors = list(self.authors)
+        site.chapters = list(self.chapters)
+        site.questions = list(self.questions)
 
-        try:
-            q_header = soup.find("header", attrs={"class": "question-header"})
-            if isinstance(q_header, Tag):
-                self.questions.append(q_header.get_text())
-            else:
-                self.questions.append("What's next?")
-        except AttributeError:
-            self.questions.append("What's next?")
-
-        temp += "<h2>" + self.questions[-1] + "</h2>\n</div>"
-        if self.partial:
-            Common.prnt(str(depth))
-        j = 1
-
-        nextpages = []
-        epubnextpages = []
-        nextpagesurl = []
-        nextpagesdepth = []
-        temp += "<br />"
-        epubtemp = temp
-        q_content = soup.find("div", attrs={"class": "question-content"})
-        if isinstance(q_content, Tag):
-            for i in q_content.find_all("a"):
-                if i.get_text().strip() != "Add a new chapter":
-                    link = i.get_text()
-                    # Band aid fix for replaceable text in the next chapter links
-                    for i_rename in range(len(self.renames)):
-                        link = link.replace(self.oldnames[i_rename], self.renames[i_rename])
-                    nextLink = (
-                        '\n<a href="#'
-                        + str(depth)
-                        + "."
-                        + str(j)
-                        + '">'
-                        + "Previous Chapter"
-                        + "</a>\n<br />"
-                    )
-                    # nextLinks.append(nextLink)
-
-                    if Common.opf is not None and any(
-                        x in ("epub", "EPUB") for x in Common.opf
-                    ):
-                        epubnextpages.append(
-                            '\n<a href="'
-                            + str(depth)
-                            + "."
-                            + str(j)
-                            + '.xhtml">'
-                            + link.strip()
-                            + "</a>\n<br />"
-                        )
-                    nextpages.append(
-                        '\n<a href="#'
-                        + str(depth)
-                        + "."
-                        + str(j)
-                        + '">'
-                        + link.strip()
-                        + "</a>\n<br />"
-                    )
-                    # nextpages.append(prevLink)
-                    nextpagesurl.append(i)
-                    nextpagesdepth.append(j)
-                    j += 1
-        temp += prevLink
-        if Common.opf is not None and any(x in ("epub", "EPUB") for x in Common.opf):
-            epubtemp += epubPrevLink
-            for j_str in epubnextpages:
-                epubtemp += j_str
-            self.epubtemp.append(epubtemp)
-
-        for j_str in nextpages:
-            temp += j_str
-        self.temp.append(temp)
-        if self.pbar:
-            self.pbar.Update()
-        # Checks if new page was a link backwards and exits if so
-        chapNum = 0
-        meta_p = soup.find("p", attrs={"class": "meta"})
-        if isinstance(meta_p, Tag):
-            meta_text = meta_p.get_text().split()
-            if len(meta_text) > 1:
-                chapNum = int(meta_text[1])
 
-        self.pageIDs.append(self.pageIDIter)
-        self.pageIDDict[depth] = self.pageIDIter
-        self.pageIDIter += 1
+class StoryGraph:
+    """Every chapter of a story as last crawled, saved next to the output.
+
+    A SQLite file mapping chapter keys to Page.Record() dicts: URL, depth,
+    choices and links, the hash and validators of the page and its parsed
+    text. An update run sends these validators and rebuilds unchanged
+    chapters from here, so only new or edited chapters are downloaded in
+    full and parsed. A record is only read once the crawl reaches its
+    chapter, so the story is never held in memory whole.
+    """
+
+    path: str
+    db: Optional[sqlite3.Connection]
+    lock: threading.Lock
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.db = None
+        self.lock = threading.Lock()
+        self.Open()
 
-        if prevChapNum >= chapNum:
+    def Open(self) -> None:
+        if not os.path.isfile(self.path):
             return
+        try:
+            # read by every crawl worker
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("SELECT key, record, content FROM chapters LIMIT 1")
+        except sqlite3.Error as e:
+            print("Could not read story graph " + self.path + ": " + str(e))
+            return
+        self.db = db
 
-        # Other check if current page is a link and doesn't continue if so
-        prevLinkCheck1 = soup.find("span", attrs={"class": "controls-left"})
-        if isinstance(prevLinkCheck1, Tag):
-            a_tags = prevLinkCheck1.find_all("a")
-            if a_tags:
-                prevLinkCheck2 = a_tags[0].get("href")
-                if isinstance(prevLinkCheck2, str):
-                    prevLinkId1 = urllib.parse.urlparse(prevLinkCheck2)[2].split(".")[
-                        -1
-                    ]
+    def __len__(self) -> int:
+        if self.db is None:
+            return 0
+        with self.lock:
+            return int(self.db.execute("SELECT COUNT(*) FROM chapters").fetchone()[0])
 
-                    currLinkId = urllib.parse.urlparse(url)[2].split(".")[-1]
-                    if prevLinkId is not None and prevLinkId1 != prevLinkId:
-                        return
-
-        n2 = []
-        for i_tag, j_int in zip(nextpagesurl, nextpagesdepth, strict=False):
-            href = i_tag.get("href")
-            if isinstance(href, str):
-                n2.append(
-                    [
-                        href,
-                        str(depth) + "." + str(j_int),
-                        chapNum,
-                        currLink,
-                        epubCurrLink,
-                        nextLink,
-                        currLinkId,
-                    ]
+    def Chapter(self, key: str) -> Optional[Dict[str, Any]]:
+        """The record of the chapter with key, with its content, if it was saved."""
+        if self.db is None:
+            return None
+        with self.lock:
+            row = self.db.execute(
+                "SELECT record, content FROM chapters WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        record: Dict[str, Any] = json.loads(row[0])
+        record["content"] = row[1]
+        return record
+
+    def Save(self, url: str, crawl: "Crawl", pages: List["Page"]) -> None:
+        """Writes the graph one chapter at a time, reading contents back from the store."""
+        self.Write(
+            url,
+            (
+                (
+                    page.key,
+                    page.Record(crawl.Links(page)),
+                    crawl.store.PageContent(page.key),
                 )
-        self.pageQueue[0:0] = n2
+                for page in pages
+            ),
+        )
 
-    def ThreadAdd(
-        self,
-        url: str,
-        depth: str,
-        renames: List[str],
-        oldnames: List[str],
-        chapNum: int,
-        currLink: str,
-        epubCurrLink: str,
-        nextLink: str,
-        currLinkId: str,
-        ogUrl: str,
+    def Write(
+        self, url: str, chapters: Iterable[Tuple[str, Dict[str, Any], str]]
     ) -> None:
+        """Replaces the graph with (key, record, content) chapters."""
+        tmp = self.path + ".tmp"
         try:
-            idx = self.Pages.index(url)
-            self.Pages[idx] = Page(
-                url,
-                depth,
-                renames,
-                oldnames,
-                self.q,
-                chapNum,
-                currLink,
-                epubCurrLink,
-                nextLink,
-                currLinkId,
-                ogUrl,
-            )
-        except ValueError:
-            pass
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            db = sqlite3.connect(tmp, isolation_level=None)
+            try:
+                db.execute("PRAGMA journal_mode=OFF")
+                db.execute("PRAGMA synchronous=OFF")
+                db.execute("CREATE TABLE story (url TEXT)")
+                db.execute(
+                    "CREATE TABLE chapters (key TEXT PRIMARY KEY, record TEXT,"
+                    " content TEXT)"
+                )
+                db.execute("INSERT INTO story VALUES (?)", (url,))
+                db.execute("BEGIN")
+                for key, record, content in chapters:
+                    db.execute(
+                        "INSERT OR REPLACE INTO chapters VALUES (?, ?, ?)",
+                        (key, json.dumps(record), content),
+                    )
+                db.execute("COMMIT")
+            finally:
+                db.close()
+            self.Close()
+            os.replace(tmp, self.path)
+        except (OSError, sqlite3.Error) as e:
+            print("Could not save story graph " + self.path + ": " + str(e))
+        self.Open()
+
+    def Close(self) -> None:
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+def ChapterKey(url: str) -> str:
+    """Identifies a chapter (or story intro) by its ID, whatever slug its URL has."""
+    path = urllib.parse.urlparse(url)[2]
+    return path.split("/")[1 if path.startswith("/") else 0] + ":" + path.split(".")[-1]
+
+
+class Crawl:
+    """Forward crawl run by a fixed pool of workers sharing one frontier.
+
+    Fetching a page queues its children on the frontier instead of starting
+    a thread per link, so threads and requests in flight never exceed
+    workers however wide the story tree is. Every chapter is fetched once:
+    nodes holds every chapter met and visited maps chapter keys to their
+    index there, so a chapter reached again through another branch is
+    linked to rather than downloaded and rendered a second time. A page's
+    choices are kept as an array of those indices. Fetched contents wait
+    in store until the chapters are rendered.
+
+    The frontier is a heap ordered by level below the start page, so pages
+    are fetched breadth first. When a budget (see maxDepth and the others)
+    runs out, no more pages are taken from it and the book holds the top
+    levels of the story in full.
+
+    With a transport that fetches ahead (the async engine), pages are
+    prefetched as they are queued and the workers only wait to parse them.
+    """
+
+    workers: int
+    store: ChapterStore.ChapterStore
+    pbar: Optional["Progress"]
+    start: "Page"
+    nodes: List["Page"]
+    visited: Dict[str, int]
+    frontier: List[Tuple[int, int, "Page"]]
+    announcing: Set[str]
+    queued: int
+    cond: threading.Condition
+    active: int
+    pages: int
+    bytes: int
+    maxDepth: int
+    maxPages: int
+    maxTime: float
+    maxBytes: int
+    deadline: float
+    stopped: str
+    longest: int
+    busy: float
+    known: Optional[StoryGraph]
+    unchanged: int
+    ids: Dict[str, int]
+    unresolved: List[str]
 
-    def addPage(self, page: Any) -> None:
-        self.depth.append(page.depth)
-        self.authors.append(page.author)
-        self.chapters.append(page.chapter)
-        self.images.extend(page.images)
-        if page.hasimages:
-            self.hasimages = True
-        self.questions.extend(page.questions)
-        self.epubtemp.extend(page.epubtemp)
-        self.temp.extend(page.temp)
+    def __init__(
+        self,
+        workers: int,
+        store: ChapterStore.ChapterStore,
+        pbar: Optional["Progress"] = None,
+        known: Optional[StoryGraph] = None,
+    ) -> None:
+        self.workers = max(1, workers)
+        self.store = store
+        self.pbar = pbar
+        self.known = known
+        self.unchanged = 0
+        self.ids = {}
+        self.unresolved = []
+        self.nodes = []
+        self.visited = {}
+        self.frontier = []
+        self.announcing = set()
+        self.queued = 0
+        self.cond = threading.Condition()
+        self.active = 0
+        self.pages = 0
+        self.bytes = 0
+        self.maxDepth = maxDepth
+        self.maxPages = maxPages
+        self.maxTime = maxTime
+        self.maxBytes = maxBytes
+        self.deadline = 0.0
+        self.stopped = ""
+        self.longest = 0
+        self.busy = 0.0
+
+    def Run(self, start: "Page") -> None:
+        """Fetches everything below the already fetched start page."""
+        begin = time.monotonic()
+        self.deadline = begin + self.maxTime
+        self.start = start
+        with self.cond:
+            self.visited[start.key] = len(self.nodes)
+            self.nodes.append(start)
+            start.queued = True
+            self.Resolve(start)
+            ahead = self.Expand(start, None)
+        self.Prefetch(ahead)
+        if self.workers == 1:
+            self.Work()
+        else:
+            threads = [
+                threading.Thread(target=self.Work, daemon=True)
+                for _ in range(self.workers)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        # left behind by a budget
+        Common.transport.Cancel(page.url for _, _, page in self.frontier)
+        self.Report(time.monotonic() - begin)
+
+    def Work(self) -> None:
+        """Crawls pages off the frontier until it is empty and none is in flight.
+
+        The crawl is over as soon as the last page in flight is done. A page
+        that fails in any way is dropped but still counted as done, so no
+        worker is left waiting on it.
+        """
+        while True:
+            with self.cond:
+                while not self.frontier and self.active:
+                    self.cond.wait()
+                if not self.frontier or self.Exhausted():
+                    return
+                page = heapq.heappop(self.frontier)[2]
+                # fetched here now, so no longer worth announcing
+                self.announcing.discard(page.key)
+                self.active += 1
+            begin = time.monotonic()
+            size = 0
+            try:
+                size = page.AddNextPage(
+                    self.known.Chapter(page.key) if self.known is not None else None
+                )
+                if page.fetched:
+                    # only rendered once the whole tree is known, so wait on disk
+                    self.store.SavePage(page.key, page.content)
+                    page.content = ""
+            except Exception as e:
+                page.fetched = False
+                print("Could not add page " + page.url + ": " + str(e))
+            ahead: List["Page"] = []
+            with self.cond:
+                if page.restored:
+                    self.unchanged += 1
+                try:
+                    if page.fetched:
+                        self.Resolve(page)
+                        for parent in page.parents or ():
+                            if self.Follows(parent, page):
+                                ahead = self.Expand(page, parent)
+                                break
+                except Exception as e:
+                    page.fetched = False
+                    print("Could not crawl the choices of " + page.url + ": " + str(e))
+                # only needed to find the chapter page continues from
+                page.parents = None
+                self.active -= 1
+                self.pages += 1
+                self.bytes += size
+                self.busy += time.monotonic() - begin
+                self.cond.notify_all()
+            self.Prefetch(ahead)
+            if self.pbar:
+                self.pbar.Update()
+
+    def Ahead(self) -> bool:
+        """Whether the page just queued is worth fetching ahead. Called with cond held.
+
+        Pages beyond the page budget are left to the workers.
+        """
+        if not Common.transport.prefetches:
+            return False
+        return not (self.maxPages and 1 + self.queued > self.maxPages)
+
+    def Prefetch(self, pages: List["Page"]) -> None:
+        """Has the transport fetch queued pages ahead of the workers.
+
+        Called without cond held, as each page's story graph record is read
+        first. A page a worker took in the meantime is not announced.
+        """
+        for page in pages:
+            known = self.known.Chapter(page.key) if self.known is not None else None
+            headers = page.Headers(known)
+            with self.cond:
+                if page.key not in self.announcing:
+                    continue
+                self.announcing.discard(page.key)
+                Common.transport.Prefetch([page.url], headers)
+
+    def Exhausted(self) -> bool:
+        """Whether a budget has run out, noting which. Called with cond held.
+
+        Pages already in flight are still finished.
+        """
+        if self.stopped:
+            return True
+        # the start page is a chapter of the book too
+        if self.maxPages and 1 + self.pages + self.active >= self.maxPages:
+            self.stopped = "page"
+        elif self.maxBytes and self.bytes >= self.maxBytes:
+            self.stopped = "byte"
+        elif self.maxTime and time.monotonic() >= self.deadline:
+            self.stopped = "time"
+        return bool(self.stopped)
+
+    def Follows(self, parent: "Page", page: "Page") -> bool:
+        """Whether page really continues from parent, so its own choices are crawled.
+
+        Choices leading back to an earlier chapter, or across to a chapter
+        that belongs to another branch, are linked but not followed.
+        """
+        if page.chapNum <= parent.chapNum:
+            return False
+        return (
+            parent is self.start
+            or page.prevId is None
+            or page.prevId == parent.key.rpartition(":")[2]
+        )
 
-        self.pageIDs.append(self.pageIDIter)
-        self.pageIDDict[page.depth] = self.pageIDIter
-        self.pageIDIter += 1
+    def Resolve(self, page: "Page") -> None:
+        """Turns page's links into node indices, adding nodes for chapters met first.
+
+        Called with cond held. The new nodes are only queued once a page
+        that is crawled further leads to them.
+        """
+        targets = array("i")
+        for link in page.links or ():
+            if not link:
+                targets.append(-1)
+                continue
+            num = self.visited.get(ChapterKey(link))
+            if num is None:
+                child = Page(link)
+                num = len(self.nodes)
+                # keyed by the page's own key string rather than a second copy
+                self.visited[child.key] = num
+                self.nodes.append(child)
+            targets.append(num)
+        page.targets = targets
+        page.links = None
+
+    def Expand(self, page: "Page", parent: Optional["Page"]) -> List["Page"]:
+        """Queues the chapters page's choices lead to. Called with cond held.
+
+        Chapters deeper than maxDepth are left out. Returns the pages to
+        fetch ahead, for Prefetch once cond is released.
+        """
+        ahead = []
+        page.parent = parent
+        page.level = parent.level + 1 if parent is not None else 0
+        page.expanded = True
+        stack = [page]
+        while stack:
+            node = stack.pop()
+            if self.maxDepth and node.level >= self.maxDepth:
+                continue
+            for num in node.targets:
+                if num < 0:
+                    continue
+                child = self.nodes[num]
+                if not child.queued:
+                    child.queued = True
+                    child.level = node.level + 1
+                    self.queued += 1
+                    heapq.heappush(self.frontier, (child.level, self.queued, child))
+                    if self.Ahead():
+                        self.announcing.add(child.key)
+                        ahead.append(child)
+                elif child.fetched and not child.expanded and self.Follows(node, child):
+                    # fetched through another branch before its own parent
+                    child.parent = node
+                    child.level = node.level + 1
+                    child.expanded = True
+                    stack.append(child)
+                if child.parents is not None:
+                    child.parents.append(node)
+        self.longest = max(self.longest, len(self.frontier))
+        return ahead
+
+    def Place(self) -> List["Page"]:
+        """Labels every fetched chapter with its depth and lists them in reading order.
+
+        A chapter sits under the parent it continues from, or where it is
+        first reached if that parent was not crawled; any other choice
+        leading to it links to that spot. ids maps each label to the
+        chapter's position, which names its EPUB file.
+        """
+        order: List["Page"] = []
+        stack: List[Tuple["Page", int]] = [(self.start, 0)]
+        while stack:
+            node, j = stack.pop()
+            if j >= len(node.targets):
+                continue
+            stack.append((node, j + 1))
+            if node.targets[j] < 0:
+                continue
+            child = self.nodes[node.targets[j]]
+            if child is self.start or child.label or not child.fetched:
+                continue
+            if child.expanded and child.parent is not node:
+                continue
+            child.parent = node
+            child.label = self.Label(node, j)
+            self.ids[child.label] = len(order)
+            order.append(child)
+            if child.expanded:
+                stack.append((child, 0))
+        return order
+
+    def Label(self, page: "Page", j: int) -> str:
+        """Depth label of page's j-th choice, like 1.2.3."""
+        if page is self.start:
+            return str(j + 1)
+        return page.label + "." + str(j + 1)
+
+    def Target(self, page: "Page", j: int) -> Optional[Tuple[str, str]]:
+        """HTML and EPUB hrefs for page's j-th choice.
+
+        None if the chapter it leads to was not downloaded, whose label is
+        noted in unresolved.
+        """
+        child = self.nodes[page.targets[j]] if page.targets[j] >= 0 else None
+        if child is self.start:
+            return "#Chapter 0", "Chapter 1.xhtml"
+        if child is None or not child.label:
+            self.unresolved.append(self.Label(page, j))
+            return None
+        return "#" + child.label, self.EpubHref(child.label)
+
+    def EpubHref(self, label: str) -> str:
+        """EPUB file of the chapter placed at label."""
+        return "nfChapter" + str(self.ids[label]) + ".xhtml"
+
+    def Links(self, page: "Page") -> List[str]:
+        """The URLs page's choices lead to, "" where a choice has none."""
+        return [self.nodes[num].url if num >= 0 else "" for num in page.targets]
+
+    def ReportUnresolved(self) -> None:
+        if self.unresolved:
+            Common.prnt(
+                str(len(self.unresolved))
+                + " choices lead to chapters that were not downloaded: "
+                + ", ".join(self.unresolved[:10])
+                + (", ..." if len(self.unresolved) > 10 else "")
+            )
 
-        if page.children != []:
-            for zzz in range(0, len(page.children)):
-                while isinstance(page.children[zzz], str):
-                    self.q.get()
-            # prepend child pages to the queue
-            self.pageQueue[0:0] = page.children
+    def Report(self, seconds: float) -> None:
+        seconds = max(seconds, 1e-9)
+        Common.prnt(
+            "Crawled "
+            + str(self.pages)
+            + " pages in "
+            + "%.1f" % seconds
+            + "s ("
+            + "%.1f" % (self.pages / seconds)
+            + " pages/s), frontier peaked at "
+            + str(self.longest)
+            + ", "
+            + str(self.workers)
+            + " workers "
+            + "%.0f" % (100 * self.busy / (self.workers * seconds))
+            + "% busy"
+        )
+        if self.stopped:
+            Common.prnt(
+                "Stopped at the "
+                + self.stopped
+                + " budget with "
+                + str(len(self.frontier))
+                + " chapters left to download",
+                f=True,
+            )
+        if self.known:
+            Common.prnt(
+                str(self.unchanged)
+                + " of "
+                + str(self.pages)
+                + " pages unchanged since the last update"
+            )
 
 
 class Page:
-    visitedPages: Dict[str, "Page"] = {}
-    children: List[Any]
-    depth: str
+    """A chapter of the crawl tree.
+
+    There is one per chapter met, so the node is kept small: slots, the
+    choices' links only until the crawl resolves them into targets, and
+    parents only until the page has been crawled.
+    """
+
+    __slots__ = (
+        "url",
+        "key",
+        "prevId",
+        "chapNum",
+        "author",
+        "chapter",
+        "question",
+        "content",
+        "hasimages",
+        "rawChoices",
+        "links",
+        "targets",
+        "hash",
+        "etag",
+        "modified",
+        "restored",
+        "parents",
+        "parent",
+        "level",
+        "label",
+        "queued",
+        "fetched",
+        "expanded",
+    )
+
+    url: str
+    key: str
+    prevId: Optional[str]
+    chapNum: int
     author: str
     chapter: str
-    images: List[str]
+    question: str
+    content: str
     hasimages: bool
-    questions: List[str]
-    epubtemp: List[str]
-    temp: List[str]
-    renames: List[str]
-    oldnames: List[str]
-    q: queue.Queue[Any]
-    chapNum: int
-    prevChapNum: int
-    prevLink: str
-    currLink: str
-    epubPrevLink: str
-    prevLinkId: Optional[str]
-    ogUrl: str
+    rawChoices: List[str]
+    links: Optional[List[str]]
+    targets: "array[int]"
+    hash: bytes
+    etag: str
+    modified: str
+    restored: bool
+    parents: Optional[List["Page"]]
+    parent: Optional["Page"]
+    level: int
+    label: str
+    queued: bool
+    fetched: bool
+    expanded: bool
 
-    def __init__(
-        self,
-        url: str,
-        depth: Any,
-        renames: List[str],
-        oldnames: List[str],
-        q: queue.Queue[Any],
-        prevChapNum: int,
-        prevLink: str,
-        epubPrevLink: str,
-        currLink: str,
-        prevLinkId: Optional[str],
-        ogUrl: str,
-    ) -> None:
-        self.children = []
-        self.depth = str(depth)
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.key = ChapterKey(url)
+        self.prevId = None
+        self.chapNum = 0
         self.author = ""
         self.chapter = ""
-        self.images = []
+        self.question = ""
+        self.content = ""
         self.hasimages = False
-        self.questions = []
-        self.epubtemp = []
-        self.temp = []
-        self.renames = renames
-        self.oldnames = oldnames
-        self.q = q
-        self.chapNum = 0
-        self.prevChapNum = prevChapNum
-        self.prevLink = prevLink
-        self.currLink = currLink
-        self.epubPrevLink = epubPrevLink
-        self.prevLinkId = prevLinkId
-
-        self.ogUrl = ogUrl
-
-        self.AddNextPage(url, depth)
-        self.q.put(self, False)
-
-    def AddNextPage(self, url: str, depth: Any) -> None:
-        page = Common.RequestPageChyoa(
-            url, headers={"User-Agent": "Mozilla/5.0 (Windows NT 6.1; Win64; x64)"}
-        )
+        self.rawChoices = []
+        self.links = []
+        self.targets = noTargets
+        self.hash = b""
+        self.etag = ""
+        self.modified = ""
+        self.restored = False
+        self.parents = []
+        self.parent = None
+        self.level = 0
+        self.label = ""
+        self.queued = False
+        self.fetched = False
+        self.expanded = False
+
+    def Headers(self, known: Optional[Dict[str, Any]] = None) -> Dict[str, str]:
+        """Request headers for this chapter, conditional on its known record."""
+        headers = {"User-Agent": "Mozilla/5.0 (Windows NT 6.1; Win64; x64)"}
+        if known is not None:
+            if "etag" in known:
+                headers["If-None-Match"] = known["etag"]
+            if "modified" in known:
+                headers["If-Modified-Since"] = known["modified"]
+        return headers
+
+    def AddNextPage(self, known: Optional[Dict[str, Any]] = None) -> int:
+        """Fetches and parses this chapter; its choices are crawled by the caller.
+
+        known is the chapter as recorded by the last update run. It is sent
+        conditionally and restored from the record rather than parsed if the
+        server reports it unchanged or returns the same page. Returns the
+        bytes downloaded.
+        """
+        url = self.url
+        page = Common.RequestPageChyoa(url, headers=self.Headers(known))
 
         if page is None:
             print("Could not complete request for page: " + url)
-            return
+            if known is not None:
+                self.Restore(known)
+            return 0
+
+        if known is not None and page.status_code == 304:
+            self.Restore(known)
+            return 0
+        self.hash = hashlib.sha256(page.content).digest()
+        if known is not None and self.hash.hex() == known.get("hash"):
+            self.Restore(known)
+            return len(page.content)
+        self.etag = page.headers.get("ETag") or ""
+        self.modified = page.headers.get("Last-Modified") or ""
 
         soup = BeautifulSoup(page.content, "html.parser")
 
@@ -883,7 +1334,8 @@ class Page:
             if isinstance(meta_p, Tag):
                 meta_a = meta_p.find("a")
                 if isinstance(meta_a, Tag):
-                    self.author = meta_a.get_text()
+                    # shared by every chapter the author wrote
+                    self.author = sys.intern(meta_a.get_text())
                 else:
                     self.author = "Unknown"
             else:
@@ -895,182 +1347,96 @@ class Page:
         if isinstance(h1_tag, Tag):
             self.chapter = h1_tag.get_text()
 
-        if Common.images:
-            content_div = soup.find("div", attrs={"class": "chapter-content"})
-            if isinstance(content_div, Tag) and content_div.find("img"):
-                with lock2:
-                    for simg in content_div.find_all("img"):
-                        imgtemp = simg.get("src")
-                        if isinstance(imgtemp, str):
-                            simg["src"] = (
-                                "img" + str(len(Common.urlDict[self.ogUrl]) + 1) + ".jpg"
-                            )
-                            Common.urlDict[self.ogUrl][
-                                len(Common.urlDict[self.ogUrl])
-                            ] = imgtemp
-                self.hasimages = True
-
+        # images are numbered once the chapter is placed, see NumberImages
         content_div = soup.find("div", attrs={"class": "chapter-content"})
-        Common.prnt(str(depth))
-        temp = '<div id="' + str(depth) + '">' + str(content_div)
+        if Common.images and isinstance(content_div, Tag) and content_div.find("img"):
+            self.hasimages = True
+        Common.prnt(url)
+        self.content = str(content_div)
 
         try:
             q_header = soup.find("header", attrs={"class": "question-header"})
             if isinstance(q_header, Tag):
-                self.questions.append(q_header.get_text())
+                self.question = sys.intern(q_header.get_text())
             else:
-                self.questions.append("What's next?")
+                self.question = "What's next?"
         except AttributeError:
-            self.questions.append("What's next?")
-
-        temp += "<h2>" + self.questions[-1] + "</h2>\n</div>"
-        j = 1
-
-        nextpages = []
-        epubnextpages = []
-        nextpagesurl = []
-        nextpagesdepth = []
-        urls = []
-        temp += "<br />"
-        epubtemp = temp
-        nextLinks: List[str] = []
-        epubCurrLink = (
-            '\n<a href="'
-            + str(depth)
-            + '.xhtml">'
-            + "Previous Chapter"
-            + "</a>\n<br />"
-        )
-
-        temp += self.prevLink
+            self.question = "What's next?"
 
         q_content = soup.find("div", attrs={"class": "question-content"})
         if isinstance(q_content, Tag):
-            for i in q_content.find_all("a"):
-                if i.get_text().strip() != "Add a new chapter":
-                    link = i.get_text()
-                    # Band aid fix for replaceable text in the next chapter links
-                    for i_rename in range(len(self.renames)):
-                        link = link.replace(self.oldnames[i_rename], self.renames[i_rename])
-
-                    if Common.opf is not None and any(
-                        x in ("epub", "EPUB") for x in Common.opf
-                    ):
-                        epubnextpages.append(
-                            '\n<a href="'
-                            + str(depth)
-                            + "."
-                            + str(j)
-                            + '.xhtml">'
-                            + link.strip()
-                            + "</a>\n<br />"
-                        )
-                    nextLink = (
-                        '\n<a href="#'
-                        + str(depth)
-                        + "."
-                        + str(j)
-                        + '">'
-                        + "Previous Chapter"
-                        + "</a>\n<br />"
-                    )
-                    nextLinks.append(nextLink)
-                    nextpages.append(
-                        '\n<a href="#'
-                        + str(depth)
-                        + "."
-                        + str(j)
-                        + '">'
-                        + link.strip()
-                        + "</a>\n<br />"
-                    )
-                    nextpagesurl.append(i)
-                    href = i.get("href")
-                    if isinstance(href, str):
-                        urls.append(href)
-                    nextpagesdepth.append(j)
-                    j += 1
-
-        if Common.opf is not None and any(x in ("epub", "EPUB") for x in Common.opf):
-            epubtemp += self.epubPrevLink
-            for j_str in epubnextpages:
-                epubtemp += j_str
-            self.epubtemp.append(epubtemp)
-
-        for j_str in nextpages:
-            temp += j_str
-        self.temp.append(temp)
+            self.AddChoices(q_content)
 
         # Checks if new page was a link backwards and exits if so
-        self.chapNum = 0
         meta_p = soup.find("p", attrs={"class": "meta"})
         if isinstance(meta_p, Tag):
             meta_text = meta_p.get_text().split()
-            if len(meta_text) > 1:
+            if len(meta_text) > 1 and meta_text[1].isdigit():
                 self.chapNum = int(meta_text[1])
 
-        if self.prevChapNum >= self.chapNum:
-            return
-
-        # Other check if current page is a link and doesn't continue if so
+        # Other check if current page is a link: the chapter it really follows
         prevLinkCheck1 = soup.find("span", attrs={"class": "controls-left"})
         if isinstance(prevLinkCheck1, Tag):
             a_tags = prevLinkCheck1.find_all("a")
             if a_tags:
                 prevLinkCheck2 = a_tags[0].get("href")
                 if isinstance(prevLinkCheck2, str):
-                    prevLinkId = urllib.parse.urlparse(prevLinkCheck2)[2].split(".")[
+                    self.prevId = urllib.parse.urlparse(prevLinkCheck2)[2].split(".")[
                         -1
                     ]
+        self.fetched = True
+        return len(page.content)
 
-                    currLinkId = urllib.parse.urlparse(url)[2].split(".")[-1]
-                    if self.prevLinkId is not None and prevLinkId != self.prevLinkId:
-                        return
-
-        self.children.extend(urls)
-        for idx in range(0, len(nextpagesurl)):
-            href = nextpagesurl[idx].get("href")
-            if isinstance(href, str):
-                threading.Thread(
-                    target=self.ThreadAdd,
-                    args=(
-                        href,
-                        str(depth) + "." + str(nextpagesdepth[idx]),
-                        self.renames,
-                        self.oldnames,
-                        self.currLink,
-                        epubCurrLink,
-                        nextLinks[idx],
-                        currLinkId,
-                    ),
-                    daemon=True,
-                ).start()
-
-    def ThreadAdd(
-        self,
-        url: str,
-        depth: str,
-        renames: List[str],
-        oldnames: List[str],
-        currLink: str,
-        epubCurrLink: str,
-        nextLink: str,
-        currLinkId: str,
-    ) -> None:
-        try:
-            idx = self.children.index(url)
-            self.children[idx] = self.__class__(
-                url,
-                depth,
-                renames,
-                oldnames,
-                self.q,
-                self.chapNum,
-                currLink,
-                epubCurrLink,
-                nextLink,
-                currLinkId,
-                self.ogUrl,
-            )
-        except ValueError:
-            pass
+    def AddChoices(self, q_content: Tag) -> None:
+        for i in q_content.find_all("a"):
+            if i.get_text().strip() != "Add a new chapter":
+                href = i.get("href")
+                self.AddChoice(i.get_text(), href if isinstance(href, str) else "")
+
+    def AddChoice(self, text: str, href: str) -> None:
+        """Adds a choice; its text is renamed when it is rendered."""
+        self.rawChoices.append(text)
+        if self.links is not None:
+            self.links.append(href)
+
+    def Record(self, links: List[str]) -> Dict[str, Any]:
+        """This chapter as kept in the story graph for the next update.
+
+        links are where its choices lead, see Crawl.Links. The content is
+        added by StoryGraph.Save, from the chapter store.
+        """
+        record: Dict[str, Any] = {
+            "url": self.url,
+            "depth": self.label,
+            "links": links,
+            "choices": self.rawChoices,
+            "hash": self.hash.hex(),
+            "author": self.author,
+            "chapter": self.chapter,
+            "question": self.question,
+            "chapNum": self.chapNum,
+            "prevId": self.prevId,
+            "hasimages": self.hasimages,
+        }
+        if self.etag:
+            record["etag"] = self.etag
+        if self.modified:
+            record["modified"] = self.modified
+        return record
+
+    def Restore(self, record: Dict[str, Any]) -> None:
+        """Fills this chapter in from its story graph record instead of the page."""
+        self.hash = bytes.fromhex(record["hash"])
+        self.author = sys.intern(record["author"])
+        self.chapter = record["chapter"]
+        self.question = sys.intern(record["question"])
+        self.content = record["content"]
+        self.chapNum = record["chapNum"]
+        self.prevId = record["prevId"]
+        self.hasimages = Common.images and record["hasimages"]
+        self.etag = record.get("etag", "")
+        self.modified = record.get("modified", "")
+        for text, href in zip(record["choices"], record["links"], strict=True):
+            self.AddChoice(text, href)
+        self.restored = True
+        self.fetched = True
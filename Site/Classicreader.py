@@ -76,7 +76,9 @@ class Classicreader:
                 toc_href = categories_links[7].get("href")
                 if isinstance(toc_href, str):
                     url_toc = "https://www.classicreader.com" + toc_href
-                    page_toc = requests.get(url_toc)
+                    page_toc = self.requestPage(url_toc)
+                    if page_toc is None:
+                        raise ValueError("Could not complete request for page: " + url_toc)
                     soup = BeautifulSoup(page_toc.content, "html.parser")
                     Common.prnt("got table of contents page")
             except Exception:
@@ -95,6 +97,11 @@ class Classicreader:
         links = soup.find_all("a", attrs={"class": "chapter-title"})
 
         self.pbar = Common.Progress(len(links))
+        Common.transport.Prefetch(
+            "https://www.classicreader.com" + href
+            for href in (i.get("href") for i in links)
+            if isinstance(href, str)
+        )
 
         for i in links:
             href = i.get("href")
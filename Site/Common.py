@@ -1,16 +1,38 @@
 import html
 import os
+import random
+import re
 import sys
+import threading
 import time
 from datetime import datetime
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Protocol, Set, Tuple, Union
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Protocol,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
 
 import nh3
 import requests
 
 if TYPE_CHECKING:
+    from concurrent.futures import Future
+
     from bs4 import Tag
 
+    from Site.Cache import ResponseCache
+    from Site.ImageStore import ImageStore
+
 # Module contains common functions needed by sites
 
 lineEnding: str = "\n\n"
@@ -29,6 +51,9 @@ dup: bool = False
 
 chyoaDupCheck: bool = False
 
+# Skip stories whose first page the server reports as not modified
+update: bool = False
+
 chyoa_force_forwards: bool = False
 
 chyoa_name: Optional[str] = None
@@ -40,8 +65,20 @@ default_headers: Dict[str, str] = {
 
 mt: bool = False
 
+# Maximum number of keep-alive connections kept open per host
+pool_size: int = 10
+
 urlDict: Dict[str, Dict[int, str]] = {}
 
+# On-disk page cache, set up by main.py when --cache-dir is given
+cache: Optional["ResponseCache"] = None
+
+# Serve pages from the cache only and never touch the network
+cache_only: bool = False
+
+# Content-addressed image store, set up by main.py when --image-store is given
+image_store: Optional["ImageStore"] = None
+
 
 class SiteProvider(Protocol):
     """Protocol defining the interface for story-site implementations."""
@@ -161,14 +198,36 @@ def is_safe_url(url: str) -> bool:
         return False
 
 
+def ImageName(num: int, size: int) -> str:
+    """File name of the num-th of size gallery images, zero padded to sort in order."""
+    zeros = "0" * (len(str(size)) - 1)
+    # print(zeros)
+    if len(zeros) > 1 and num > 9:
+        zeros = "0"
+    elif len(zeros) == 1 and num > 9:
+        zeros = ""
+    if num > 99:
+        zeros = ""
+    return zeros + str(num) + ".jpg"
+
+
+def ImagePath(title: str, num: int, size: int = 0, gallery: bool = False) -> str:
+    """Where imageDL saves the num-th image of a story, or of a gallery of size images."""
+    if gallery:
+        file_name = ImageName(num, size)
+    else:
+        # TODO fix this for Chyoa stories so that image files don't have to be prepended with 'img' and no zeros
+        file_name = "img" + str(num) + ".jpg"
+    return os.path.join(wd, sanitize_filename(title), file_name)
+
+
 def imageDL(
     title: str,
     url: str,
     num: int,
     size: int = 0,
     pbar: Optional["Progress"] = None,
-    queue: Optional[Any] = None,
-) -> None:
+) -> Optional[str]:
     title_stripped = sanitize_filename(title)
     target_dir = os.path.join(wd, title_stripped)
     if not os.path.exists(target_dir):
@@ -176,27 +235,12 @@ def imageDL(
             os.makedirs(target_dir)
         except FileExistsError:
             pass
-    zeros = "0" * (len(str(size)) - 1)
-    # print(zeros)
-    if len(zeros) > 1 and num > 9:
-        zeros = "0"
-    elif len(zeros) == 1 and num > 9:
-        zeros = ""
-    if num > 99:
-        zeros = ""
-    if pbar is None:
-        zeros = "img"  # TODO fix this for Chyoa stories so that image files don't have to be prepended with 'img' and no zeros
-    # print(zeros)
-    file_path = os.path.join(target_dir, zeros + str(num) + ".jpg")
-    imgbytes = GetImage(url)
-    if imgbytes is not None:
-        with open(file_path, "wb") as myimg:
-            myimg.write(imgbytes)
+    file_path = ImagePath(title, num, size, pbar is not None)
+    saved = SaveImage(url, file_path)
 
     if pbar is not None:
         pbar.Update()
-    if queue is not None:
-        queue.put(num)
+    return file_path if saved else None
 
 
 def CheckDuplicate(title: str) -> bool:
@@ -216,6 +260,7 @@ def CheckDuplicate(title: str) -> bool:
 
 
 def CheckDuplicateTime(title: str, timeObject: datetime) -> bool:
+    """Whether the story needs downloading: it is missing or older than timeObject."""
     title_stripped = sanitize_filename(title)
     if opf is not None:
         if any(x in ("epub", "EPUB") for x in opf):
@@ -225,6 +270,8 @@ def CheckDuplicateTime(title: str, timeObject: datetime) -> bool:
                     time.ctime(os.path.getmtime(file_path)), "%a %b %d %H:%M:%S %Y"
                 ):
                     return True
+            else:
+                return True
         elif any(x in ("txt", "TXT") for x in opf):
             file_path = os.path.join(wd, title_stripped + ".txt")
             dir_path = os.path.join(wd, title_stripped)
@@ -238,6 +285,8 @@ def CheckDuplicateTime(title: str, timeObject: datetime) -> bool:
                     time.ctime(os.path.getmtime(dir_path)), "%a %b %d %H:%M:%S %Y"
                 ):
                     return True
+            else:
+                return True
 
         elif any(x in ("html", "HTML") for x in opf):
             file_path = os.path.join(wd, title_stripped + ".html")
@@ -252,33 +301,325 @@ def CheckDuplicateTime(title: str, timeObject: datetime) -> bool:
                     time.ctime(os.path.getmtime(dir_path)), "%a %b %d %H:%M:%S %Y"
                 ):
                     return True
+            else:
+                return True
     return False
 
 
-def GetImage(url: str) -> Optional[bytes]:
+def OtherExtension(url: str) -> str:
+    """The image URL with .jpg and .png swapped, tried when the original fails."""
+    if url[-4:] == ".jpg":
+        return url[:-4] + ".png"
+    if url[-4:] == ".png":
+        return url[:-4] + ".jpg"
+    return ""
+
+
+def RequestImage(
+    url: str, stream: bool = False, offset: int = 0
+) -> Optional[requests.Response]:
+    """Requests an image, asking for the bytes from offset on when resuming.
+
+    A resumed request that the server refuses comes back as its 416 reply.
+    """
     if not is_safe_url(url):
         prnt(f"Blocked unsafe or unsupported URL: {url}")
         return None
+    pending = transport.PrefetchedImage(url)
+    if pending is not None:
+        # Fetched whole, which callers treat like a server ignoring the range
+        return pending.result()
+    headers = default_headers
+    if offset:
+        headers = dict(default_headers, Range="bytes=%d-" % offset)
+
+    def send(target: str) -> requests.Response:
+        # Image CDNs are only throttled when a limit is configured for them
+        rateLimiter.Wait(target, default=False)
+        return transport.Get(target, headers=headers, timeout=10, stream=stream)
+
+    passthrough = (416,) if offset else ()
+    response = retryPolicy.Send(lambda: send(url), url, passthrough, "image")
+    if response is None:
+        new_url = OtherExtension(url)
+        if new_url and is_safe_url(new_url):
+            response = retryPolicy.Send(
+                lambda: send(new_url), new_url, passthrough, "image"
+            )
+    return response
+
+
+class ImageStats:
+    """Counts streamed image bytes to report download throughput."""
+
+    count: int
+    bytes: int
+    first: Optional[float]
+    last: float
+    lock: threading.Lock
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.bytes = 0
+        self.first = None
+        self.last = 0.0
+        self.lock = threading.Lock()
+
+    def Add(self, size: int, start: float, end: float) -> None:
+        with self.lock:
+            self.count += 1
+            self.bytes += size
+            if self.first is None or start < self.first:
+                self.first = start
+            self.last = max(self.last, end)
+
+    def Rate(self) -> float:
+        """Bytes per second over the time images were being downloaded."""
+        with self.lock:
+            if self.first is None or self.last <= self.first:
+                return 0.0
+            return self.bytes / (self.last - self.first)
+
+
+imageStats: ImageStats = ImageStats()
+
+# Size of the pieces images are streamed in, which bounds memory per download
+image_chunk_size: int = 64 * 1024
+
+
+def WriteImage(
+    response: requests.Response, url: str, dest: IO[bytes], start: float
+) -> Optional[int]:
+    """Streams a response body into an open binary file in chunks.
+
+    Returns the number of bytes written, or None if the download failed.
+    """
+    written = 0
     try:
-        response = requests.get(url, headers=default_headers, timeout=10)
-        if response.status_code == 200:
-            return bytes(response.content)
-    except Exception:
-        # Fallback logic for extensions if needed
+        for chunk in response.iter_content(chunk_size=image_chunk_size):
+            dest.write(chunk)
+            written += len(chunk)
+    except requests.RequestException as e:
+        print("Image download interrupted: " + url + " (" + type(e).__name__ + ")")
+        return None
+    finally:
+        response.close()
+    imageStats.Add(written, start, time.monotonic())
+    return written
+
+
+def DownloadPart(url: str, part: str) -> Optional[int]:
+    """Downloads an image into part, resuming whatever an earlier attempt left there.
+
+    A 206 reply is appended to the partial file and a 200 (the server ignored
+    the range) starts it over, as does a refused range. Returns the full size
+    once it matches the length the server announced, or None with part kept
+    for the next attempt.
+    """
+    start = time.monotonic()
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+    response = RequestImage(url, stream=True, offset=offset)
+    if response is None:
+        return None
+    if response.status_code == 416:
+        response.close()
+        # The part may already hold the whole image
+        if response.headers.get("Content-Range", "") == "bytes */" + str(offset):
+            return offset
+        prnt("Range refused for " + url + ", starting over")
+        os.remove(part)
+        return DownloadPart(url, part)
+    expected: Optional[int] = None
+    mode = "wb"
+    if response.status_code == 206:
+        match = re.match(
+            r"bytes (\d+)-\d+/(\d+|\*)", response.headers.get("Content-Range", "")
+        )
+        if match is None or int(match.group(1)) != offset:
+            response.close()
+            prnt("Unexpected Content-Range for " + url + ", starting over")
+            if offset:
+                os.remove(part)
+                return DownloadPart(url, part)
+            return None
+        if match.group(2) != "*":
+            expected = int(match.group(2))
+        mode = "ab"
+    else:
+        offset = 0
+        length = response.headers.get("Content-Length", "")
+        # A compressed body is decoded on the fly and will not match the header
+        if length.isdigit() and "Content-Encoding" not in response.headers:
+            expected = int(length)
+    with open(part, mode) as fo:
+        written = WriteImage(response, url, fo, start)
+    if written is None:
+        return None
+    size = offset + written
+    if expected is not None and size != expected:
+        print(
+            "Incomplete image download: "
+            + url
+            + " ("
+            + str(size)
+            + " of "
+            + str(expected)
+            + " bytes)"
+        )
+        if size > expected:
+            os.remove(part)
+        return None
+    return size
+
+
+class ImageSources:
+    """Remembers which URL each finished image file was downloaded from.
+
+    Each directory images are saved to gets a hidden file of "name url" lines
+    beside it (.<directory>.sources), so a later run skips files that are
+    already complete while the published directory only holds images. A
+    line may end with the size recompression left the file at, so a later
+    run does not re-encode it again. The file is removed once every image
+    in the directory is complete, as only a run resuming it needs it.
+    """
+
+    directories: Dict[str, Dict[str, Tuple[str, Optional[int]]]]
+    lock: threading.Lock
+
+    def __init__(self) -> None:
+        self.directories = {}
+        self.lock = threading.Lock()
+
+    def Path(self, directory: str) -> str:
+        parent, name = os.path.split(os.path.normpath(directory))
+        return os.path.join(parent, "." + name + ".sources")
+
+    def Load(self, directory: str) -> Dict[str, Tuple[str, Optional[int]]]:
+        """The record of directory. Called with lock held.
+
+        Later lines override earlier ones, which are dropped from the file
+        when it is first read.
+        """
+        if directory not in self.directories:
+            sources: Dict[str, Tuple[str, Optional[int]]] = {}
+            lines = 0
+            try:
+                with open(self.Path(directory), "r", encoding="utf-8") as fi:
+                    for line in fi:
+                        name, _, rest = line.rstrip("\n").partition(" ")
+                        url, _, size = rest.partition(" ")
+                        sources[name] = (url, int(size) if size.isdigit() else None)
+                        lines += 1
+            except OSError:
+                pass
+            self.directories[directory] = sources
+            if lines > len(sources):
+                self.Compact(directory)
+        return self.directories[directory]
+
+    def Compact(self, directory: str) -> None:
+        """Rewrites directory's file with one line per image. Called with lock held."""
+        path = self.Path(directory)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fo:
+            for name, (url, size) in self.directories[directory].items():
+                fo.write(self.Line(name, url, size))
+        os.replace(tmp, path)
+
+    def Line(self, name: str, url: str, size: Optional[int]) -> str:
+        return name + " " + url + ("" if size is None else " " + str(size)) + "\n"
+
+    def Append(self, file_path: str, url: str, size: Optional[int]) -> None:
+        directory, name = os.path.split(file_path)
+        with self.lock:
+            self.Load(directory)[name] = (url, size)
+            with open(self.Path(directory), "a", encoding="utf-8") as fo:
+                fo.write(self.Line(name, url, size))
+
+    def Complete(self, file_path: str, url: str) -> bool:
+        directory, name = os.path.split(file_path)
+        with self.lock:
+            known = self.Load(directory).get(name, ("", None))[0] == url
+        return known and os.path.isfile(file_path)
+
+    def Record(self, file_path: str, url: str) -> None:
+        self.Append(file_path, url, None)
+
+    def Processed(self, file_path: str) -> bool:
+        """Whether file_path is still as recompression left it."""
+        directory, name = os.path.split(file_path)
+        with self.lock:
+            size = self.Load(directory).get(name, ("", None))[1]
         try:
-            new_url = ""
-            if url[-4:] == ".jpg":
-                new_url = url[:-4] + ".png"
-            elif url[-4:] == ".png":
-                new_url = url[:-4] + ".jpg"
-
-            if new_url and is_safe_url(new_url):
-                response = requests.get(new_url, headers=default_headers, timeout=10)
-                if response.status_code == 200:
-                    return bytes(response.content)
-        except Exception:
-            pass
-    return None
+            return size is not None and os.path.getsize(file_path) == size
+        except OSError:
+            return False
+
+    def RecordProcessed(self, file_path: str) -> None:
+        directory, name = os.path.split(file_path)
+        with self.lock:
+            url = self.Load(directory).get(name, ("", None))[0]
+        if url:
+            self.Append(file_path, url, os.path.getsize(file_path))
+
+    def Finish(self, directory: str, files: Iterable[Tuple[str, str]]) -> None:
+        """Drops the record of directory once every (file path, url) in it is complete."""
+        if all(self.Complete(file_path, url) for file_path, url in files):
+            self.Forget(directory)
+
+    def Forget(self, directory: str) -> None:
+        """Drops the record of a directory that is complete or being deleted."""
+        with self.lock:
+            self.directories.pop(directory, None)
+            try:
+                os.remove(self.Path(directory))
+            except OSError:
+                pass
+
+
+imageSources: ImageSources = ImageSources()
+
+
+def SaveImage(url: str, file_path: str) -> bool:
+    """Downloads an image to file_path through a resumable .part file.
+
+    The file only gets its final name once complete, and one already saved
+    from the same URL by an earlier run is kept as is.
+    """
+    if image_store is not None:
+        return image_store.Export(url, file_path)
+    if imageSources.Complete(file_path, url):
+        return True
+    part = file_path + ".part"
+    if DownloadPart(url, part) is None:
+        return False
+    os.replace(part, file_path)
+    imageSources.Record(file_path, url)
+    return True
+
+
+def PrefetchImage(url: str, file_path: Optional[str] = None) -> None:
+    """Announces an image about to be saved to file_path to the transport.
+
+    Images already in the image store, or saved there by an earlier run,
+    are not fetched again. Neither are images an earlier run left partly
+    downloaded, which DownloadPart resumes with a range request instead.
+    """
+    if not transport.prefetches or not is_safe_url(url):
+        return
+    if image_store is not None:
+        if image_store.Lookup(url) is not None:
+            return
+        part = image_store.PartPath(url)
+    elif file_path is not None:
+        if imageSources.Complete(file_path, url):
+            return
+        part = file_path + ".part"
+    else:
+        part = ""
+    if part and os.path.isfile(part):
+        return
+    transport.PrefetchImage(url)
 
 
 class Progress:
@@ -309,6 +650,486 @@ class Progress:
         self.it = 0
 
 
+class Transport:
+    """Keeps one pooled keep-alive session per host, shared by every thread.
+
+    Providers may announce pages and images they are about to request with
+    Prefetch and PrefetchImage. This transport ignores them and sends each
+    request when it is made; see AsyncEngine for one that fetches ahead.
+    """
+
+    # Whether Prefetch fetches anything, so callers can skip building hints
+    prefetches: bool = False
+    poolSize: int
+    sessions: Dict[str, requests.Session]
+    requestCounts: Dict[str, int]
+    lock: threading.Lock
+
+    def __init__(self, poolSize: int = 10) -> None:
+        self.poolSize = poolSize
+        self.sessions = {}
+        self.requestCounts = {}
+        self.lock = threading.Lock()
+
+    def Mount(self, session: requests.Session) -> None:
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=self.poolSize
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+    def Register(self, host: str, session: requests.Session) -> None:
+        """Routes every request for host through an existing (e.g. logged in) session."""
+        with self.lock:
+            self.sessions[host] = session
+
+    def Session(self, host: str) -> requests.Session:
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                self.Mount(session)
+                self.sessions[host] = session
+            return session
+
+    def Get(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        cookies: Optional[Dict[str, str]] = None,
+        **kwargs: Any,
+    ) -> requests.Response:
+        from urllib.parse import urlparse
+
+        host = urlparse(url).netloc
+        session = self.Session(host)
+        with self.lock:
+            self.requestCounts[host] = self.requestCounts.get(host, 0) + 1
+        return session.get(url, headers=headers, cookies=cookies, **kwargs)
+
+    def Prefetch(
+        self, urls: Iterable[str], headers: Optional[Dict[str, str]] = None
+    ) -> None:
+        """Announces pages that are about to be requested with FetchPage."""
+
+    def Prefetched(
+        self, url: str
+    ) -> Optional["Future[Tuple[Optional[requests.Response], bool]]"]:
+        """The FetchPage result for a prefetched page, handed out once."""
+        return None
+
+    def PrefetchImage(self, url: str) -> None:
+        """Announces an image that is about to be requested with RequestImage."""
+
+    def PrefetchedImage(
+        self, url: str
+    ) -> Optional["Future[Optional[requests.Response]]"]:
+        """The RequestImage result for a prefetched image, handed out once."""
+        return None
+
+    def Cancel(self, urls: Iterable[str]) -> None:
+        """Drops prefetched pages and images that will not be requested after all."""
+
+    def Stats(self) -> Dict[str, Tuple[int, int]]:
+        """Returns host -> (requests sent, connections opened)."""
+        stats: Dict[str, Tuple[int, int]] = {}
+        with self.lock:
+            for host, session in self.sessions.items():
+                connections = 0
+                for adapter in set(session.adapters.values()):
+                    if not isinstance(adapter, requests.adapters.HTTPAdapter):
+                        continue
+                    pools = adapter.poolmanager.pools
+                    for key in pools.keys():
+                        pool = pools.get(key)
+                        if pool is not None:
+                            connections += pool.num_connections
+                stats[host] = (self.requestCounts.get(host, 0), connections)
+        return stats
+
+
+transport: Transport = Transport(pool_size)
+
+
+def BuildResponse(
+    url: str, status: int, headers: Dict[str, str], content: bytes
+) -> requests.Response:
+    """Wraps a body fetched some other way in a requests.Response for the providers."""
+    response = requests.Response()
+    response.url = url
+    response.status_code = status
+    response.headers = requests.structures.CaseInsensitiveDict(headers)
+    response._content = content
+    response._content_consumed = True  # type: ignore[attr-defined]
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    return response
+
+
+class TokenBucket:
+    """Thread-safe token bucket. Callers reserve a token and sleep off any debt."""
+
+    rate: float
+    burst: int
+    tokens: float
+    stamp: float
+    lock: threading.Lock
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = max(burst, 1)
+        # Starts full so an idle host never pays a delay
+        self.tokens = float(self.burst)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def Reserve(self) -> float:
+        """Takes one token and returns how long to wait until it is available."""
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                float(self.burst), self.tokens + (now - self.stamp) * self.rate
+            )
+            self.stamp = now
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def Acquire(self) -> float:
+        """Takes one token, sleeping until it is available. Returns the time waited."""
+        wait = self.Reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class RateLimiter:
+    """Hands out one TokenBucket per host, configured per site or by the defaults."""
+
+    defaultRate: float
+    defaultBurst: int
+    limits: Dict[str, Tuple[float, int]]
+    buckets: Dict[str, Optional[TokenBucket]]
+    waits: Dict[str, Tuple[int, float]]
+    lock: threading.Lock
+
+    def __init__(self, rate: float = 2.0, burst: int = 2) -> None:
+        self.defaultRate = rate
+        self.defaultBurst = burst
+        self.limits = {}
+        self.buckets = {}
+        self.waits = {}
+        self.lock = threading.Lock()
+
+    def Configure(self, host: Optional[str], rate: float, burst: int) -> None:
+        """Sets the rate for one host (and its subdomains), or the default if host is None."""
+        with self.lock:
+            if host is None:
+                self.defaultRate = rate
+                self.defaultBurst = burst
+            else:
+                self.limits[host] = (rate, burst)
+            # Buckets are rebuilt with the new settings on next use
+            self.buckets = {}
+
+    def Parse(self, spec: str) -> None:
+        """Configures from a [HOST=]RATE[:BURST] string, e.g. chyoa.com=1:3"""
+        host: Optional[str] = None
+        if "=" in spec:
+            host, spec = spec.split("=", 1)
+        rate, _, burst = spec.partition(":")
+        self.Configure(
+            host, float(rate), int(burst) if burst else max(int(float(rate)), 1)
+        )
+
+    def Load(self, path: str) -> None:
+        """Configures from a JSON file mapping hosts (or "default") to {"rate", "burst"}."""
+        import json
+
+        with open(path, "r", encoding="utf-8") as fi:
+            config = json.load(fi)
+        for host, limit in config.items():
+            if isinstance(limit, dict):
+                rate = float(limit.get("rate", self.defaultRate))
+                burst = int(limit.get("burst", max(int(rate), 1)))
+            else:
+                rate = float(limit)
+                burst = max(int(rate), 1)
+            self.Configure(None if host == "default" else host, rate, burst)
+
+    def Limit(self, host: str) -> Optional[Tuple[float, int]]:
+        if host in self.limits:
+            return self.limits[host]
+        for domain, limit in self.limits.items():
+            if host.endswith("." + domain):
+                return limit
+        return None
+
+    def Wait(self, url: str, default: bool = True) -> None:
+        """Blocks until the host of url may be sent another request.
+
+        With default=False, hosts without an explicit limit are not throttled.
+        """
+        wait = self.Reserve(url, default)
+        if wait > 0:
+            time.sleep(wait)
+
+    def Reserve(self, url: str, default: bool = True) -> float:
+        """Books the next request to the host of url and returns how long to wait for it."""
+        from urllib.parse import urlparse
+
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                limit = self.Limit(host)
+                if limit is None and default:
+                    limit = (self.defaultRate, self.defaultBurst)
+                self.buckets[host] = TokenBucket(*limit) if limit is not None else None
+            bucket = self.buckets[host]
+        if bucket is None:
+            return 0.0
+        wait = bucket.Reserve()
+        if wait > 0:
+            with self.lock:
+                count, total = self.waits.get(host, (0, 0.0))
+                self.waits[host] = (count + 1, total + wait)
+        return wait
+
+
+rateLimiter: RateLimiter = RateLimiter()
+
+
+class RetryPolicy:
+    """Classifies failed requests and retries the transient ones with backoff.
+
+    Delays grow exponentially with full jitter, a Retry-After header takes
+    precedence, and the total time slept for one request is capped by budget.
+    """
+
+    retryable: Set[int] = {408, 425, 429, 500, 502, 503, 504}
+    # Failures without a reply that sending again may get past
+    transient: Tuple[Type[requests.RequestException], ...] = (
+        requests.ConnectionError,
+        requests.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+    )
+    retries: int
+    base: float
+    cap: float
+    budget: float
+    outcomes: Dict[str, int]
+    lock: threading.Lock
+
+    def __init__(
+        self,
+        retries: int = 4,
+        base: float = 1.0,
+        cap: float = 30.0,
+        budget: float = 60.0,
+    ) -> None:
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+        self.budget = budget
+        self.outcomes = {}
+        self.lock = threading.Lock()
+
+    def RetryAfter(self, response: requests.Response) -> Optional[float]:
+        """Returns the delay requested by a Retry-After header, in seconds."""
+        from email.utils import parsedate_to_datetime
+
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max((when - datetime.now(when.tzinfo)).total_seconds(), 0.0)
+
+    def Delay(self, attempt: int, response: Optional[requests.Response]) -> float:
+        if response is not None:
+            retryAfter = self.RetryAfter(response)
+            if retryAfter is not None:
+                return retryAfter
+        return random.uniform(0, min(self.cap, self.base * 2**attempt))
+
+    def Record(self, outcome: str) -> None:
+        with self.lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def Transient(self, error: Optional[Exception]) -> bool:
+        """Whether a request that raised error could succeed if sent again."""
+        # An SSLError is a ConnectionError, but fails the same way every time
+        return isinstance(error, self.transient) and not isinstance(
+            error, requests.exceptions.SSLError
+        )
+
+    def Send(
+        self,
+        send: Callable[[], Optional[requests.Response]],
+        url: str,
+        passthrough: Tuple[int, ...] = (),
+        kind: str = "page",
+    ) -> Optional[requests.Response]:
+        """Calls send until it succeeds, fails permanently or runs out of retries/budget.
+
+        Error statuses in passthrough are returned for the caller to handle.
+        kind names what url is in failure messages.
+        """
+        spent = 0.0
+        attempt = 0
+        while True:
+            reason: str
+            response: Optional[requests.Response] = None
+            error: Optional[Exception] = None
+            try:
+                response = send()
+            except requests.RequestException as e:
+                reason = type(e).__name__
+                error = e
+            else:
+                if response is None:
+                    return None
+                if response.status_code < 400 or response.status_code in passthrough:
+                    if attempt > 0:
+                        self.Record("recovered")
+                    return response
+                reason = str(response.status_code)
+
+            delay = self.Retry(url, attempt, spent, response, reason, error, kind)
+            if response is not None:
+                response.close()
+            if delay is None:
+                return None
+            time.sleep(delay)
+            spent += delay
+            attempt += 1
+
+    def Retry(
+        self,
+        url: str,
+        attempt: int,
+        spent: float,
+        response: Optional[requests.Response],
+        reason: str,
+        error: Optional[Exception] = None,
+        kind: str = "page",
+    ) -> Optional[float]:
+        """Decides on a failed attempt: the delay before the next one, or None to give up.
+
+        response is the error reply, if there was one, and error what was
+        raised when there was none; reason names the failure.
+        """
+        if response is None and not self.Transient(error):
+            self.Record("failed " + reason)
+            print("Request failed (" + reason + ") for " + kind + ": " + url)
+            return None
+        if response is not None and response.status_code not in self.retryable:
+            self.Record("failed " + reason)
+            print("Server returned status code " + reason + " for " + kind + ": " + url)
+            return None
+        delay = self.Delay(attempt, response)
+        if attempt >= self.retries or spent + delay > self.budget:
+            self.Record("gave up " + reason)
+            print(
+                "Giving up on "
+                + kind
+                + " "
+                + url
+                + " after "
+                + str(attempt + 1)
+                + " attempts ("
+                + reason
+                + ")"
+            )
+            return None
+        self.Record("retried " + reason)
+        prnt(
+            "Attempt "
+            + str(attempt + 1)
+            + "/"
+            + str(self.retries + 1)
+            + " for "
+            + url
+            + " failed ("
+            + reason
+            + "), retrying in "
+            + "%.1f" % delay
+            + "s"
+        )
+        return delay
+
+
+retryPolicy: RetryPolicy = RetryPolicy()
+
+
+def ReportStats() -> None:
+    for host, (sent, connections) in sorted(transport.Stats().items()):
+        prnt(
+            host
+            + ": "
+            + str(sent)
+            + " requests over "
+            + str(connections)
+            + " connections ("
+            + str(max(sent - connections, 0))
+            + " reused)",
+            f=True,
+        )
+    if cache is not None:
+        prnt(
+            "cache: "
+            + str(cache.hits)
+            + " hits, "
+            + str(cache.misses)
+            + " misses, "
+            + str(cache.revalidated)
+            + " not modified, "
+            + "%.1f" % (cache.size / 1048576)
+            + " MB on disk",
+            f=True,
+        )
+    if imageStats.count:
+        prnt(
+            "images: "
+            + str(imageStats.count)
+            + " downloaded, "
+            + "%.1f" % (imageStats.bytes / 1048576)
+            + " MB at "
+            + "%.1f" % (imageStats.Rate() / 1024)
+            + " KB/s",
+            f=True,
+        )
+    if image_store is not None:
+        prnt(
+            "image store: "
+            + str(image_store.hits)
+            + " hits, "
+            + str(image_store.misses)
+            + " misses, "
+            + "%.1f" % (image_store.size / 1048576)
+            + " MB on disk",
+            f=True,
+        )
+    for outcome, count in sorted(retryPolicy.outcomes.items()):
+        prnt(outcome + ": " + str(count), f=True)
+    for host, (count, total) in sorted(rateLimiter.waits.items()):
+        prnt(
+            host
+            + ": rate limited "
+            + str(count)
+            + " times for "
+            + "%.1f" % total
+            + "s",
+            f=True,
+        )
+
+
 def RequestSend(
     url: str,
     headers: Optional[Dict[str, str]] = None,
@@ -319,38 +1140,105 @@ def RequestSend(
         return None
 
     # Rate limiting: Be a good citizen to target servers
-    time.sleep(0.5)
+    rateLimiter.Wait(url)
 
-    if headers is None:
-        response = requests.get(url)
-    else:
-        response = requests.get(url, headers=headers, cookies=cookies)
-    return response
+    return transport.Get(url, headers=headers, cookies=cookies)
+
+
+class PageRequest:
+    """One page fetch through the cache, split around the request it sends.
+
+    Creating it looks the page up: result is set if the cache (or offline
+    mode) settles it, otherwise headers are what to send, validators
+    included. Finish takes the reply and updates the cache. FetchPage and
+    the async engine both go through it.
+    """
+
+    url: str
+    headers: Optional[Dict[str, str]]
+    entry: Optional[Tuple[Dict[str, Any], bytes]]
+    result: Optional[Tuple[Optional[requests.Response], bool]]
+
+    def __init__(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        revalidate: bool = False,
+    ) -> None:
+        self.url = url
+        self.headers = dict(headers) if headers is not None else None
+        self.entry = cache.Load(url) if cache is not None else None
+        self.result = None
+        if cache is not None and self.entry is not None:
+            if cache_only or (not revalidate and cache.Fresh(self.entry[0])):
+                cache.Count(True)
+                self.result = (cache.Response(*self.entry), False)
+                return
+        if cache is not None:
+            cache.Count(False)
+        if cache_only:
+            print("Not in cache, skipping in offline mode: " + url)
+            self.result = (None, False)
+            return
+        if cache is not None and self.entry is not None:
+            self.headers = self.headers or {}
+            self.headers.update(cache.Conditional(self.entry[0]))
+
+    def Finish(
+        self, response: Optional[requests.Response]
+    ) -> Tuple[Optional[requests.Response], bool]:
+        if response is None:
+            return None, False
+        url = self.url
+        entry = self.entry
+        if cache is not None and entry is not None and response.status_code == 304:
+            try:
+                cache.Refresh(url, entry[0], response)
+            except OSError as e:
+                prnt("Could not cache " + url + ": " + str(e))
+            return cache.Response(*entry), True
+        if cache is not None and response.status_code == 200:
+            try:
+                cache.Store(url, response)
+            except OSError as e:
+                prnt("Could not cache " + url + ": " + str(e))
+        # Servers that ignore the validators may still send back the same page
+        unchanged = entry is not None and response.content == entry[1]
+        return response, unchanged
+
+
+def FetchPage(
+    url: str, headers: Optional[Dict[str, str]] = None, revalidate: bool = False
+) -> Tuple[Optional[requests.Response], bool]:
+    """Fetches a page through the cache.
+
+    A stale cached page (or any cached page, with revalidate=True) is
+    requested conditionally. Returns the page and whether the server
+    confirmed the cached copy is still current. A page the transport was
+    told to prefetch is waited for instead.
+    """
+    if not revalidate:
+        pending = transport.Prefetched(url)
+        if pending is not None:
+            return pending.result()
+    request = PageRequest(url, headers, revalidate)
+    if request.result is not None:
+        return request.result
+    sendHeaders = request.headers
+    return request.Finish(retryPolicy.Send(lambda: RequestSend(url, sendHeaders), url))
 
 
 def RequestPage(
     url: str, headers: Optional[Dict[str, str]] = None
 ) -> Optional[requests.Response]:
-    response = RequestSend(url, headers)
-    if response is None:
-        return None
-    attempts = 0
-    # print(response.url)
-    while response.status_code != 200 and attempts < 4:
-        time.sleep(2)
-        response = RequestSend(url, headers)
-        if response is None:
-            return None
-        attempts += 1
-    if attempts >= 4:
-        print(
-            "Server returned status code "
-            + str(response.status_code)
-            + " for page: "
-            + url
-        )
-        return None
-    return response
+    return FetchPage(url, headers)[0]
+
+
+def PageUnchanged(url: str, headers: Optional[Dict[str, str]] = None) -> bool:
+    """Asks the server whether the cached copy of url is still current."""
+    if cache is None or cache_only:
+        return False
+    return FetchPage(url, headers, revalidate=True)[1]
 
 
 class AuthenticationError(Exception):
@@ -368,6 +1256,7 @@ def GetChyoaSession(password: str) -> None:
         return
 
     chyoa_session = requests.Session()
+    transport.Mount(chyoa_session)
     response = chyoa_session.post(
         "https://chyoa.com/auth/login",
         data={"username": user, "password": password},
@@ -387,38 +1276,12 @@ def GetChyoaSession(password: str) -> None:
             "Failed to log in to Chyoa. Please check your credentials."
         )
 
+    # Every later chyoa.com request reuses the logged in, pooled session
+    transport.Register("chyoa.com", chyoa_session)
+
 
 def RequestPageChyoa(
     url: str, headers: Optional[Dict[str, str]] = None
 ) -> Optional[requests.Response]:
-    global chyoa_session
-    response: Optional[requests.Response] = None
-    if chyoa_session is None:
-        response = RequestSend(url, headers)
-    else:
-        response = chyoa_session.get(url, headers=headers)
-
-    if response is None:
-        return None
-
-    attempts = 0
-    # print(response.url)
-    while response.status_code != 200 and attempts < 4:
-        time.sleep(2)
-        if chyoa_session is None:
-            response = RequestSend(url, headers)
-        else:
-            response = chyoa_session.get(url, headers=headers)
-
-        if response is None:
-            return None
-        attempts += 1
-    if attempts >= 4:
-        print(
-            "Server returned status code "
-            + str(response.status_code)
-            + " for page: "
-            + url
-        )
-        return None
-    return response
+    # The logged in session, if any, is registered with the transport for chyoa.com
+    return RequestPage(url, headers)
@@ -116,6 +116,7 @@ class Fanfiction:
                 self.pbar = Common.Progress(len(self.chapters))
                 if self.pbar:
                     self.pbar.Update()
+                self.PrefetchChapters(i)
                 self.AddNextPage(soup)
                 break
 
@@ -134,6 +135,25 @@ class Fanfiction:
         self.story = re.sub(r"\n\s*\n", r"\n\n", self.story, flags=re.M)
         # print(self.chapters)
 
+    def PrefetchChapters(self, button: Tag) -> None:
+        """Announces the chapters after this one, whose URLs only differ in their number."""
+        rawnexturl = button.get("onclick")
+        if not isinstance(rawnexturl, str):
+            return
+        # /s/<story id>/<chapter>/<title>
+        parts = rawnexturl[15:-1].split("/")
+        if len(parts) < 4 or not parts[3].isdigit():
+            return
+        if urllib.parse.urlparse(self.url)[1] == "www.fanfiction.net":
+            host = "https://www.fanfiction.net"
+        else:
+            host = "https://www.fictionpress.com"
+        urls = []
+        for chapter in range(int(parts[3]), len(self.chapters) + 1):
+            parts[3] = str(chapter)
+            urls.append(host + "/".join(parts))
+        Common.transport.Prefetch(urls)
+
     def AddNextPage(self, soup: BeautifulSoup) -> None:
         for i in soup.find_all("button"):
             if i.text.strip() == "Next >":
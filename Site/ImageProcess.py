@@ -0,0 +1,172 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+from Site import Common
+
+try:
+    from PIL import Image
+except ImportError:  # only needed when images are recompressed
+    Image = None  # type: ignore[assignment]
+
+# Longest side images are downscaled to, 0 keeps the original size
+max_dimension: int = 0
+
+# JPEG quality images are re-encoded at, 0 keeps the original encoding
+quality: int = 0
+
+# Worker processes used, None means one per core
+processes: Optional[int] = None
+
+
+def Enabled(maxDimension: Optional[int] = None) -> bool:
+    """Whether images are processed, optionally with a caller's own size limit."""
+    if maxDimension is None:
+        maxDimension = max_dimension
+    return bool(maxDimension or quality)
+
+
+def SniffFormat(head: bytes) -> str:
+    """Identifies an image from its first bytes, whatever its file name says."""
+    if head[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if head[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[:2] == b"BM":
+        return "bmp"
+    return ""
+
+
+def Process(path: str, maxDimension: int, jpegQuality: int) -> Tuple[int, int, str]:
+    """Downscales and re-encodes one image as JPEG, matching the .jpg names used.
+
+    Runs in a worker process. Animated GIFs and unrecognised files are left
+    alone, as is any image the re-encode would make bigger without resizing.
+    Returns (bytes before, bytes after, sniffed format).
+    """
+    before = os.path.getsize(path)
+    with open(path, "rb") as fi:
+        fmt = SniffFormat(fi.read(16))
+    if Image is None or not fmt:
+        return before, before, fmt
+
+    # Written beside the original and swapped in, which also breaks any
+    # hard link into the image store instead of rewriting the stored copy
+    tmp = path + ".tmp"
+    try:
+        with Image.open(path) as opened:
+            if getattr(opened, "is_animated", False):
+                return before, before, fmt
+            opened.load()
+            img: Image.Image = opened
+            resized = False
+            if maxDimension and max(img.size) > maxDimension:
+                img.thumbnail((maxDimension, maxDimension), Image.Resampling.LANCZOS)
+                resized = True
+            if img.mode in ("RGBA", "LA", "P"):
+                img = img.convert("RGBA")
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel("A"))
+                img = background
+            elif img.mode != "RGB":
+                img = img.convert("RGB")
+            img.save(tmp, "JPEG", quality=jpegQuality or 85, optimize=True)
+
+        after = os.path.getsize(tmp)
+        if after >= before and not resized and fmt == "jpeg":
+            return before, before, fmt
+        os.replace(tmp, path)
+    finally:
+        # only still there if it was not swapped in
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return before, after, fmt
+
+
+class ProcessPool:
+    """Worker processes shared by every story in a run, started on first use.
+
+    The workers come from a forkserver (spawned where there is none) rather
+    than being forked from this process, whose crawl and download threads
+    may hold locks a forked child would inherit.
+    """
+
+    executor: Optional[ProcessPoolExecutor]
+    lock: threading.Lock
+
+    def __init__(self) -> None:
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def Executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                method = (
+                    "forkserver"
+                    if "forkserver" in multiprocessing.get_all_start_methods()
+                    else "spawn"
+                )
+                self.executor = ProcessPoolExecutor(
+                    max_workers=processes,
+                    mp_context=multiprocessing.get_context(method),
+                )
+            return self.executor
+
+    def Shutdown(self) -> None:
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+pool: ProcessPool = ProcessPool()
+
+
+def ProcessAll(
+    paths: List[str], maxDimension: Optional[int] = None
+) -> Tuple[int, int, float]:
+    """Processes images on the shared pool. Returns (bytes before, bytes after, seconds).
+
+    maxDimension overrides the configured max_dimension for these images.
+    Images an earlier run already processed are left as they are.
+    """
+    if maxDimension is None:
+        maxDimension = max_dimension
+    paths = [
+        path
+        for path in paths
+        if os.path.isfile(path) and not Common.imageSources.Processed(path)
+    ]
+    if not paths or not Enabled(maxDimension):
+        return 0, 0, 0.0
+    start = time.monotonic()
+    before = after = 0
+    executor = pool.Executor()
+    futures = [executor.submit(Process, path, maxDimension, quality) for path in paths]
+    for path, future in zip(paths, futures, strict=True):
+        try:
+            old, new, _ = future.result()
+        except Exception as e:
+            Common.prnt("Could not process image " + path + ": " + str(e))
+            continue
+        before += old
+        after += new
+        Common.imageSources.RecordProcessed(path)
+    seconds = time.monotonic() - start
+    Common.prnt(
+        "Processed "
+        + str(len(paths))
+        + " images: "
+        + "%.1f" % (before / 1048576)
+        + " MB -> "
+        + "%.1f" % (after / 1048576)
+        + " MB"
+    )
+    return before, after, seconds
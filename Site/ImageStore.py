@@ -0,0 +1,187 @@
+import hashlib
+import os
+import shutil
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from Site import Common
+
+
+class ImageStore:
+    """Content-addressed image store shared by every story and run.
+
+    Images live under objects/ named by the SHA-256 of their content, so a
+    banner reused across chapters or stories is kept once. index.log maps
+    each URL to its digest; it is append-only and replayed on start-up. Once
+    the objects exceed maxBytes the least recently used ones (by mtime,
+    bumped on every hit) are removed.
+    """
+
+    directory: str
+    maxBytes: int
+    index: Dict[str, str]
+    size: int
+    hits: int
+    misses: int
+    lock: threading.Lock
+    fetching: Dict[str, threading.Lock]
+
+    def __init__(self, directory: str, maxBytes: int = 2 << 30) -> None:
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.index = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.fetching = {}
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "tmp"), exist_ok=True)
+        self.Load()
+        self.size = sum(size for _, size, _ in self.Objects())
+
+    def IndexPath(self) -> str:
+        return os.path.join(self.directory, "index.log")
+
+    def ObjectPath(self, digest: str) -> str:
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def Load(self) -> None:
+        lines = 0
+        try:
+            with open(self.IndexPath(), "r", encoding="utf-8") as fi:
+                for line in fi:
+                    digest, _, url = line.rstrip("\n").partition(" ")
+                    if url:
+                        self.index[url] = digest
+                        lines += 1
+        except OSError:
+            return
+        # Rewrite the log once superseded entries make up most of it
+        if lines > 2 * len(self.index) + 1000:
+            self.Compact()
+
+    def Compact(self) -> None:
+        tmp = self.IndexPath() + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fo:
+            for url, digest in self.index.items():
+                fo.write(digest + " " + url + "\n")
+        os.replace(tmp, self.IndexPath())
+
+    def Objects(self) -> List[Tuple[str, int, float]]:
+        """Lists (path, size, last use) for every stored image."""
+        objects = []
+        for root, _, files in os.walk(os.path.join(self.directory, "objects")):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                objects.append((path, st.st_size, st.st_mtime))
+        return objects
+
+    def Lookup(self, url: str) -> Optional[str]:
+        """Returns the stored path of url's image if it has been downloaded before."""
+        with self.lock:
+            digest = self.index.get(url)
+        if digest is None:
+            return None
+        path = self.ObjectPath(digest)
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted since it was indexed
+            return None
+        return path
+
+    def Fetch(self, url: str) -> Optional[str]:
+        """Returns the stored path of url's image, downloading it if needed."""
+        with self.lock:
+            urlLock = self.fetching.setdefault(url, threading.Lock())
+        # Only one thread downloads a given URL, the others wait for it
+        with urlLock:
+            path = self.Lookup(url)
+            if path is not None:
+                with self.lock:
+                    self.hits += 1
+                return path
+            with self.lock:
+                self.misses += 1
+            path = self.Download(url)
+        with self.lock:
+            self.fetching.pop(url, None)
+        return path
+
+    def PartPath(self, url: str) -> str:
+        # Named after the URL so an interrupted download resumes next run
+        return os.path.join(
+            self.directory,
+            "tmp",
+            hashlib.sha256(url.encode("utf-8")).hexdigest() + ".part",
+        )
+
+    def Download(self, url: str) -> Optional[str]:
+        tmp = self.PartPath(url)
+        written = Common.DownloadPart(url, tmp)
+        if written is None:
+            return None
+        sha = hashlib.sha256()
+        with open(tmp, "rb") as fi:
+            for chunk in iter(lambda: fi.read(Common.image_chunk_size), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        path = self.ObjectPath(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.lock:
+            if os.path.exists(path):
+                # Same content already stored under another URL
+                os.remove(tmp)
+                os.utime(path)
+            else:
+                os.replace(tmp, path)
+                self.size += written
+            self.index[url] = digest
+            with open(self.IndexPath(), "a", encoding="utf-8") as fo:
+                fo.write(digest + " " + url + "\n")
+            full = self.size > self.maxBytes
+        if full:
+            self.Evict(keep=path)
+        return path
+
+    def Export(self, url: str, file_path: str) -> bool:
+        """Places url's image at file_path as a hard link, or a copy across filesystems."""
+        path = self.Fetch(url)
+        if path is None:
+            return False
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        try:
+            os.link(path, file_path)
+        except OSError:
+            shutil.copyfile(path, file_path)
+        return True
+
+    def Evict(self, keep: Optional[str] = None) -> None:
+        """Removes least recently used images until the store is at 90% of maxBytes."""
+        with self.lock:
+            objects = sorted(self.Objects(), key=lambda entry: entry[2])
+            self.size = sum(size for _, size, _ in objects)
+            removed = set()
+            for path, size, _ in objects:
+                if self.size <= self.maxBytes * 0.9:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                removed.add(os.path.basename(path))
+                self.size -= size
+            if removed:
+                self.index = {
+                    url: digest
+                    for url, digest in self.index.items()
+                    if digest not in removed
+                }
+                self.Compact()
@@ -1,15 +1,39 @@
-import queue
-import threading
+import os
+import re
+from concurrent.futures import Future
 from typing import TYPE_CHECKING, Any, List, Optional
 
 import requests
 from bs4 import BeautifulSoup, Tag
 
-from Site import Common
+from Site import Common, ImageProcess, Staging
 
 if TYPE_CHECKING:
     from Site.Common import Progress
 
+# Image variant fetched: "thumbnail" (CDN previews only), "reduced" (full
+# size downscaled for small readers) or "full"
+tier: str = "full"
+
+# Longest side "reduced" images are downscaled to
+reduced_dimension: int = 1280
+
+
+def MaxDimension() -> int:
+    """Longest side gallery images are downscaled to under the configured tier."""
+    if tier == "reduced" and ImageProcess.max_dimension:
+        return min(ImageProcess.max_dimension, reduced_dimension)
+    if tier == "reduced":
+        return reduced_dimension
+    return ImageProcess.max_dimension
+
+
+def ThumbURL(url: str) -> str:
+    """Maps a full size i.nhentai.net page URL to its t.nhentai.net preview."""
+    return re.sub(
+        r"//i(\d*)\.nhentai\.net/(.*/)(\d+)\.(\w+)$", r"//t\1.nhentai.net/\2\3t.\4", url
+    )
+
 
 class Nhentai:
     title: str
@@ -26,7 +50,8 @@ class Nhentai:
     hasimages: bool
     isize: int
     duplicate: bool
-    queue: queue.Queue[Any]
+    downloads: List["Future[Optional[str]]"]
+    staged: Staging.Manifest
 
     def requestPage(self, url: str) -> Optional[requests.Response]:
         return Common.RequestPage(url)
@@ -46,7 +71,8 @@ class Nhentai:
         self.hasimages = True
         self.isize = 0
         self.duplicate = False
-        self.queue = queue.Queue()
+        self.downloads = []
+        self.staged = Staging.Manifest()
 
         page = self.requestPage(url)
 
@@ -82,28 +108,52 @@ class Nhentai:
         ):
             self.pbar = Common.Progress(self.isize)
 
-        for i in soup.find_all("a", attrs={"rel": "nofollow"}):
-            href = i.get("href")
-            if isinstance(href, str):
-                self.GetURLS(href)
-                break
+        # the gallery page already links every preview, so no reader page is needed
+        if tier == "thumbnail":
+            self.images = self.Thumbnails(soup)
+        if not self.images:
+            for i in soup.find_all("a", attrs={"rel": "nofollow"}):
+                href = i.get("href")
+                if isinstance(href, str):
+                    self.GetURLS(href)
+                    break
+            if tier == "thumbnail":
+                self.images = [ThumbURL(image) for image in self.images]
         self.AddPage()
 
-        if (
-            Common.opf is not None
-            and any(x in ("txt", "html", "TXT", "HTML") for x in Common.opf)
-            and Common.mt
-        ):
-            for _ in range(0, len(self.images)):
-                self.queue.get()
+        # wait for the pooled downloads in page order
+        for download in self.downloads:
+            download.result()
 
         if self.pbar is not None:
             self.pbar.End()
 
+        if Common.opf is not None and any(
+            x in ("html", "HTML", "txt", "TXT") for x in Common.opf
+        ):
+            target_dir = os.path.join(Common.wd, Common.sanitize_filename(self.title))
+            paths = [
+                os.path.join(target_dir, Common.ImageName(i, self.isize))
+                for i in range(1, len(self.images) + 1)
+            ]
+            ImageProcess.ProcessAll(paths, MaxDimension())
+            Common.imageSources.Finish(target_dir, zip(paths, self.images, strict=True))
+
         # Adhere to SiteProvider protocol
         for html_content in self.truestoryhttml:
             self.rawstoryhtml.append(BeautifulSoup(html_content, "html.parser"))
 
+    def Thumbnails(self, soup: BeautifulSoup) -> List[str]:
+        """Preview URLs from the gallery page, or none unless every page has one."""
+        thumbs = []
+        for link in soup.find_all("a", attrs={"rel": "nofollow"}):
+            img = link.find("img") if isinstance(link, Tag) else None
+            if isinstance(img, Tag):
+                src = img.get("data-src") or img.get("src")
+                if isinstance(src, str) and src.startswith("http"):
+                    thumbs.append(src)
+        return thumbs if len(thumbs) == self.isize else []
+
     def GetURLS(self, url: str) -> None:
         page = self.requestPage("https://nhentai.net" + url.rstrip())
 
@@ -153,20 +203,18 @@ class Nhentai:
             if Common.opf is not None and any(
                 x in ("html", "HTML", "txt", "TXT") for x in Common.opf
             ):
+                Common.PrefetchImage(
+                    thisimage, Common.ImagePath(self.title, i, self.isize, True)
+                )
                 if Common.mt:
-                    t = threading.Thread(
-                        target=Common.imageDL,
-                        args=(
-                            self.title,
-                            thisimage,
-                            i,
-                            self.isize,
-                            self.pbar,
-                            self.queue,
-                        ),
-                        daemon=False,
+                    self.downloads.append(
+                        Staging.pool.Submit(self.DownloadImage, thisimage, i)
                     )
-                    t.start()
                 else:
-                    Common.imageDL(self.title, thisimage, i, self.isize, self.pbar)
+                    self.DownloadImage(thisimage, i)
             i += 1
+
+    def DownloadImage(self, url: str, num: int) -> Optional[str]:
+        path = Common.imageDL(self.title, url, num, self.isize, self.pbar)
+        self.staged.Record(url, path)
+        return path
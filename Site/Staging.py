@@ -0,0 +1,179 @@
+import collections
+import functools
+import os
+import shutil
+import tempfile
+import threading
+import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+from Site import Common
+
+T = TypeVar("T")
+
+# Image downloads running at once across every story
+workers: int = 8
+
+# Image downloads running at once against a single host
+per_host: int = 4
+
+
+class ImagePool:
+    """Bounded image download executor shared by every story in a run.
+
+    At most workers downloads run at once, and at most per_host of them
+    against any one host, however many galleries or stories are queued.
+    Downloads wait in a queue for their host and only reach the executor
+    once it has a free slot, so a busy host never keeps a worker from
+    another host's downloads.
+    """
+
+    executor: Optional[ThreadPoolExecutor]
+    pending: Dict[str, Deque[Callable[[], None]]]
+    running: Dict[str, int]
+    lock: threading.RLock
+
+    def __init__(self) -> None:
+        self.executor = None
+        self.pending = {}
+        self.running = {}
+        # re-entered when a download is already done as it is handed over
+        self.lock = threading.RLock()
+
+    def Submit(self, fn: Callable[..., T], url: str, *args: Any) -> "Future[T]":
+        """Runs fn(url, *args) on the pool once url's host has a free slot."""
+        future: "Future[T]" = Future()
+        host = urllib.parse.urlparse(url).netloc
+        with self.lock:
+            queue = self.pending.setdefault(host, collections.deque())
+            queue.append(functools.partial(Deliver, future, fn, url, *args))
+            self.Start(host)
+        return future
+
+    def Start(self, host: str) -> None:
+        """Hands host's queued downloads to the executor while it has free slots.
+
+        Called with lock held.
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="image"
+            )
+        queue = self.pending[host]
+        while queue and self.running.get(host, 0) < per_host:
+            self.running[host] = self.running.get(host, 0) + 1
+            done = functools.partial(self.Release, host)
+            self.executor.submit(queue.popleft()).add_done_callback(done)
+        if not queue:
+            # may already be gone if a download finished as it was handed over
+            self.pending.pop(host, None)
+
+    def Release(self, host: str, finished: "Future[None]") -> None:
+        with self.lock:
+            self.running[host] -= 1
+            if host in self.pending:
+                self.Start(host)
+
+    def Shutdown(self) -> None:
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+def Deliver(future: "Future[T]", fn: Callable[..., T], url: str, *args: Any) -> None:
+    """Runs fn(url, *args) for a queued download, unless it was cancelled while queued."""
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        future.set_result(fn(url, *args))
+    except BaseException as e:
+        future.set_exception(e)
+
+
+pool: ImagePool = ImagePool()
+
+
+class Manifest:
+    """Local copies of a story's images, keyed by source URL.
+
+    The provider records each image it saves for html/txt output, and the
+    EPUB writer packages those files instead of downloading them again.
+    """
+
+    paths: Dict[str, str]
+    lock: threading.Lock
+
+    def __init__(self) -> None:
+        self.paths = {}
+        self.lock = threading.Lock()
+
+    def Record(self, url: str, path: Optional[str]) -> None:
+        if path is not None:
+            with self.lock:
+                self.paths[url] = path
+
+    def Path(self, url: str) -> Optional[str]:
+        with self.lock:
+            path = self.paths.get(url)
+        if path is not None and os.path.isfile(path):
+            return path
+        return None
+
+
+class Prefetch:
+    """Images downloading into a staging directory ahead of packaging."""
+
+    directory: str
+    entries: List[Tuple[str, str, "Future[bool]"]]
+    reused: Set[str]
+
+    def __init__(
+        self,
+        images: List[Tuple[str, str]],
+        parent: str,
+        staged: Optional[Manifest] = None,
+    ) -> None:
+        """Starts downloading (name, url) pairs; name is where the image is packaged.
+
+        Images already in staged are packaged from their local copy instead.
+        """
+        self.directory = tempfile.mkdtemp(dir=parent)
+        self.entries = []
+        self.reused = set()
+        for name, url in images:
+            path = staged.Path(url) if staged is not None else None
+            if path is not None:
+                self.reused.add(path)
+                done: "Future[bool]" = Future()
+                done.set_result(True)
+                self.entries.append((name, path, done))
+                continue
+            path = os.path.join(self.directory, str(len(self.entries)) + ".img")
+            Common.PrefetchImage(url, path)
+            self.entries.append((name, path, pool.Submit(Common.SaveImage, url, path)))
+
+    def Results(self) -> Iterator[Tuple[str, str]]:
+        """Yields (name, staged path) in the original order as each download finishes."""
+        for name, path, future in self.entries:
+            try:
+                if future.result():
+                    yield name, path
+            except Exception as e:
+                Common.prnt("Could not download image " + name + ": " + str(e))
+
+    def Close(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+        Common.imageSources.Forget(self.directory)
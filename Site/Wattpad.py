@@ -82,6 +82,11 @@ class Wattpad:
         toc_ul = soup.find("ul", attrs={"class": "table-of-contents"})
         if isinstance(toc_ul, Tag):
             self.length = len(toc_ul.find_all("li"))
+            Common.transport.Prefetch(
+                href
+                for href in (a.get("href") for a in toc_ul.find_all("a"))
+                if isinstance(href, str) and href.startswith("http") and href != url
+            )
 
         self.pbar = Common.Progress(self.length)
         if self.pbar:
@@ -6,4 +6,9 @@ __all__ = [
     "Wattpad",
     "Nhentai",
     "Common",
+    "AsyncEngine",
+    "Cache",
+    "ImageStore",
+    "ImageProcess",
+    "Staging",
 ]
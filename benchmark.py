@@ -0,0 +1,777 @@
+import argparse
+import contextlib
+import http.server
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import requests
+from bs4 import BeautifulSoup, Tag
+
+from Site import AsyncEngine, ChapterStore, Chyoa, Common, ImageProcess, Staging
+
+
+def bench_images(directory: str, max_dimension: int, quality: int) -> None:
+    """Recompresses a copy of every image in directory, reporting MB saved and images/s."""
+    if ImageProcess.Image is None:
+        print("Pillow is not installed: pip install pillow")
+        sys.exit(1)
+    staging = tempfile.mkdtemp()
+    try:
+        paths = []
+        for name in sorted(os.listdir(directory)):
+            source = os.path.join(directory, name)
+            if os.path.isfile(source):
+                paths.append(shutil.copy(source, os.path.join(staging, name)))
+        ImageProcess.max_dimension = max_dimension
+        ImageProcess.quality = quality
+        before, after, seconds = ImageProcess.ProcessAll(paths)
+    finally:
+        ImageProcess.pool.Shutdown()
+        shutil.rmtree(staging, ignore_errors=True)
+    print(f"Images:    {len(paths)}")
+    print(f"Before:    {before / 1048576:.1f} MB")
+    print(f"After:     {after / 1048576:.1f} MB")
+    print(f"Saved:     {(before - after) / 1048576:.1f} MB")
+    if seconds > 0:
+        print(f"Rate:      {len(paths) / seconds:.1f} images/s")
+
+
+def synthetic_chyoa(
+    chapters: int, seed: int = 1
+) -> Tuple[List[str], List[str], List[str], List[str], List[str]]:
+    """Chapter titles, authors, HTML and EPUB chapters and immersion names of a fake story."""
+    rnd = random.Random(seed)
+    renames = ["Alice", "Bob"]
+    titles, authors, temp, epubtemp = [], [], [], []
+    for i in range(chapters):
+        label = ".".join(str(rnd.randint(1, 3)) for _ in range(rnd.randint(1, 8)))
+        body = "".join(
+            "<p>Paragraph %d of chapter %d, where\n"
+            '  <span class="js-immersion-receiver-c%d">\n   Name\n  </span>\n'
+            "  says something.</p>\n" % (p, i, rnd.randint(0, 1))
+            for p in range(rnd.randint(2, 12))
+        )
+        content = (
+            '<div id="'
+            + label
+            + '"><div class="chapter-content">'
+            + body
+            + "</div><h2>What now?</h2>\n</div><br />"
+        )
+        links = "".join(
+            '\n<a href="%s%s.%d">Choice %d</a>\n<br />' % ("%s", label, j, j)
+            for j in range(1, rnd.randint(1, 4))
+        )
+        titles.append("Chapter %d" % i)
+        authors.append("Author%d" % (i % 7))
+        temp.append(content + links.replace("%s", "#"))
+        epubtemp.append(content + links.replace("%s", "nfChapter"))
+    return titles, authors, temp, epubtemp, renames
+
+
+def legacy_render_story(
+    chapters: List[str],
+    authors: List[str],
+    temp: List[str],
+    epubtemp: List[str],
+    renames: List[str],
+) -> Tuple[List[Tag], List[Tag], str]:
+    """The Chyoa post-processing RenderEntry replaced, kept for comparison."""
+    temp, epubtemp = list(temp), list(epubtemp)
+    rawstoryhtml: List[Tag] = []
+    epubrawstoryhtml: List[Tag] = []
+    truestoryhttml, epubtruestoryhttml = [], []
+    story = ""
+    for i in range(len(temp)):
+        temp[i] = "\n<h4>by " + authors[i] + "</h4>" + temp[i]
+        epubtemp[i] = "\n<h4>by " + authors[i] + "</h4>" + epubtemp[i]
+        rawstoryhtml.append(BeautifulSoup(temp[i], "html.parser"))
+        epubrawstoryhtml.append(BeautifulSoup(epubtemp[i], "html.parser"))
+    for i_tag in rawstoryhtml:
+        for j in range(len(renames)):
+            for k in i_tag.find_all(
+                "span", attrs={"class": "js-immersion-receiver-c" + str(j)}
+            ):
+                k.string = renames[j]
+        story += chapters[rawstoryhtml.index(i_tag)] + i_tag.get_text()
+        truestoryhttml.append(str(i_tag))
+    for i_tag in epubrawstoryhtml:
+        for j in range(len(renames)):
+            for l_tag in i_tag.find_all(
+                "span", attrs={"class": "js-immersion-receiver-c" + str(j)}
+            ):
+                l_tag.string = renames[j]
+        epubtruestoryhttml.append(str(i_tag))
+    for pages, indent in ((truestoryhttml, "  "), (epubtruestoryhttml, " ")):
+        for i in range(len(pages)):
+            pages[i] = pages[i].replace("\n" + indent + "<span", "<span")
+            pages[i] = pages[i].replace("<span", " <span")
+            for j_name in renames:
+                pages[i] = pages[i].replace("\n   " + j_name + "\n", j_name)
+            pages[i] = pages[i].replace("  </span>\n  ", "</span> ")
+    for i in range(len(truestoryhttml)):
+        rawstoryhtml[i] = BeautifulSoup(truestoryhttml[i], "html.parser")
+    for i in range(len(epubtruestoryhttml)):
+        epubrawstoryhtml[i] = BeautifulSoup(epubtruestoryhttml[i], "html.parser")
+    return rawstoryhtml, epubrawstoryhtml, story
+
+
+def bench_chyoa_render(chapters: int, legacy: bool) -> None:
+    """Times Chyoa's chapter rendering on a synthetic story, against the old code if asked."""
+    titles, authors, temp, epubtemp, renames = story = synthetic_chyoa(chapters)
+    store = ChapterStore.ChapterStore()
+    begin = time.perf_counter()
+    for i in range(chapters):
+        store.Append(
+            *Chyoa.RenderEntry(titles[i], authors[i], temp[i], epubtemp[i], renames)
+        )
+    seconds = time.perf_counter() - begin
+    print(f"Chapters:  {chapters}")
+    print(f"Render:    {seconds:.2f}s ({chapters / seconds:.0f} chapters/s)")
+    if not legacy:
+        store.Close()
+        return
+    begin = time.perf_counter()
+    expected = legacy_render_story(*story)
+    legacySeconds = time.perf_counter() - begin
+    print(
+        f"Legacy:    {legacySeconds:.2f}s ({chapters / legacySeconds:.0f} chapters/s)"
+    )
+    print(f"Speedup:   {legacySeconds / seconds:.1f}x")
+    same = (
+        [store.Html(i) for i in range(chapters)] == [str(tag) for tag in expected[0]]
+        and [store.Epub(i) for i in range(chapters)]
+        == [str(tag) for tag in expected[1]]
+        and "".join(store.Texts()) == expected[2].replace("\n", Common.lineEnding)
+    )
+    store.Close()
+    print("Output:    " + ("identical" if same else "DIFFERS"))
+    if not same:
+        sys.exit(1)
+
+
+class NotModified(Common.Transport):
+    """Answers every request with 304, so a crawl rebuilds pages from its records."""
+
+    def Get(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        cookies: Optional[Dict[str, str]] = None,
+        **kwargs: Any,
+    ) -> requests.Response:
+        return Common.BuildResponse(url, 304, {}, b"")
+
+
+def synthetic_graph(nodes: int, seed: int = 1) -> Dict[str, Dict[str, Any]]:
+    """Story graph records for a random tree of nodes chapters, keyed like a saved graph."""
+    rnd = random.Random(seed)
+    urls = ["https://chyoa.com/story/Story.1"] + [
+        "https://chyoa.com/chapter/Chapter-%d.%d" % (i, i + 1) for i in range(1, nodes)
+    ]
+    kids: List[List[int]] = [[] for _ in range(nodes)]
+    depth = [1] * nodes
+    for i in range(1, nodes):
+        parent = rnd.randrange(max(0, i - 1000), i)
+        kids[parent].append(i)
+        depth[i] = depth[parent] + 1
+    records = {}
+    for i in range(nodes):
+        links = [urls[k] for k in kids[i]]
+        if i > 1 and rnd.random() < 0.05:
+            # a choice leading back to an earlier chapter
+            links.append(urls[rnd.randrange(1, i)])
+        records[Chyoa.ChapterKey(urls[i])] = {
+            "url": urls[i],
+            "depth": "",
+            "links": links,
+            "choices": ["Choice %d" % j for j in range(len(links))],
+            "hash": "%064x" % i,
+            "author": "Author%d" % rnd.randrange(50),
+            "chapter": "Chapter %d" % i,
+            "question": "What's next?",
+            "content": "",
+            "chapNum": depth[i],
+            "prevId": None,
+            "hasimages": False,
+            "etag": '"%x"' % i,
+        }
+    return records
+
+
+class LegacyPage:
+    """A crawl node as Chyoa kept it before nodes were compacted, kept for comparison.
+
+    A plain object with every attribute the old Page had, filled in from a
+    record the way its Restore did.
+    """
+
+    def __init__(
+        self, url: str, renames: List[str], oldnames: List[str], ogUrl: str
+    ) -> None:
+        self.url = url
+        self.key = Chyoa.ChapterKey(url)
+        self.id = urllib.parse.urlparse(url)[2].split(".")[-1]
+        self.prevId: Optional[str] = None
+        self.chapNum = 0
+        self.author = ""
+        self.chapter = ""
+        self.question = ""
+        self.content = ""
+        self.hasimages = False
+        self.rawChoices: List[str] = []
+        self.choices: List[str] = []
+        self.links: List[str] = []
+        self.hash = ""
+        self.validators: Dict[str, str] = {}
+        self.restored = False
+        self.children: List[Optional["LegacyPage"]] = []
+        self.parents: List["LegacyPage"] = []
+        self.parent: Optional["LegacyPage"] = None
+        self.label = ""
+        self.fetched = False
+        self.expanded = False
+        self.renames = renames
+        self.oldnames = oldnames
+        self.ogUrl = ogUrl
+
+    def Restore(self, record: Dict[str, Any]) -> None:
+        self.hash = record["hash"]
+        self.author = record["author"]
+        self.chapter = record["chapter"]
+        self.question = record["question"]
+        self.content = record["content"]
+        self.chapNum = record["chapNum"]
+        self.prevId = record["prevId"]
+        self.hasimages = Common.images and record["hasimages"]
+        for name in ("etag", "modified"):
+            if name in record:
+                self.validators[name] = record[name]
+        for text, href in zip(record["choices"], record["links"], strict=True):
+            self.rawChoices.append(text)
+            link = text
+            for i in range(len(self.renames)):
+                link = link.replace(self.oldnames[i], self.renames[i])
+            self.choices.append(link)
+            self.links.append(href)
+        self.restored = True
+        self.fetched = True
+
+
+def legacy_crawl(
+    intro: str, records: Dict[str, str]
+) -> Tuple[Dict[str, LegacyPage], Dict[str, int], List[LegacyPage]]:
+    """The old Crawl over JSON records: its visited map, label ids and placed pages."""
+    renames: List[str] = []
+    oldnames: List[str] = []
+    start = LegacyPage(intro, renames, oldnames, intro)
+    start.Restore(json.loads(records[start.key]))
+    visited = {start.key: start}
+    frontier: List[LegacyPage] = []
+
+    def follows(parent: LegacyPage, page: LegacyPage) -> bool:
+        if page.chapNum <= parent.chapNum:
+            return False
+        return parent is start or page.prevId is None or page.prevId == parent.id
+
+    def expand(page: LegacyPage, parent: Optional[LegacyPage]) -> None:
+        page.parent = parent
+        page.expanded = True
+        stack = [page]
+        while stack:
+            node = stack.pop()
+            for link in node.links:
+                if not link:
+                    node.children.append(None)
+                    continue
+                key = Chyoa.ChapterKey(link)
+                child = visited.get(key)
+                if child is None:
+                    child = LegacyPage(link, renames, oldnames, intro)
+                    visited[key] = child
+                    frontier.append(child)
+                elif child.fetched and not child.expanded and follows(node, child):
+                    child.parent = node
+                    child.expanded = True
+                    stack.append(child)
+                child.parents.append(node)
+                node.children.append(child)
+
+    expand(start, None)
+    done = 0
+    while done < len(frontier):
+        page = frontier[done]
+        done += 1
+        page.Restore(json.loads(records[page.key]))
+        for parent in page.parents:
+            if follows(parent, page):
+                expand(page, parent)
+                break
+    ids: Dict[str, int] = {}
+    order: List[LegacyPage] = []
+    places: List[Tuple[LegacyPage, int]] = [(start, 0)]
+    while places:
+        node, j = places.pop()
+        if j >= len(node.children):
+            continue
+        places.append((node, j + 1))
+        child = node.children[j]
+        if child is None or child is start or child.label or not child.fetched:
+            continue
+        if child.expanded and child.parent is not node:
+            continue
+        child.parent = node
+        child.label = str(j + 1) if node is start else node.label + "." + str(j + 1)
+        ids[child.label] = len(order)
+        order.append(child)
+        if child.expanded:
+            places.append((child, 0))
+    return visited, ids, order
+
+
+def bench_chyoa_nodes(nodes: int, legacy: bool) -> None:
+    """Crawls a synthetic story from graph records and reports memory per crawl node.
+
+    With legacy, the same records are also crawled into the old node shape.
+    """
+    intro = "https://chyoa.com/story/Story.1"
+    records = synthetic_graph(nodes)
+    first = dict(records[Chyoa.ChapterKey(intro)])
+    # read back one chapter at a time, as the old crawl restored them
+    encoded = (
+        {key: json.dumps(record) for key, record in records.items()} if legacy else {}
+    )
+    directory = tempfile.mkdtemp(prefix="chyoa-nodes-")
+    graph = Chyoa.StoryGraph(os.path.join(directory, "Story.chyoa.db"))
+    graph.Write(
+        intro,
+        ((key, record, record.pop("content")) for key, record in records.items()),
+    )
+    del records
+    Common.transport = NotModified()
+    Common.rateLimiter.Configure(None, 0, 1)
+    Common.quiet = True
+    store = ChapterStore.ChapterStore()
+    tracemalloc.start()
+    begin = time.perf_counter()
+    crawl = Chyoa.Crawl(1, store, None, graph)
+    start = Chyoa.Page(intro)
+    start.Restore(first)
+    crawl.Run(start)
+    placed = crawl.Place()
+    seconds = time.perf_counter() - begin
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    store.Close()
+    graph.Close()
+    shutil.rmtree(directory, ignore_errors=True)
+    print(f"Nodes:     {crawl.pages + 1} ({len(placed)} placed)")
+    print(f"Crawl:     {seconds:.2f}s")
+    print(
+        f"Memory:    {size / 1048576:.1f} MB ({size / (crawl.pages + 1):.0f} bytes/node)"
+    )
+    print(f"Peak:      {peak / 1048576:.1f} MB")
+    if not legacy:
+        return
+    tracemalloc.start()
+    visited, ids, order = legacy_crawl(intro, encoded)
+    legacySize, legacyPeak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"Legacy:    {legacySize / 1048576:.1f} MB"
+        f" ({legacySize / len(visited):.0f} bytes/node, {len(order)} placed)"
+    )
+    print(f"Saved:     {100 * (1 - size / legacySize):.0f}%")
+    if len(order) != len(placed):
+        print("Placed:    DIFFERS")
+        sys.exit(1)
+
+
+class StoryServer(Common.Transport):
+    """Serves the pages of a synthetic Chyoa story, each after latency seconds."""
+
+    pages: Dict[str, str]
+    latency: float
+
+    def __init__(self, pages: Dict[str, str], latency: float) -> None:
+        super().__init__()
+        self.pages = pages
+        self.latency = latency
+
+    def Get(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        cookies: Optional[Dict[str, str]] = None,
+        **kwargs: Any,
+    ) -> requests.Response:
+        time.sleep(self.latency)
+        page = self.pages.get(url)
+        if page is None:
+            return Common.BuildResponse(url, 404, {}, b"")
+        return Common.BuildResponse(
+            url, 200, {"Content-Type": "text/html; charset=utf-8"}, page.encode()
+        )
+
+
+def synthetic_story(
+    chapters: int, seed: int = 1, base: str = "https://chyoa.com"
+) -> Tuple[str, Dict[str, str]]:
+    """URL of a chapter midway through a random Chyoa story, and the story's pages.
+
+    The chapter is the one three levels down with the most chapters below it.
+    The story's intro is base + "/story/Story.1".
+    """
+    rnd = random.Random(seed)
+    urls = [base + "/story/Story.1"] + [
+        base + "/chapter/Chapter-%d.%d" % (i, i + 1) for i in range(1, chapters)
+    ]
+    parent = [0] * chapters
+    level = [1] * chapters
+    kids: List[List[int]] = [[] for _ in range(chapters)]
+    for i in range(1, chapters):
+        parent[i] = rnd.randrange(max(0, i - 200), i)
+        level[i] = level[parent[i]] + 1
+        kids[parent[i]].append(i)
+    below = [1] * chapters
+    for i in range(chapters - 1, 0, -1):
+        below[parent[i]] += below[i]
+    pages = {}
+    for i in range(chapters):
+        links = [urls[k] for k in kids[i]]
+        if i > 1 and rnd.random() < 0.05:
+            # a choice leading back to an earlier chapter
+            links.append(urls[rnd.randrange(1, i)])
+        pages[urls[i]] = (
+            "<html><body>"
+            + ("<h3>Story</h3>" if i else "")
+            + "<h1>Chapter %d</h1>" % i
+            + '<p class="meta">Chapter %d by <a href="/user/a">Author%d</a></p>'
+            % (level[i], i % 7)
+            + '<div class="chapter-content"><p>Chapter %d.</p></div>' % i
+            + '<header class="question-header">What now?</header>'
+            + '<div class="question-content">'
+            + "".join(
+                '<a href="%s">Choice %d</a>' % (link, j) for j, link in enumerate(links)
+            )
+            + "</div>"
+            + (
+                '<span class="controls-left"><a href="%s">Previous Chapter</a></span>'
+                % urls[parent[i]]
+                if i
+                else ""
+            )
+            + "</body></html>"
+        )
+    mid = [i for i in range(chapters) if level[i] == 3]
+    start = max(mid, key=lambda i: below[i]) if mid else 0
+    return urls[start], pages
+
+
+def crawl_partial(url: str, threads: bool) -> Tuple[float, List[Any]]:
+    """Seconds taken to download the story from url, and everything it produced."""
+    Common.mt = threads
+    begin = time.perf_counter()
+    site = Chyoa.Chyoa(url)
+    seconds = time.perf_counter() - begin
+    count = len(site.store)
+    output = [
+        site.partialStart,
+        site.chapters,
+        site.authors,
+        site.questions,
+        site.depth,
+        [site.store.Html(i) for i in range(count)],
+        [site.store.Epub(i) for i in range(count)],
+        list(site.store.Texts()),
+    ]
+    site.store.Close()
+    return seconds, output
+
+
+def bench_chyoa_partial(chapters: int, latency: float, threads: int) -> None:
+    """Downloads a story from a mid-story chapter serially and with threads, checking both match."""
+    url, pages = synthetic_story(chapters)
+    Common.transport = StoryServer(pages, latency)
+    Common.rateLimiter.Configure(None, 0, 1)
+    Common.quiet = True
+    Common.chyoa_force_forwards = True
+    Common.opf = ("html", "epub")
+    Chyoa.workers = threads
+    serialSeconds, serial = crawl_partial(url, False)
+    seconds, parallel = crawl_partial(url, True)
+    print(f"Chapters:  {len(serial[1])} of {chapters}, from {url}")
+    print(f"Serial:    {serialSeconds:.2f}s")
+    print(f"Threads:   {seconds:.2f}s ({threads} workers)")
+    print(f"Speedup:   {serialSeconds / seconds:.1f}x")
+    same = serial == parallel
+    print("Output:    " + ("identical" if same else "DIFFERS"))
+    if not same:
+        sys.exit(1)
+
+
+class LocalServer(http.server.ThreadingHTTPServer):
+    """Stand-in for a story site on a loopback port, serving pages by path.
+
+    Each reply is held back latency seconds, like a distant server.
+    """
+
+    request_queue_size = 4096
+    daemon_threads = True
+    pages: Dict[str, bytes]
+    latency: float
+
+    def __init__(self, pages: Dict[str, bytes], latency: float) -> None:
+        super().__init__(("127.0.0.1", 0), PageHandler)
+        self.pages = pages
+        self.latency = latency
+
+
+class PageHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: LocalServer
+
+    def do_GET(self) -> None:
+        time.sleep(self.server.latency)
+        body = self.server.pages.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+@contextlib.contextmanager
+def allow_hosts(*hosts: str) -> Iterator[None]:
+    """Wraps is_safe_url to let through the local servers started here, and no other."""
+    safe = Common.is_safe_url
+
+    def is_safe_url(url: str) -> bool:
+        return urllib.parse.urlparse(url).netloc in hosts or safe(url)
+
+    Common.is_safe_url = is_safe_url
+    try:
+        yield
+    finally:
+        Common.is_safe_url = safe
+
+
+def crawl_stories(
+    urls: List[str], run: Any, workers: int
+) -> Tuple[float, Dict[str, List[Any]]]:
+    """Seconds taken to download every story with run, and what each produced."""
+    output: Dict[str, List[Any]] = {}
+
+    def work(url: str) -> None:
+        site = Chyoa.Chyoa(url)
+        count = len(site.store)
+        output[url] = [site.chapters, [site.store.Html(i) for i in range(count)]]
+        site.store.Close()
+
+    begin = time.perf_counter()
+    run(urls, work, workers)
+    return time.perf_counter() - begin, output
+
+
+def run_threads(urls: List[str], work: Any, workers: int) -> None:
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(work, urls))
+
+
+def bench_engine(
+    stories: int, chapters: int, latency: float, workers: int, inflight: int
+) -> None:
+    """Downloads Chyoa stories from a local server with threads and the async engine.
+
+    Both must produce the same chapters.
+    """
+    pages: Dict[str, bytes] = {}
+    server = LocalServer(pages, latency)
+    host = "127.0.0.1:%d" % server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    urls = []
+    for k in range(stories):
+        base = "http://%s/%d" % (host, k)
+        story = synthetic_story(chapters, k + 1, base)[1]
+        for url, page in story.items():
+            pages[urllib.parse.urlparse(url).path] = page.encode()
+        urls.append(base + "/story/Story.1")
+    Common.rateLimiter.Configure(None, 0, 1)
+    Common.quiet = True
+    Common.mt = True
+    Common.chyoa_force_forwards = True
+    Common.opf = ("html",)
+    try:
+        with allow_hosts(host):
+            Common.transport = Common.Transport(workers * Chyoa.workers)
+            threadSeconds, threaded = crawl_stories(urls, run_threads, workers)
+            engine = AsyncEngine.AsyncTransport(inflight, inflight)
+            Common.transport = engine
+            try:
+                seconds, fetched = crawl_stories(urls, engine.Run, workers)
+            finally:
+                engine.Close()
+    finally:
+        server.shutdown()
+    print(f"Stories:   {stories} of {chapters} chapters, from {host}")
+    print(f"Threads:   {threadSeconds:.2f}s ({workers} stories at once)")
+    print(f"Async:     {seconds:.2f}s ({workers} parsers)")
+    print(f"In flight: {engine.peak} at most (limit {inflight})")
+    print(f"Speedup:   {threadSeconds / seconds:.1f}x")
+    same = threaded == fetched and len(fetched) == stories
+    print("Output:    " + ("identical" if same else "DIFFERS"))
+    if not same:
+        sys.exit(1)
+
+
+def bench_image_hosts(images: int, latency: float, workers: int, per_host: int) -> None:
+    """Saves images from two local hosts through the shared image pool.
+
+    Every image from the first host is queued before any from the second,
+    which must still get its first image before half of the first host's
+    rather than waiting behind them for a worker.
+    """
+    Staging.workers = workers
+    Staging.per_host = per_host
+    Common.rateLimiter.Configure(None, 0, 1)
+    Common.quiet = True
+    Common.transport = Common.Transport(workers)
+    servers = []
+    for _ in range(2):
+        server = LocalServer(
+            {"/%d.jpg" % i: bytes(1024) for i in range(images)}, latency
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    hosts = ["127.0.0.1:%d" % server.server_address[1] for server in servers]
+    finished: Dict[str, List[float]] = {host: [] for host in hosts}
+    directory = tempfile.mkdtemp()
+    begin = time.perf_counter()
+
+    def save(url: str, path: str) -> bool:
+        saved = Common.SaveImage(url, path)
+        host = urllib.parse.urlparse(url).netloc
+        finished[host].append(time.perf_counter() - begin)
+        return saved
+
+    try:
+        with allow_hosts(*hosts):
+            futures = [
+                Staging.pool.Submit(
+                    save,
+                    "http://%s/%d.jpg" % (host, i),
+                    os.path.join(directory, "%d-%d.jpg" % (k, i)),
+                )
+                for k, host in enumerate(hosts)
+                for i in range(images)
+            ]
+            saved = sum(future.result() for future in futures)
+    finally:
+        Staging.pool.Shutdown()
+        for server in servers:
+            server.shutdown()
+        shutil.rmtree(directory)
+    first, second = (finished[host] for host in hosts)
+    print(f"Images:    {images} from each of 2 hosts, {latency}s per image")
+    print(f"Pool:      {workers} workers, {per_host} per host")
+    print(f"First:     done from {min(first):.2f}s to {max(first):.2f}s")
+    print(f"Second:    done from {min(second):.2f}s to {max(second):.2f}s")
+    ahead = sum(done < min(second) for done in first)
+    print(f"Ahead:     {ahead} of the first host's images before the second's first")
+    concurrent = ahead < images / 2
+    print("Hosts:     " + ("concurrent" if concurrent else "ONE AFTER THE OTHER"))
+    if saved != 2 * images or not concurrent:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ebook-Publisher benchmarks.")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    images = sub.add_parser("images", help="Image recompression stage")
+    images.add_argument("dir", help="Directory of downloaded images")
+    images.add_argument("--max-size", type=int, default=1600)
+    images.add_argument("--quality", type=int, default=80)
+
+    render = sub.add_parser(
+        "chyoa-render", help="Chyoa chapter rendering after the crawl"
+    )
+    render.add_argument("--chapters", type=int, default=10000)
+    render.add_argument(
+        "--legacy",
+        action="store_true",
+        help="Also time the old multi-pass rendering and check the output matches",
+    )
+
+    nodes = sub.add_parser("chyoa-nodes", help="Memory held per Chyoa crawl node")
+    nodes.add_argument("--nodes", type=int, default=100000)
+    nodes.add_argument(
+        "--legacy",
+        action="store_true",
+        help="Also crawl into the old node shape and compare the memory held",
+    )
+
+    partial = sub.add_parser(
+        "chyoa-partial",
+        help="Chyoa download from a mid-story chapter, serial against threaded",
+    )
+    partial.add_argument("--chapters", type=int, default=1000)
+    partial.add_argument(
+        "--latency", type=float, default=0.02, help="Seconds per simulated request"
+    )
+    partial.add_argument("--workers", type=int, default=8)
+
+    engine = sub.add_parser(
+        "engine",
+        help="Chyoa stories from a local server, threads against --engine async",
+    )
+    engine.add_argument("--stories", type=int, default=50)
+    engine.add_argument("--chapters", type=int, default=100)
+    engine.add_argument(
+        "--latency", type=float, default=0.2, help="Seconds the server takes per page"
+    )
+    engine.add_argument("--workers", type=int, default=8)
+    engine.add_argument("--max-inflight", type=int, default=1000)
+
+    hosts = sub.add_parser(
+        "image-hosts",
+        help="Image pool downloads from two local hosts, queued one after the other",
+    )
+    hosts.add_argument("--images", type=int, default=16, help="Images per host")
+    hosts.add_argument(
+        "--latency", type=float, default=0.1, help="Seconds the servers take per image"
+    )
+    hosts.add_argument("--workers", type=int, default=4)
+    hosts.add_argument("--per-host", type=int, default=2)
+
+    args = parser.parse_args()
+    if args.bench == "images":
+        bench_images(args.dir, args.max_size, args.quality)
+    elif args.bench == "chyoa-render":
+        bench_chyoa_render(args.chapters, args.legacy)
+    elif args.bench == "chyoa-nodes":
+        bench_chyoa_nodes(args.nodes, args.legacy)
+    elif args.bench == "chyoa-partial":
+        bench_chyoa_partial(args.chapters, args.latency, args.workers)
+    elif args.bench == "engine":
+        bench_engine(
+            args.stories, args.chapters, args.latency, args.workers, args.max_inflight
+        )
+    elif args.bench == "image-hosts":
+        bench_image_hosts(args.images, args.latency, args.workers, args.per_host)
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 import argparse
+import functools
 import getpass
 import os
-import queue
 import sys
 import threading
 import urllib.parse
@@ -10,7 +10,20 @@ from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 from zipfile import ZipFile
 
 from EpubMaker import epub as epub
-from Site import Chyoa, Classicreader, Common, Fanfiction, Literotica, Nhentai, Wattpad
+from Site import (
+    AsyncEngine,
+    Cache,
+    Chyoa,
+    Classicreader,
+    Common,
+    Fanfiction,
+    ImageProcess,
+    ImageStore,
+    Literotica,
+    Nhentai,
+    Staging,
+    Wattpad,
+)
 
 Version = "3.4.0"
 
@@ -34,6 +47,48 @@ formats: Dict[str, Callable[[Common.SiteProvider], None]] = {
 }
 
 
+# Chyoa keeps its chapters on disk, read back one at a time
+def ChapterCount(site: Any) -> int:
+    if isinstance(site, Chyoa.Chyoa):
+        return len(site.store)
+    return len(site.rawstoryhtml)
+
+
+def ChapterHTML(site: Any, i: int) -> Any:
+    if isinstance(site, Chyoa.Chyoa):
+        return site.store.Html(i)
+    return site.rawstoryhtml[i]
+
+
+# Level of the Chyoa chapter at depth label below the start page, like 3 for 1.12.3
+def ChyoaDepth(label: str) -> int:
+    return label.count(".") + 1
+
+
+# Marks a Chyoa chapter in the table of contents if some of its choices were not downloaded
+def ChyoaDangling(site: Any, i: int) -> str:
+    if i >= len(site.dangling) or not site.dangling[i]:
+        return ""
+    return (
+        " ("
+        + str(site.dangling[i])
+        + (" choice" if site.dangling[i] == 1 else " choices")
+        + " not downloaded)"
+    )
+
+
+# EPUB page of chapter i, only read once the book is written
+def EpubChapter(site: Any, i: int, epubLinks: bool) -> str:
+    return (
+        "<h2>\n"
+        + Common.escape_html(site.chapters[i])
+        + "\n</h2>\n"
+        + Common.sanitize_html(
+            site.store.Epub(i) if epubLinks else ChapterHTML(site, i)
+        )
+    )
+
+
 # function for making text files
 def MakeText(site: Common.SiteProvider) -> None:
     if not isinstance(site, Nhentai.Nhentai):
@@ -43,7 +98,11 @@ def MakeText(site: Common.SiteProvider) -> None:
         )
         published.write(site.title + Common.lineEnding)
         published.write("by " + site.author + Common.lineEnding)
-        published.write(site.story)
+        if isinstance(site, Chyoa.Chyoa):
+            for text in site.store.Texts():
+                published.write(text)
+        else:
+            published.write(site.story)
         published.close()
 
 def MakeHTML(site: Any) -> None:
@@ -82,7 +141,7 @@ def MakeHTML(site: Any) -> None:
     if not isinstance(site, (Nhentai.Nhentai, Literotica.Literotica)):
         published.write("<h2>Table of Contents</h2>\n")
         if not isinstance(site, Chyoa.Chyoa):
-            for i in range(len(site.rawstoryhtml)):
+            for i in range(ChapterCount(site)):
                 published.write(
                     '<p><a href="#Chapter ' \
                     + str(i)
@@ -92,24 +151,21 @@ def MakeHTML(site: Any) -> None:
                 )
         elif not site.backwards:
             j = 0
-            for i in range(len(site.rawstoryhtml)):
+            for i in range(ChapterCount(site)):
                 if i != 0:
                     if site.partial:
                         published.write(
                             '<p><a href="#'
                             + str(site.depth[i - 1])
                             + '">'
-                            + str(" _" * int((len(site.depth[i - 1]) / 2) + 1))
+                            + str(" _" * ChyoaDepth(site.depth[i - 1]))
                             + " "
-                            + str(
-                                int(
-                                    (site.partialStart + len(site.depth[i - 1]) / 2) + 1
-                                )
-                            )
+                            + str(site.partialStart + ChyoaDepth(site.depth[i - 1]))
                             + "."
                             + site.depth[i - 1].split(".")[-1]
                             + " "
                             + Common.escape_html(site.chapters[i])
+                            + ChyoaDangling(site, i)
                             + "</a></p>\n"
                         )
                     else:
@@ -117,13 +173,14 @@ def MakeHTML(site: Any) -> None:
                             '<p><a href="#'
                             + str(site.depth[i - 1])
                             + '">'
-                            + str(" _" * int((len(site.depth[i - 1]) / 2) + 1))
+                            + str(" _" * ChyoaDepth(site.depth[i - 1]))
                             + " "
-                            + str(int((len(site.depth[i - 1]) / 2) + 2))
+                            + str(ChyoaDepth(site.depth[i - 1]) + 1)
                             + "."
                             + site.depth[i - 1].split(".")[-1]
                             + " "
                             + Common.escape_html(site.chapters[i])
+                            + ChyoaDangling(site, i)
                             + "</a></p>\n"
                         )
                 else:
@@ -136,6 +193,7 @@ def MakeHTML(site: Any) -> None:
                             + str(j)
                             + ". "
                             + Common.escape_html(site.chapters[i])
+                            + ChyoaDangling(site, i)
                             + "</a></p>\n"
                         )
                         j += 1
@@ -146,10 +204,11 @@ def MakeHTML(site: Any) -> None:
                             + '">'
                             + "1.1 "
                             + Common.escape_html(site.chapters[i])
+                            + ChyoaDangling(site, i)
                             + "</a></p>\n"
                         )
         else:
-            for i in range(len(site.rawstoryhtml)):
+            for i in range(ChapterCount(site)):
                 published.write(
                     '<p><a href="#Chapter ' \
                     + str(i)
@@ -157,7 +216,7 @@ def MakeHTML(site: Any) -> None:
                     + Common.escape_html(site.chapters[i])
                     + "</a></p>\n"
                 )
-    for i in range(len(site.rawstoryhtml)):
+    for i in range(ChapterCount(site)):
         if isinstance(site, Nhentai.Nhentai):
             published.write(Common.sanitize_html(site.truestoryhttml[i]))
         elif isinstance(site, Literotica.Literotica):
@@ -172,7 +231,7 @@ def MakeHTML(site: Any) -> None:
                         + '">'
                         + Common.escape_html(site.chapters[i])
                         + "\n</h2>\n"
-                        + Common.sanitize_html(site.rawstoryhtml[i])
+                        + Common.sanitize_html(ChapterHTML(site, i))
                     )
                 else:
                     published.write(
@@ -181,7 +240,7 @@ def MakeHTML(site: Any) -> None:
                         + '">\n'
                         + Common.escape_html(site.chapters[i])
                         + "\n</h2>\n"
-                        + Common.sanitize_html(site.rawstoryhtml[i])
+                        + Common.sanitize_html(ChapterHTML(site, i))
                     )
             else:
                 published.write(
@@ -190,7 +249,7 @@ def MakeHTML(site: Any) -> None:
                     + '">\n'
                     + Common.escape_html(site.chapters[i])
                     + "\n</h2>\n"
-                    + Common.sanitize_html(site.rawstoryhtml[i])
+                    + Common.sanitize_html(ChapterHTML(site, i))
                 )
     published.write("</html>")
 
@@ -204,6 +263,10 @@ def MakeHTML(site: Any) -> None:
 
 # This function is basically all magic from the docs of EpubMaker
 def MakeEpub(site: Any) -> None:
+    # images download in the background while the chapters are written
+    images = EpubImages(site)
+    prefetch = Staging.Prefetch(images, wd, site.staged) if images else None
+
     book = epub.EpubBook()
     book.set_identifier(Common.escape_html(site.url))
     titlepage = epub.EpubHtml(title="Title Page", file_name="Title.xhtml", lang="en")
@@ -231,7 +294,7 @@ def MakeEpub(site: Any) -> None:
 
     if not isinstance(site, (Literotica.Literotica, Nhentai.Nhentai)):
         toc: List[epub.EpubHtml] = []
-        for i in range(len(site.rawstoryhtml)):
+        for i in range(ChapterCount(site)):
             if isinstance(site, Chyoa.Chyoa) and not site.backwards:
                 if i == 0:
                     c.append(
@@ -239,6 +302,8 @@ def MakeEpub(site: Any) -> None:
                             title=Common.escape_html(site.chapters[i]),
                             file_name="Chapter " + str(i + 1) + ".xhtml",
                             lang="en",
+                            tocTitle=Common.escape_html(site.chapters[i])
+                            + ChyoaDangling(site, i),
                         )
                     )
                 else:
@@ -250,15 +315,14 @@ def MakeEpub(site: Any) -> None:
                                 + str(site.pageIDs[i - 1])
                                 + ".xhtml",
                                 lang="en",
-                                tocTitle=str(
-                                    " _" * int((len(site.depth[i - 1]) / 2) + 1)
-                                )
+                                tocTitle=str(" _" * ChyoaDepth(site.depth[i - 1]))
                                 + " "
-                                + str(int((len(site.depth[i - 1]) / 2) + 2))
+                                + str(ChyoaDepth(site.depth[i - 1]) + 1)
                                 + "."
                                 + site.depth[i - 1].split(".")[-1]
                                 + " "
-                                + Common.escape_html(site.chapters[i]),
+                                + Common.escape_html(site.chapters[i])
+                                + ChyoaDangling(site, i),
                             )
                         )
                         # c.append(epub.EpubHtml(title=site.chapters[i], file_name=str(site.depth[i-1])+'.xhtml', lang='en', tocTitle=str(' _'*int((len(site.depth[i-1])/2)+1))+' '+str(int((len(site.depth[i-1])/2)+2))+'.'+site.depth[i-1].split('.')[-1]+' '+site.chapters[i]))
@@ -270,28 +334,17 @@ def MakeEpub(site: Any) -> None:
                                 + str(site.pageIDs[i - 1])
                                 + ".xhtml",
                                 lang="en",
-                                tocTitle=str(
-                                    " _" * int((len(site.depth[i - 1]) / 2) + 1)
-                                )
+                                tocTitle=str(" _" * ChyoaDepth(site.depth[i - 1]))
                                 + " "
-                                + str(
-                                    int(
-                                        (site.partialStart + len(site.depth[i - 1]) / 2)
-                                        + 1
-                                    )
-                                )
+                                + str(site.partialStart + ChyoaDepth(site.depth[i - 1]))
                                 + "."
                                 + site.depth[i - 1].split(".")[-1]
                                 + " "
-                                + Common.escape_html(site.chapters[i]),
+                                + Common.escape_html(site.chapters[i])
+                                + ChyoaDangling(site, i),
                             )
                         )
-                c[i].content = (
-                    "<h2>\n"
-                    + Common.escape_html(site.chapters[i])
-                    + "\n</h2>\n"
-                    + Common.sanitize_html(site.epubrawstoryhtml[i])
-                )
+                c[i].loader = functools.partial(EpubChapter, site, i, True)
             elif isinstance(site, Nhentai.Nhentai):
                 c.append(
                     epub.EpubHtml(
@@ -309,12 +362,7 @@ def MakeEpub(site: Any) -> None:
                         lang="en",
                     )
                 )
-                c[i].content = (
-                    "<h2>\n"
-                    + Common.escape_html(site.chapters[i])
-                    + "\n</h2>\n"
-                    + Common.sanitize_html(site.rawstoryhtml[i])
-                )
+                c[i].loader = functools.partial(EpubChapter, site, i, False)
             book.add_item(c[i])
             toc.append(c[i])
 
@@ -345,59 +393,114 @@ def MakeEpub(site: Any) -> None:
     title_stripped = Common.sanitize_filename(site.title)
     epub.write_epub(os.path.join(wd, title_stripped + ".epub"), book)
 
-    if isinstance(site, Nhentai.Nhentai):
-        if site.hasimages:
-            with ZipFile(os.path.join(wd, site.title + ".epub"), "a") as myfile:
-                i = 1
-                for url in site.images:
-                    zeros = "0" * (len(str(len(site.images))) - 1)
-                    if len(zeros) > 1 and i > 9:
-                        zeros = "0"
-                    elif len(zeros) == 1 and i > 9:
-                        zeros = ""
-                    if i > 99:
-                        zeros = ""
-                    with myfile.open("EPUB/" + zeros + str(i) + ".jpg", "w") as myimg:
-                        img_data = Common.GetImage(url)
-                        if img_data is not None:
-                            myimg.write(img_data)
-                    i = i + 1
-    elif isinstance(site, Chyoa.Chyoa):
-        if site.hasimages:
-            with ZipFile(os.path.join(wd, title_stripped + ".epub"), "a") as myfile:
-                i = 1
-                for num in Common.urlDict[site.url]:
-                    try:
-                        i = i + 1
-                        with myfile.open(
-                            "EPUB/img" + str(i - 1) + ".jpg", "w"
-                        ) as myimg:
-                            img_data = Common.GetImage(Common.urlDict[site.url][num])
-                            if img_data is not None:
-                                myimg.write(img_data)
-                    except Exception:
-                        continue
+    if prefetch is not None:
+        maxDimension = (
+            Nhentai.MaxDimension()
+            if isinstance(site, Nhentai.Nhentai)
+            else ImageProcess.max_dimension
+        )
+        AddImages(os.path.join(wd, title_stripped + ".epub"), prefetch, maxDimension)
+
+
+# (name in the zip, url) of every image an EPUB needs
+def EpubImages(site: Any) -> List[Tuple[str, str]]:
+    if isinstance(site, Nhentai.Nhentai) and site.hasimages:
+        return [
+            ("EPUB/" + Common.ImageName(i, len(site.images)), url)
+            for i, url in enumerate(site.images, 1)
+        ]
+    if isinstance(site, Chyoa.Chyoa) and site.hasimages:
+        return [
+            ("EPUB/img" + str(i) + ".jpg", Common.urlDict[site.url][num])
+            for i, num in enumerate(Common.urlDict[site.url], 1)
+        ]
+    return []
+
+
+# Appends prefetched images to a finished EPUB; only the zip writes are serial
+def AddImages(epubPath: str, prefetch: Staging.Prefetch, maxDimension: int) -> None:
+    try:
+        staged = prefetch.Results()
+        if ImageProcess.Enabled(maxDimension):
+            done = list(staged)
+            # copies reused from the html/txt output were processed already
+            ImageProcess.ProcessAll(
+                [path for _, path in done if path not in prefetch.reused], maxDimension
+            )
+            staged = iter(done)
+        with ZipFile(epubPath, "a") as myfile:
+            for name, path in staged:
+                myfile.write(path, name)
+    finally:
+        prefetch.Close()
+
+
+# The files each requested format of a story was written to
+def Outputs(site: Any) -> Dict[str, List[str]]:
+    name = Common.sanitize_filename(site.title)
+    paths = {
+        "txt": [os.path.join(wd, name + ".txt")],
+        "html": [
+            os.path.join(wd, name + ".html"),
+            os.path.join(wd, name, name + ".html"),
+        ],
+        "epub": [os.path.join(wd, name + ".epub")],
+    }
+    return {
+        ft.lower(): [path for path in paths[ft.lower()] if os.path.isfile(path)]
+        for ft in ftype
+    }
+
+
+# Whether an earlier run wrote every requested format of the story at url, and they are still there
+def Published(url: str) -> bool:
+    outputs = Common.cache.Outputs(url) if Common.cache is not None else {}
+    return all(
+        ft.lower() in outputs and all(os.path.isfile(p) for p in outputs[ft.lower()])
+        for ft in ftype
+    )
+
+
+# Writes every requested format of a story, noting the files for --update
+def Publish(url: str, site: Common.SiteProvider) -> None:
+    try:
+        for ft in ftype:
+            formats[ft](site)
+    finally:
+        Release(site)
+    if Common.cache is not None:
+        Common.cache.RecordOutputs(url, Outputs(site))
+
+
+# Frees what a story kept for writing its output, whether it was written or not
+def Release(site: Common.SiteProvider) -> None:
+    if isinstance(site, Chyoa.Chyoa):
+        site.store.Close()
+
 
 def MakeClass(url: str) -> Optional[Common.SiteProvider]:
     # getting url
     domain = urllib.parse.urlparse(url)[1]
-    if domain == "nhentai.net" and args.t:
-        # TODO the lock should be in the Nhentai class definitions
-        with lock:
-            site = sites[domain](url)
-    else:
-        try:
-            site = sites[domain](url)
-        except KeyError:
-            print("Unsupported site: " + domain)
-            return None
+    # a 304 on the first page means the story has not changed since it was
+    # cached, which is only worth skipping for if its output is still there
+    if (
+        (Common.update or (Common.chyoaDupCheck and domain == "chyoa.com"))
+        and Published(url)
+        and Common.PageUnchanged(url)
+    ):
+        Common.prnt("Story not updated: " + url, f=True)
+        return None
+    try:
+        site = sites[domain](url)
+    except KeyError:
+        print("Unsupported site: " + domain)
+        return None
     # site=sites[domain](url)
     if args.t:
         if not site.duplicate:
-            for ft in ftype:
-                formats[ft](site)
-            q.put(site)
+            Publish(url, site)
         else:
+            Release(site)
             return None
     return site
 
@@ -530,142 +633,421 @@ parser.add_argument(
 
 parser.add_argument(
     "--chyoa-update",
-    help="Checks if story already exists in output directory, and skips it if it has not been updated on the server since file was created.",
+    help="Checks if story already exists in output directory, and skips it if it has not been updated on the server since file was created. Updated stories are crawled against the story graph saved next to the output, so only new or edited chapters are downloaded and parsed.",
     action="store_true",
 )
 
 
+parser.add_argument(
+    "--chyoa-workers",
+    help="Number of Chyoa pages fetched at once when crawling forwards with -t. Default 4",
+    type=int,
+    default=4,
+)
+
+
+parser.add_argument(
+    "--chyoa-max-depth",
+    help="Stops a forward Chyoa crawl this many levels below the starting page. Pages are fetched breadth first, so a crawl stopped by any budget keeps the top levels",
+    type=int,
+    default=0,
+)
+
+
+parser.add_argument(
+    "--chyoa-max-pages",
+    help="Stops a forward Chyoa crawl after this many chapters",
+    type=int,
+    default=0,
+)
+
+
+parser.add_argument(
+    "--chyoa-max-time",
+    help="Stops a forward Chyoa crawl after this many seconds",
+    type=float,
+    default=0,
+)
+
+
+parser.add_argument(
+    "--chyoa-max-mb",
+    help="Stops a forward Chyoa crawl after downloading this many MB",
+    type=float,
+    default=0,
+)
+
+
 parser.add_argument(
     "--usr",
     help="Chyoa username. If provided, you will be prompted for a password securely.",
 )
 
 
-args = parser.parse_args()
+parser.add_argument(
+    "--pool-size",
+    help="Maximum number of keep-alive connections kept open per host. Default 10",
+    type=int,
+    default=10,
+)
 
 
-# Handle credentials securely
+parser.add_argument(
+    "--rate-limit",
+    help="Requests per second allowed per host, as [HOST=]RATE[:BURST] (e.g. chyoa.com=1:3). Can be used multiple times. Default 2:2",
+    action="append",
+    default=[],
+)
 
 
-password = os.environ.get("CHYOA_PASSWORD")
+parser.add_argument(
+    "--rate-config",
+    help='JSON file of per-host rate limits, e.g. {"default": {"rate": 2, "burst": 2}, "chyoa.com": {"rate": 1}}',
+)
 
 
-user = args.usr or os.environ.get("CHYOA_USER")
+parser.add_argument(
+    "--retries",
+    help="Times a request is retried after a transient error (429, 5xx, timeouts). Default 4",
+    type=int,
+    default=4,
+)
 
 
-if user:
-    Common.chyoa_name = user
+parser.add_argument(
+    "--retry-budget",
+    help="Maximum seconds spent waiting between retries of a single request. Default 60",
+    type=float,
+    default=60.0,
+)
 
-    if not password:
-        password = getpass.getpass(f"Password for Chyoa user '{user}': ")
 
-try:
-    if user and password:
-        Common.GetChyoaSession(password)
+parser.add_argument(
+    "--engine",
+    help="Network backend. 'async' sends every request as a coroutine on one asyncio event loop and fetches known chapters and images ahead of the parsers (requires aiohttp). Stories are processed concurrently like -t",
+    choices=["threads", "async"],
+    default="threads",
+)
 
 
-except Common.AuthenticationError as e:
-    print(f"Error: {e}")
+parser.add_argument(
+    "--max-inflight",
+    help="Maximum number of requests in flight with --engine async. Default 1000",
+    type=int,
+    default=1000,
+)
 
-    sys.exit(1)
 
+parser.add_argument(
+    "--host-concurrency",
+    help="Maximum number of concurrent requests to one host with --engine async. Default 8",
+    type=int,
+    default=8,
+)
 
-if args.quiet:
-    Common.quiet = True
-    # sys.stdout=open(os.devnull, 'w')
-    # print('quiet enabled')
-if args.insert_images:
-    Common.images = True
-args.file = True
-stdin = False
 
-Common.prnt("Ebook-Publisher " + str(Version))
-if not sys.stdin.isatty():
-    stdin = True
-elif not args.url:
-    # print(args.url)
-    parser.error("No input")
+parser.add_argument(
+    "--workers",
+    help="Number of stories parsed at once with --engine async. Default 32",
+    type=int,
+    default=32,
+)
 
-if args.no_duplicates:
-    Common.dup = True
 
-if args.chyoa_force_forwards:
-    Common.chyoa_force_forwards = True
+parser.add_argument(
+    "--cache-dir",
+    help="Directory in which downloaded pages are cached, so stories can be re-exported without downloading them again",
+)
 
-if args.chyoa_update:
-    Common.chyoaDupCheck = True
 
-Common.lineEnding = args.eol.encode("latin-1", "backslashreplace").decode(
-    "unicode-escape"
+parser.add_argument(
+    "--cache-ttl",
+    help="Seconds a cached page is used before it is downloaded again. Default 604800 (one week)",
+    type=float,
+    default=7 * 86400,
 )
 
-if args.directory is None:
-    wd = "./"
-else:
-    wd = args.directory
-Common.wd = wd
 
-Common.opf = args.output_type
-if not Common.opf:
-    Common.opf = ["txt"]
+parser.add_argument(
+    "--cache-size",
+    help="Maximum size of the page cache in MB, least recently used pages are removed first. Default 1024",
+    type=int,
+    default=1024,
+)
 
 
-Common.mt = args.t
+parser.add_argument(
+    "--cache-only",
+    help="Offline mode: only use pages from --cache-dir, however old, and never download",
+    action="store_true",
+)
 
-cwd = os.getcwd()
-# TODO should use non-relative path
-wd = os.path.join(cwd, wd)
-if not os.path.exists(wd):
-    os.makedirs(wd)
 
+parser.add_argument(
+    "--image-store",
+    help="Directory of a content-addressed image store, so images shared between chapters, stories and runs are downloaded once",
+)
 
-styleSheet = getCSS()
 
-ftype = args.output_type
-if not ftype:
-    ftype = ["txt"]
-q: queue.Queue[Common.SiteProvider] = queue.Queue()
+parser.add_argument(
+    "--image-store-size",
+    help="Maximum size of the image store in MB, least recently used images are removed first. Default 2048",
+    type=int,
+    default=2048,
+)
 
 
-if args.file:
-    urls: List[str] = []
-    # gets the list of urls
-    if not stdin:
-        for arg in args.url:
-            urls.extend(ListURLs(arg))
-    else:
-        stdinput = sys.stdin.read()
-        urls = stdinput.split()
+parser.add_argument(
+    "--image-max-size",
+    help="Downscales images so their longest side is at most this many pixels (requires Pillow)",
+    type=int,
+    default=0,
+)
 
-    urls = list(set(urls))
 
-    for url in urls:
-        Common.urlDict[url] = {}
+parser.add_argument(
+    "--image-quality",
+    help="Re-encodes images as JPEG at this quality, 1-95 (requires Pillow)",
+    type=int,
+    default=0,
+)
 
-    threads = 0
-    # the multithreaded variant
-    if args.t:
-        lock = threading.Lock()
-        # Limit concurrent threads to 5 to avoid overwhelming servers/local resources
-        semaphore = threading.Semaphore(5)
 
-        def ThreadedMakeClass(url: str) -> None:
-            with semaphore:
-                MakeClass(url)
+parser.add_argument(
+    "--image-processes",
+    help="Number of processes used to recompress images. Default one per core",
+    type=int,
+)
+
 
-        threads = len(urls)
-        for i in urls:
-            t = threading.Thread(target=ThreadedMakeClass, args=(i,), daemon=False)
-            t.start()
+parser.add_argument(
+    "--image-workers",
+    help="Number of images downloaded at once across all stories. Default 8",
+    type=int,
+    default=8,
+)
 
+
+parser.add_argument(
+    "--image-host-concurrency",
+    help="Number of images downloaded at once from a single host. Default 4",
+    type=int,
+    default=4,
+)
+
+
+parser.add_argument(
+    "--nhentai-tier",
+    help="Nhentai image size: thumbnail (CDN previews only), reduced (full size downscaled for small readers, requires Pillow) or full. Default full",
+    choices=["thumbnail", "reduced", "full"],
+    default="full",
+)
+
+
+parser.add_argument(
+    "-u",
+    "--update",
+    help="Skips stories whose first page the server reports as unchanged since it was cached, if every requested output of the earlier run is still there. Requires --cache-dir",
+    action="store_true",
+)
+
+
+parser.add_argument(
+    "--stats",
+    help="Prints network statistics (requests and connection reuse per host) when done",
+    action="store_true",
+)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    Common.pool_size = args.pool_size
+    Common.transport.poolSize = args.pool_size
+    try:
+        if args.rate_config:
+            Common.rateLimiter.Load(os.path.join(os.getcwd(), args.rate_config))
+        for spec in args.rate_limit:
+            Common.rateLimiter.Parse(spec)
+    except (OSError, ValueError) as e:
+        parser.error("Invalid rate limit: " + str(e))
+    Common.retryPolicy.retries = args.retries
+    Common.retryPolicy.budget = args.retry_budget
+
+    if args.cache_dir:
+        Common.cache = Cache.ResponseCache(
+            os.path.join(os.getcwd(), args.cache_dir),
+            ttl=args.cache_ttl,
+            maxBytes=args.cache_size * 1048576,
+        )
+    elif args.cache_only or args.update:
+        parser.error("--cache-only and --update require --cache-dir")
+    Common.update = args.update
+    Staging.workers = args.image_workers
+    Staging.per_host = args.image_host_concurrency
+    ImageProcess.max_dimension = args.image_max_size
+    ImageProcess.quality = args.image_quality
+    ImageProcess.processes = args.image_processes
+    if ImageProcess.Enabled() and ImageProcess.Image is None:
+        parser.error(
+            "--image-max-size and --image-quality require Pillow: pip install pillow"
+        )
+    Nhentai.tier = args.nhentai_tier
+    if Nhentai.tier == "reduced" and ImageProcess.Image is None:
+        parser.error("--nhentai-tier reduced requires Pillow: pip install pillow")
+    if args.image_store:
+        Common.image_store = ImageStore.ImageStore(
+            os.path.join(os.getcwd(), args.image_store),
+            maxBytes=args.image_store_size * 1048576,
+        )
+    Common.cache_only = args.cache_only
+
+    engine: Optional[AsyncEngine.AsyncTransport] = None
+    if args.engine == "async":
+        try:
+            engine = AsyncEngine.AsyncTransport(
+                args.max_inflight, args.host_concurrency
+            )
+        except ImportError as e:
+            parser.error(str(e))
+        Common.transport = engine
+        # Stories are processed concurrently, as with -t
+        args.t = True
+
+    # Handle credentials securely
+
+    password = os.environ.get("CHYOA_PASSWORD")
+
+    user = args.usr or os.environ.get("CHYOA_USER")
+
+    if user:
+        Common.chyoa_name = user
+
+        if not password:
+            password = getpass.getpass(f"Password for Chyoa user '{user}': ")
+
+    try:
+        if user and password:
+            Common.GetChyoaSession(password)
+
+    except Common.AuthenticationError as e:
+        print(f"Error: {e}")
+
+        sys.exit(1)
+
+    if args.quiet:
+        Common.quiet = True
+        # sys.stdout=open(os.devnull, 'w')
+        # print('quiet enabled')
+    if args.insert_images:
+        Common.images = True
+    args.file = True
+    stdin = False
+
+    Common.prnt("Ebook-Publisher " + str(Version))
+    if not sys.stdin.isatty():
+        stdin = True
+    elif not args.url:
+        # print(args.url)
+        parser.error("No input")
+
+    if args.no_duplicates:
+        Common.dup = True
+
+    if args.chyoa_force_forwards:
+        Common.chyoa_force_forwards = True
+
+    if args.chyoa_update:
+        Common.chyoaDupCheck = True
+
+    Chyoa.workers = args.chyoa_workers
+    Chyoa.maxDepth = args.chyoa_max_depth
+    Chyoa.maxPages = args.chyoa_max_pages
+    Chyoa.maxTime = args.chyoa_max_time
+    Chyoa.maxBytes = int(args.chyoa_max_mb * 1048576)
+
+    Common.lineEnding = args.eol.encode("latin-1", "backslashreplace").decode(
+        "unicode-escape"
+    )
+
+    if args.directory is None:
+        wd = "./"
     else:
-        for i in urls:
-            clas = MakeClass(i)
-            if clas is not None:
-                if not clas.duplicate:
-                    for ft in ftype:
-                        formats[ft](clas)
-
-    while threads > 1:
-        q.get()
-        threads -= 1
+        wd = args.directory
+    Common.wd = wd
+
+    Common.opf = args.output_type
+    if not Common.opf:
+        Common.opf = ["txt"]
+
+    Common.mt = args.t
+
+    cwd = os.getcwd()
+    # TODO should use non-relative path
+    wd = os.path.join(cwd, wd)
+    if not os.path.exists(wd):
+        os.makedirs(wd)
+
+    styleSheet = getCSS()
+
+    ftype = args.output_type
+    if not ftype:
+        ftype = ["txt"]
+
+    if args.file:
+        urls: List[str] = []
+        # gets the list of urls
+        if not stdin:
+            for arg in args.url:
+                urls.extend(ListURLs(arg))
+        else:
+            stdinput = sys.stdin.read()
+            urls = stdinput.split()
+
+        urls = list(set(urls))
+
+        for url in urls:
+            Common.urlDict[url] = {}
+
+        workers: List[threading.Thread] = []
+        if engine is not None:
+            engine.Run(urls, MakeClass, args.workers)
+        # the multithreaded variant
+        elif args.t:
+            # Limit concurrent threads to 5 to avoid overwhelming servers/local resources
+            semaphore = threading.Semaphore(5)
+
+            def ThreadedMakeClass(url: str) -> None:
+                with semaphore:
+                    MakeClass(url)
+
+            for i in urls:
+                t = threading.Thread(target=ThreadedMakeClass, args=(i,), daemon=False)
+                t.start()
+                workers.append(t)
+
+        else:
+            for i in urls:
+                clas = MakeClass(i)
+                if clas is not None:
+                    if not clas.duplicate:
+                        Publish(i, clas)
+                    else:
+                        Release(clas)
+
+        # every story thread finishes, however its story ended
+        for t in workers:
+            t.join()
+
+        if args.stats:
+            Common.ReportStats()
+            if engine is not None:
+                Common.prnt(
+                    "async engine: at most " + str(engine.peak) + " requests in flight",
+                    f=True,
+                )
+
+        Staging.pool.Shutdown()
+        ImageProcess.pool.Shutdown()
+        if engine is not None:
+            engine.Close()